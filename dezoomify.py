@@ -16,20 +16,41 @@ import sys
 if sys.version_info[0] < 3:
     sys.exit("ERROR: This program requires Python 3 to run.")
 
-from math import ceil, floor
+from math import ceil, floor, isqrt
+from fractions import Fraction
+import abc
 import argparse
+import asyncio
+import collections
+import copy
+import ctypes
+import ctypes.util
+import functools
+import hashlib
+import http.client
+import io
+import json
 import logging
+import mmap
 import os
 import re
 import subprocess
 import tempfile
 import shutil
+import sqlite3
+import ssl
+import struct
 import urllib.error
 import urllib.request
 import urllib.parse
 import platform
+import queue
+import zlib
 import itertools
-from multiprocessing.pool import ThreadPool
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 
 # Progressbar module is optional but recommended.
 progressbar = None
@@ -38,6 +59,65 @@ try:
 except ImportError:
     pass
 
+# Pillow is only needed for the pil joining algorithm, and for --scales and --fill-missing.
+Image = None
+try:
+    from PIL import Image, JpegImagePlugin
+except ImportError:
+    pass
+
+def parse_size(size):
+    """Parse a size in bytes with an optional K, M, G or T suffix (powers of 1024)."""
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', size, re.IGNORECASE)
+    if not m:
+        raise argparse.ArgumentTypeError("invalid size: '{}'".format(size))
+    return int(float(m.group(1)) * 1024 ** ' KMGT'.index(m.group(2).upper() or ' '))
+
+
+def parse_count(count):
+    """Parse a number with an optional K, M or G suffix (powers of 1000)."""
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)\s*$', count, re.IGNORECASE)
+    if not m:
+        raise argparse.ArgumentTypeError("invalid number: '{}'".format(count))
+    return int(float(m.group(1)) * 1000 ** ' KMG'.index(m.group(2).upper() or ' '))
+
+
+def parse_region(region):
+    """
+    Parse a rectangle given as x,y,w,h. Values with a decimal point are fractions of the
+    width or height of the image, the others are pixels.
+    """
+    values = region.split(',')
+    try:
+        if len(values) != 4:
+            raise ValueError
+        values = [float(value) if '.' in value else int(value) for value in values]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid region: '{}', expected x,y,w,h".format(region))
+    if any(value < 0 or isinstance(value, float) and value > 1 for value in values) or 0 in values[2:]:
+        raise argparse.ArgumentTypeError("invalid region: '{}'".format(region))
+    return values
+
+
+def parse_scales(scales):
+    """Parse a comma-separated list of fractions below 1 that libjpeg can scale by, multiples of 1/8."""
+    result = []
+    for scale in scales.split(','):
+        m = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', scale)
+        if not m or not 0 < int(m.group(1)) < int(m.group(2)) or 8 * int(m.group(1)) % int(m.group(2)):
+            raise argparse.ArgumentTypeError("invalid scale: '{}', expected a fraction like 1/2 or 3/8".format(scale))
+        result.append(Fraction(int(m.group(1)), int(m.group(2))))
+    return result
+
+
+def parse_shard(shard):
+    """Parse a shard of a list given as i/N, the i-th of N shards, numbered from 1."""
+    m = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', shard)
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise argparse.ArgumentTypeError("invalid shard: '{}', expected i/N with 1 <= i <= N, like 2/4".format(shard))
+    return int(m.group(1)), int(m.group(2))
+
+
 parser = argparse.ArgumentParser(
     description="Download and untile a Zoomify image.",
     epilog="More detailed help can be found at the project's wiki: http://sf.net/p/dezoomify/wiki/",
@@ -51,7 +131,8 @@ parser.add_argument('out', metavar='OUTPUT_FILE', action='store',
 parser.add_argument('-b', dest='base', action='store_true', default=False,
                     help='the URL is the base directory for the Zoomify tile structure (see wiki for more details)')
 parser.add_argument('-l', dest='list', action='store_true', default=False,
-                    help='batch mode: the URL parameter refers to a local file with a list of URL and filename pairs (one pair per line, separated by a tab). '
+                    help='batch mode: the URL parameter refers to a local file with a list of URL and filename pairs (one pair per line, separated by a tab), '
+                         'or to the standard input if it is -. The list is read as the images are processed. '
                          'The directory in which the images will be saved will be OUTPUT_FILE minus its extension. '
                          'Specifying a filename is optional, OUTPUT_FILE with numbers appended is used by default.')
 parser.add_argument('-z', dest='zoom_level', action='store', default=-1, type=int,
@@ -63,62 +144,2372 @@ parser.add_argument('-s', dest='store', action='store_true', default=False,
 parser.add_argument('-x', dest='no_download', action='store_true', default=False,
                     help='create the image from previously downloaded files stored '
                          'with -s instead of downloading (can be useful when an error occurred during tile joining)')
+parser.add_argument('--in-memory', dest='in_memory', action='store_true', default=False,
+                    help='keep the downloaded tiles in memory and pass them to jpegtran through pipes, '
+                         'and keep the intermediate images in a RAM-backed directory (/dev/shm) when it '
+                         'has room for them, so that nothing but the final image is written to disk. '
+                         'Has no effect with -s')
 parser.add_argument('-j', dest='jpegtran', action='store',
                     help='location of the jpegtran executable (assumed to be in the '
                          'same directory as this script by default)')
 parser.add_argument('-t', dest='nthreads', action='store', default=16, type=int,
                     help='number of simultaneous tile downloads (default: 16)')
+parser.add_argument('--timeout', dest='timeout', action='store', default=30.0, type=float,
+                    help='seconds a tile download waits for the server to connect or to respond before it '
+                         'fails, is retried and counts as a sign of an overloaded server (default: 30)')
+parser.add_argument('--retries', dest='retries', action='store', default=3, type=int,
+                    help='number of times a tile download is retried after a server error or '
+                         'a network failure (default: 3)')
+parser.add_argument('--retry-delay', dest='retry_delay', action='store', default=1.0, type=float,
+                    help='delay in seconds before the first retry of a tile, doubled for every '
+                         'following retry, with random jitter (default: 1)')
+parser.add_argument('--retry-budget', dest='retry_budget', action='store', default=None, type=int,
+                    help='maximum number of retries for all tiles of an image together '
+                         '(default: 10%% of the number of tiles, at least 10)')
+parser.add_argument('--adaptive', dest='adaptive', action='store_true', default=False,
+                    help='tune the number of simultaneous tile downloads at runtime based on latency, '
+                         'throughput and errors, between --min-threads and -t')
+parser.add_argument('--min-threads', dest='min_threads', action='store', default=2, type=int,
+                    help='lowest number of simultaneous tile downloads with --adaptive (default: 2)')
+parser.add_argument('--cache', dest='cache', action='store', default=None,
+                    help='directory of a persistent tile cache shared by all runs and images, '
+                         'so that tiles are only downloaded once')
+parser.add_argument('--cache-size', dest='cache_size', action='store', default='1G', type=parse_size,
+                    help='maximum size of the tile cache, least recently used tiles are evicted '
+                         'when it is exceeded. Accepts K, M, G and T suffixes (default: 1G)')
+parser.add_argument('--cache-404-ttl', dest='cache_missing_ttl', action='store', default=86400, type=float,
+                    help='number of seconds the cache remembers that a tile does not exist '
+                         'on the server (default: 86400)')
+parser.add_argument('--window', dest='window', action='store', default=None, type=int,
+                    help='maximum number of tiles that can be downloading or waiting to be joined '
+                         'at the same time (default: 4 times -t, at least 64)')
+parser.add_argument('--engine', dest='engine', action='store', default='thread', choices=['thread', 'asyncio'],
+                    help='how simultaneous tile downloads are run: one thread per download (thread), '
+                         'or all downloads in a single thread using asyncio, which allows hundreds '
+                         'of simultaneous downloads with -t (default: thread)')
+parser.add_argument('--pool-size', dest='pool_size', action='store', default=None, type=int,
+                    help='number of idle keep-alive connections kept open per host (default: same as -t)')
 #parser.add_argument('-p', dest='protocol', action='store', default='zoomify',
 #                    help='which image untiler protocol to use (options: zoomify. Default: zoomify)')
-# This is commented out for now. Will probably reintroduce this option when Pillow is integrated.
-# parser.add_argument('-a', dest='algorithm', action='store', default='jt_xl',
-# choices=['jt_std', 'jt_xl'],
-# help='which image untiler algorithm to use.'
-# 'Options:'
-# '    - jt_std (jpegtran standard classic - lossless)'
-# '             Proven classic, slow for large images.'
-# '    - jt_xl (jpegtran large image - lossless)'
-# '            New, way faster for large images.'
-# '    - pil (Python  Pillow - almost lossless - not yet implemented)'
-# 'Default: jt_xl')
+parser.add_argument('--jobs', dest='jobs', action='store', default=1, type=int,
+                    help='number of images of a list (-l) processed at the same time, so that one image is '
+                         'downloaded while another one is joined. They share the -t simultaneous downloads and '
+                         'the --join-workers. No progress bars are shown with more than one job (default: 1)')
+parser.add_argument('--prefetch', dest='prefetch', action='store', default=4, type=int,
+                    help='number of the next images of a list (-l) whose page and ImageProperties.xml are '
+                         'fetched in the background while the current image is downloaded and joined. '
+                         'Errors are still reported with the image they belong to. 0 disables it (default: 4)')
+parser.add_argument('--shard', dest='shard', action='store', default=None, type=parse_shard,
+                    help='only process the i-th of N shards of a list (-l), given as i/N: the entries numbered '
+                         'i, i + N, i + 2N... so that N machines can share one list. The images are named as '
+                         'when the whole list is processed')
+parser.add_argument('--state', dest='state', action='store', default=None,
+                    help='SQLite database where the outcome of each image of a list (-l) is recorded: '
+                         'complete, partial (with missing tiles) or failed, with the error, tile counts, '
+                         'bytes written and timing. Images already created are skipped when the list '
+                         'is run again, so only the pending and failed images are processed')
+parser.add_argument('--status', dest='status', action='store_true', default=False,
+                    help='print how many images of the list are complete, partial, failed and pending '
+                         'according to --state, and the errors of the failed images, then exit')
+parser.add_argument('--join-workers', dest='join_workers', action='store', default=None, type=int,
+                    help='number of image columns assembled in parallel (default: number of CPU cores)')
+parser.add_argument('--format', dest='format', action='store', default='jpeg',
+                    choices=['jpeg', 'tiff', 'dzi', 'zoomify'],
+                    help='format of the created image: a single JPEG image joined from the tiles (jpeg), '
+                         'a tiled BigTIFF image that stores the downloaded JPEG tiles as they are, '
+                         'without joining them (tiff), or a copy of the tile pyramid to serve from another '
+                         'tile server, with the tiles of all zoom levels or those selected with --levels: '
+                         'a Deep Zoom image (dzi), written as OUT.dzi and the OUT_files directory, '
+                         'or a Zoomify image (zoomify), written to the OUT directory. Default: jpeg')
+parser.add_argument('--levels', dest='levels', action='store', default=None,
+                    help='zoom levels copied with --format dzi or zoomify, as a comma-separated list '
+                         'of levels and ranges of levels, e.g. 0-4,6. Negative levels count from '
+                         'the highest zoom level, like with -z (default: all levels)')
+parser.add_argument('--turbojpeg', dest='turbojpeg', action='store', default=None,
+                    help='location of the TurboJPEG library of libjpeg-turbo used by -a tj_mem '
+                         '(searched for among the system libraries by default)')
+# The choices and help are filled in from the registered joining algorithms.
+algorithm_option = parser.add_argument('-a', dest='algorithm', action='store', default='auto')
+parser.add_argument('--optimize', dest='optimize', action='store', default='final',
+                    choices=['final', 'skip', 'merge', 'background'],
+                    help='when to optimize the Huffman tables of the joined image, which makes it a few percent '
+                         'smaller. final: in a separate pass over the finished image. skip: not at all. '
+                         'merge: in the last joining step where possible, saving the pass. background: in a '
+                         'separate pass while the next image is processed; the image appears once optimized. '
+                         'The sizes and times are logged with -v (default: final)')
+parser.add_argument('--max-memory', dest='max_memory', action='store', default=None, type=parse_size,
+                    help='memory the joining may use, with an optional K, M, G or T suffix. Images needing more '
+                         'are joined as bands of rows of tiles, or as a mosaic if a row of tiles is too large, '
+                         'in separate JPEG files OUTPUT_FILE_<row>[_<col>], with an index of their pixel '
+                         'offsets in a JSON file next to them. Pieces are joined in parallel if the budget and '
+                         'the join workers allow (default: no limit)')
+parser.add_argument('--region', dest='region', action='store', default=None, type=parse_region,
+                    help='only download the tiles intersecting a rectangle of the image at the zoom level, '
+                         'given as x,y,w,h in pixels, or in fractions of the image size when written with a '
+                         'decimal point (e.g. 0.25,0.25,0.5,0.5), and crop the joined image to it losslessly. '
+                         'The top left corner may move up and left by a few pixels, to the edge of the blocks '
+                         'the JPEG image is coded in. With --format tiff the whole tiles are kept '
+                         '(default: the whole image)')
+parser.add_argument('--scales', dest='scales', action='store', default=None, type=parse_scales,
+                    help='also write smaller copies of the image, without downloading anything more, as a '
+                         'comma-separated list of fractions of its size in eighths, e.g. 1/2,1/8, written to '
+                         'OUTPUT_FILE_<numerator>-<denominator>. A halving, quartering, etc. is joined from the lower '
+                         'zoom level if all its tiles are in the --cache. Otherwise the joined image is scaled '
+                         'with Pillow, or, without it, with jpegtran -scale if that writes a standard JPEG image')
+parser.add_argument('--fill-missing', dest='fill_missing', action='store_true', default=False,
+                    help='fill the tiles that cannot be downloaded with the quarter of their parent tile in the '
+                         'next lower zoom level that covers them, upscaled, and list the filled regions. Only the '
+                         'parent tiles of the missing tiles are downloaded, or taken from the --cache. Needs '
+                         'Pillow, or a jpegtran that scales to standard JPEG images')
+parser.add_argument('--max-pixels', dest='max_pixels', action='store', default=None, type=parse_count,
+                    help='download the highest zoom level, up to the one selected with -z, whose image has at '
+                         'most this many pixels, with an optional K, M or G suffix, e.g. 50M (default: no limit)')
+parser.add_argument('--max-bytes', dest='max_bytes', action='store', default=None, type=parse_size,
+                    help='download the highest zoom level, up to the one selected with -z, whose tiles are '
+                         'estimated to take at most this many bytes, with an optional K, M, G or T suffix. The size '
+                         'is estimated from a few sample tiles (default: no limit)')
+parser.add_argument('--deadline', dest='deadline', action='store', default=None, type=float,
+                    help='download the highest zoom level, up to the one selected with -z, whose tiles are '
+                         'estimated to download in at most this many seconds, from the time a few sample tiles '
+                         'take to fetch. The joining is not counted (default: no limit)')
+parser.add_argument('--plan', dest='plan', action='store_true', default=False,
+                    help='print how each image would be joined, with the estimated work, memory and disk use, '
+                         'without downloading it')
 parser.add_argument('-v', dest='verbose', action='count', default=0,
                     help="increase verbosity (-vv for more)")
 
+class PooledResponse(io.BytesIO):
+    """
+    A fully read HTTP response, returned by HTTPConnectionPool.
+    Behaves like the file-like object returned by urllib.request.urlopen.
+    """
+    def __init__(self, url, status, headers, body):
+        super().__init__(body)
+        self.url = url
+        self.status = status
+        self.headers = headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+
+class HTTPConnectionPool():
+    """
+    Keeps persistent (keep-alive) HTTP connections to each host, so that fetching
+    thousands of tiles does not cost a TCP and TLS handshake per tile.
+
+    A connection is checked out by a thread for the duration of one request and
+    returned to the pool afterwards. Up to maxsize idle connections are kept per host.
+    Idle connections that have been closed by the server are replaced transparently.
+    A connection that stalls for timeout seconds fails the request with a TimeoutError reason.
+    """
+    max_redirects = 10
+
+    def __init__(self, maxsize=16, timeout=30.0):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _get_connection(self, key):
+        """Return an idle connection to the host if there is one, otherwise a new one."""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, **kwargs), False
+        return http.client.HTTPConnection(host, port, **kwargs), False
+
+    def _put_connection(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def request(self, url, headers):
+        """
+        Perform a GET request, following redirects.
+
+        Returns a PooledResponse. Raises urllib.error.HTTPError for error responses
+        and urllib.error.URLError if the connection fails, just like urllib.request does.
+        """
+        for _ in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port)
+            selector = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+            while True:
+                connection, reused = self._get_connection(key)
+                try:
+                    connection.request('GET', selector, headers=headers)
+                    response = connection.getresponse()
+                    body = response.read()
+                except (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                        ConnectionResetError, BrokenPipeError) as e:
+                    connection.close()
+                    if reused:
+                        # The server has closed the idle connection. Try again with another one.
+                        continue
+                    raise urllib.error.URLError(e)
+                except (OSError, http.client.HTTPException) as e:
+                    connection.close()
+                    raise urllib.error.URLError(e)
+                break
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._put_connection(key, connection)
+
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if response.status >= 400:
+                raise urllib.error.HTTPError(url, response.status, response.reason,
+                                             response.headers, io.BytesIO(body))
+            return PooledResponse(url, response.status, response.headers, body)
+
+        raise urllib.error.HTTPError(url, response.status, 'Too many redirects',
+                                     response.headers, io.BytesIO(body))
+
+
+# Connections shared by all downloads.
+http_pool = HTTPConnectionPool()
+
+
+# Spoof the user-agent and referrer, in case that matters.
+request_headers = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 6.2; WOW64; rv:24.0) Gecko/20100101 Firefox/24.0',
+    'Referer': 'http://google.com'
+}
+
+
+def quote_url(url):
+    """Escape the path part of the URL so spaces in it would not confuse the server."""
+    scheme, netloc, path, qs, anchor = urllib.parse.urlsplit(url)
+    path = urllib.parse.quote(path, '/%:|')
+    qs = urllib.parse.quote_plus(qs, ':&=')
+    return urllib.parse.urlunsplit((scheme, netloc, path, qs, anchor))
+
+
+def uses_proxy(url):
+    """Whether urllib would send a request for the URL through a proxy."""
+    scheme, netloc = urllib.parse.urlsplit(url)[:2]
+    return scheme in urllib.request.getproxies() and not urllib.request.proxy_bypass(netloc)
+
+
 def open_url(url):
     """
     Similar to urllib.request.urlopen,
     except some additional preparation is done on the URL and
     the user-agent and referrer are spoofed.
 
+    Connections are reused through http_pool, unless a proxy is configured
+    for the URL, in which case urllib handles the request.
+
     Keyword arguments:
     url -- the URL to open
     """
+    url = quote_url(url)
+    if urllib.parse.urlsplit(url).scheme in ('http', 'https') and not uses_proxy(url):
+        return http_pool.request(url, request_headers)
 
-    # Escape the path part of the URL so spaces in it would not confuse the server.
-    scheme, netloc, path, qs, anchor = urllib.parse.urlsplit(url)
-    path = urllib.parse.quote(path, '/%:|')
-    qs = urllib.parse.quote_plus(qs, ':&=')
-    url = urllib.parse.urlunsplit((scheme, netloc, path, qs, anchor))
+    # create a request object for the URL
+    request = urllib.request.Request(url, headers=request_headers)
+    # create an opener object
+    opener = urllib.request.build_opener()
+    # open a connection and receive the http response headers + contents
+    return opener.open(request)
+
+
+def download_url(url, destination):
+    """
+    Copy a network object denoted by a URL to a local file.
+    """
+    with open_url(url) as response, open(destination, 'wb') as out_file:
+        shutil.copyfileobj(response, out_file)
+
+class AsyncHTTPClient():
+    """
+    A minimal HTTP/1.1 client for asyncio, used by the asyncio download engine.
+
+    Only supports GET requests. Like HTTPConnectionPool, it keeps up to maxsize idle
+    keep-alive connections per host and replaces connections closed by the server.
+    Connecting and each response have to complete within timeout seconds.
+    Proxies are not supported.
+    """
+    max_redirects = 10
+
+    def __init__(self, maxsize=16, timeout=30.0):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = {}
+
+    async def _get_connection(self, key):
+        idle = self._idle.get(key)
+        if idle:
+            return idle.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            connecting = asyncio.open_connection(host, port or 443, ssl=ssl.create_default_context())
+        else:
+            connecting = asyncio.open_connection(host, port or 80)
+        try:
+            reader, writer = await asyncio.wait_for(connecting, self.timeout)
+        except asyncio.TimeoutError:
+            raise urllib.error.URLError(TimeoutError("timed out connecting to {}".format(host)))
+        except OSError as e:
+            raise urllib.error.URLError(e)
+        return (reader, writer), False
+
+    async def _exchange(self, writer, reader, request):
+        writer.write(request)
+        await writer.drain()
+        return await self._read_response(reader)
+
+    def _put_connection(self, key, connection):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.maxsize:
+            idle.append(connection)
+        else:
+            connection[1].close()
+
+    async def close(self):
+        """Close all idle connections."""
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for reader, writer in connections:
+                writer.close()
+
+    @staticmethod
+    async def _read_response(reader):
+        """Read a response, return (status, reason, headers, body, will_close)."""
+        status_line = await reader.readline()
+        if not status_line:
+            raise http.client.RemoteDisconnected("Remote end closed connection without response")
+        try:
+            version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(status_line)
+
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            header_lines.append(line)
+        headers = http.client.parse_headers(io.BytesIO(b''.join(header_lines) + b'\r\n'))
+
+        connection = (headers.get('Connection') or '').lower()
+        will_close = connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive')
+        if 'chunked' in (headers.get('Transfer-Encoding') or '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';', 1)[0], 16)
+                if size == 0:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass  # skip trailers
+            body = b''.join(chunks)
+        elif headers.get('Content-Length') is not None:
+            body = await reader.readexactly(int(headers['Content-Length']))
+        elif status in (204, 304) or 100 <= status < 200:
+            body = b''
+        else:
+            body = await reader.read()
+            will_close = True
+        return status, reason, headers, body, will_close
+
+    async def get(self, url, headers=request_headers):
+        """
+        Fetch a URL and return the response body.
+        Raises urllib.error.HTTPError for error responses and urllib.error.URLError if the connection fails.
+        """
+        url = quote_url(url)
+        for _ in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port)
+            selector = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+            request = ['GET {} HTTP/1.1'.format(selector), 'Host: {}'.format(parts.netloc)]
+            request += ['{}: {}'.format(name, value) for name, value in headers.items()]
+            request = ('\r\n'.join(request) + '\r\n\r\n').encode('latin-1')
+
+            while True:
+                connection, reused = await self._get_connection(key)
+                reader, writer = connection
+                try:
+                    status, reason, response_headers, body, will_close = await asyncio.wait_for(
+                        self._exchange(writer, reader, request), self.timeout)
+                except asyncio.TimeoutError:
+                    writer.close()
+                    raise urllib.error.URLError(TimeoutError("timed out waiting for {}".format(url)))
+                except (http.client.RemoteDisconnected, asyncio.IncompleteReadError,
+                        ConnectionResetError, BrokenPipeError) as e:
+                    writer.close()
+                    if reused:
+                        # The server has closed the idle connection. Try again with another one.
+                        continue
+                    raise urllib.error.URLError(e)
+                except (OSError, ValueError, http.client.HTTPException) as e:
+                    writer.close()
+                    raise urllib.error.URLError(e)
+                break
+
+            if will_close:
+                writer.close()
+            else:
+                self._put_connection(key, connection)
+
+            location = response_headers.get('Location')
+            if status in (301, 302, 303, 307, 308) and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if status >= 400:
+                raise urllib.error.HTTPError(url, status, reason, response_headers, io.BytesIO(body))
+            return body
+
+        raise urllib.error.HTTPError(url, status, 'Too many redirects', response_headers, io.BytesIO(body))
+
+
+class TileScheduler():
+    """
+    Hands out tiles to the download workers in the order in which the joiner needs them,
+    and passes the results on to the joiner in that same order.
+
+    Only a bounded window of tiles ahead of the joiner can be downloading or waiting to be
+    joined at any time, so memory use does not grow with the number of tiles. When the window
+    is full, the workers wait for the joiner to catch up (backpressure). As tiles are handed
+    out in joining order, the tile the joiner needs next is always started before the others.
+    """
+
+    def __init__(self, items, window):
+        self.window = max(1, window)
+        self._items = iter(items)
+        self._next_index = 0  # index of the next item to hand out
+        self._next_result = 0  # index of the next result the joiner needs
+        self._num_items = None  # known once all items have been handed out
+        self._results = {}
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def next_task(self):
+        """
+        Return (index, item) of the next tile to download, waiting while the window is full.
+        Returns None when there are no more tiles.
+        """
+        with self._condition:
+            while not self._closed and self._next_index - self._next_result >= self.window:
+                self._condition.wait()
+            if self._closed or self._num_items is not None:
+                return None
+            try:
+                item = next(self._items)
+            except StopIteration:
+                self._num_items = self._next_index
+                self._condition.notify_all()
+                return None
+            self._next_index += 1
+            return self._next_index - 1, item
+
+    def complete(self, index, result, error=None):
+        """Store the result of a task, or the exception it raised."""
+        with self._condition:
+            self._results[index] = (result, error)
+            self._condition.notify_all()
+
+    def close(self):
+        """Stop handing out tiles, e.g. because the joiner has given up."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def __iter__(self):
+        """Yield the results in order. Exceptions raised by tasks are re-raised here."""
+        try:
+            while True:
+                with self._condition:
+                    while self._next_result not in self._results and not (
+                            self._num_items is not None and self._next_result >= self._num_items):
+                        self._condition.wait()
+                    if self._next_result not in self._results:
+                        return
+                    result, error = self._results.pop(self._next_result)
+                    self._next_result += 1
+                    self._condition.notify_all()
+                if error is not None:
+                    raise error
+                yield result
+        finally:
+            self.close()
+
+
+def start_thread_workers(scheduler, func, nthreads):
+    """Run func on the items of a TileScheduler in nthreads background threads."""
+    def worker():
+        while True:
+            task = scheduler.next_task()
+            if task is None:
+                return
+            index, item = task
+            try:
+                scheduler.complete(index, func(item))
+            except Exception as e:
+                scheduler.complete(index, None, e)
+
+    for _ in range(nthreads):
+        threading.Thread(target=worker, daemon=True).start()
+
+
+def start_async_workers(scheduler, func, concurrency, finalize=None):
+    """
+    Run the coroutine function func on the items of a TileScheduler, with up to concurrency
+    calls at the same time, in an asyncio event loop in a single background thread.
+
+    finalize -- optional coroutine function awaited in the event loop after all calls are done
+    """
+    async def run_task(slots, index, item):
+        try:
+            scheduler.complete(index, await func(item))
+        except Exception as e:
+            scheduler.complete(index, None, e)
+        finally:
+            slots.release()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(concurrency)
+        tasks = set()
+        try:
+            while True:
+                await slots.acquire()
+                # Waiting for the window to open up blocks, so do it outside of the event loop.
+                task = await loop.run_in_executor(None, scheduler.next_task)
+                if task is None:
+                    break
+                task = asyncio.ensure_future(run_task(slots, *task))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        finally:
+            if finalize is not None:
+                await finalize()
+
+    threading.Thread(target=asyncio.run, args=(run(),), daemon=True).start()
+
+
+class RetryPolicy():
+    """
+    Decides whether and when a failed tile download is retried.
+
+    The delay before a retry grows exponentially with every attempt and has random jitter,
+    so that simultaneous downloads do not retry in lockstep. All tiles of an image share
+    a budget of retries, so a dead server does not cause a retry storm.
+    """
+    retryable_statuses = {408, 425, 429, 500, 502, 503, 504}
+    max_delay = 60.0
+
+    def __init__(self, retries, delay, budget):
+        self.retries = retries
+        self.delay = delay
+        self.budget = budget
+        self.num_retries = 0
+        self.num_recovered = 0
+        self.num_failed = 0
+        self.exhaustion_reported = False
+        self._lock = threading.Lock()
+
+    def is_retryable(self, error):
+        """Whether the download may succeed when retried. Timeouts may, and signal an overloaded server."""
+        if isinstance(error, urllib.error.HTTPError):
+            return error.code in self.retryable_statuses
+        return isinstance(error, (urllib.error.URLError, http.client.HTTPException, ConnectionError, TimeoutError))
+
+    def next_delay(self, attempt, error):
+        """
+        Return the number of seconds to wait before retrying a download that has failed
+        with the given error on the given (zero-based) attempt, or None if it should not be retried.
+        """
+        if attempt >= self.retries or not self.is_retryable(error):
+            return None
+        with self._lock:
+            if self.num_retries >= self.budget:
+                return None
+            self.num_retries += 1
+        delay = min(self.max_delay, self.delay * 2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        # Respect the server's wishes, within reason.
+        retry_after = getattr(error, 'headers', None) and error.headers.get('Retry-After')
+        if retry_after and retry_after.strip().isdigit():
+            delay = max(delay, min(float(retry_after), self.max_delay))
+        return delay
+
+    def record(self, attempt, success):
+        """Record the outcome of a download that took attempt + 1 attempts."""
+        if attempt > 0:
+            with self._lock:
+                if success:
+                    self.num_recovered += 1
+                else:
+                    self.num_failed += 1
+
+    @property
+    def exhausted(self):
+        return self.num_retries >= self.budget
+
+
+class ConcurrencyController():
+    """
+    Limits the number of tile downloads in flight and, if min_limit < max_limit,
+    tunes that limit at runtime with an AIMD (additive increase, multiplicative decrease) scheme.
+
+    Completed downloads are evaluated in windows of about `limit` downloads. If too many of them
+    failed with errors that indicate an overloaded server (throttling, timeouts, dropped
+    connections), the limit is halved. If the latency has grown well above the lowest latency
+    seen, the server is queueing requests and the limit is decreased by a quarter. Otherwise, the
+    limit is increased by one, unless the previous increase did not improve the throughput.
+    Until the first decrease, the limit is doubled instead of increased by one (slow start).
+
+    Downloads run in threads (acquire) or in asyncio event loops (acquire_async). A released slot
+    wakes up both, so several event loops in different threads can share a controller, along
+    with threads, like the threads filling missing tiles alongside the asyncio engine.
+    """
+    max_error_rate = 0.05
+    max_latency_ratio = 2.0
+    min_window = 8
+
+    def __init__(self, min_limit, max_limit, log=None):
+        self.min_limit = max(1, min(min_limit, max_limit))
+        self.max_limit = max(1, max_limit)
+        self.adaptive = self.min_limit < self.max_limit
+        self.limit = self.min_limit if self.adaptive else self.max_limit
+        self.lowest_limit = self.highest_limit = self.limit
+        self.log = log or logging.getLogger(__name__)
+        self.in_flight = 0
+        self.slow_start = True
+        self.base_latency = None
+        self._last_throughput = None
+        self._increased = False
+        self._condition = threading.Condition()
+        # Events waking up the downloads waiting in each asyncio event loop.
+        self._released = {}
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self._window_errors = 0
+        self._window_latency = 0.0
+
+    def try_acquire(self):
+        """Take a download slot if one is free. Returns whether that succeeded."""
+        with self._condition:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self):
+        """Wait for a free download slot and take it."""
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        """Wait for a free download slot in the asyncio event loop and take it."""
+        loop = asyncio.get_running_loop()
+        with self._condition:
+            released = self._released.get(loop)
+            if released is None:
+                released = self._released[loop] = asyncio.Event()
+        while True:
+            # Cleared first, so a slot released by another thread in the meantime is not missed.
+            released.clear()
+            if self.try_acquire():
+                return
+            await released.wait()
+
+    def release(self, latency, congested):
+        """
+        Give back a download slot.
+
+        latency -- how long the download took, in seconds
+        congested -- whether the download failed with an error indicating an overloaded server
+        """
+        with self._condition:
+            self.in_flight -= 1
+            self._window_count += 1
+            self._window_latency += latency
+            if congested:
+                self._window_errors += 1
+            if self.adaptive and self._window_count >= max(self.limit, self.min_window):
+                self._evaluate()
+            self._condition.notify_all()
+            for loop, released in list(self._released.items()):
+                if loop.is_closed():
+                    del self._released[loop]
+                else:
+                    loop.call_soon_threadsafe(released.set)
+
+    def _evaluate(self):
+        """Adjust the limit based on the downloads completed in the current window."""
+        elapsed = max(time.monotonic() - self._window_start, 1e-6)
+        throughput = self._window_count / elapsed
+        latency = self._window_latency / self._window_count
+        error_rate = self._window_errors / self._window_count
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+
+        old_limit = self.limit
+        if error_rate > self.max_error_rate:
+            self.limit = max(self.min_limit, self.limit // 2)
+            reason = 'decrease (errors)'
+        elif latency > self.max_latency_ratio * self.base_latency:
+            self.limit = max(self.min_limit, self.limit * 3 // 4)
+            reason = 'decrease (latency)'
+        elif self._increased and throughput <= self._last_throughput:
+            reason = 'hold (throughput did not improve)'
+        elif self.slow_start:
+            self.limit = min(self.max_limit, self.limit * 2)
+            reason = 'increase (slow start)'
+        else:
+            self.limit = min(self.max_limit, self.limit + 1)
+            reason = 'increase'
+
+        if self.limit < old_limit:
+            self.slow_start = False
+        self._increased = self.limit > old_limit
+        self._last_throughput = throughput
+        self.lowest_limit = min(self.lowest_limit, self.limit)
+        self.highest_limit = max(self.highest_limit, self.limit)
+        self.log.debug(
+            "Simultaneous downloads: {} -> {}, {}. Latency {:.0f} ms (lowest {:.0f} ms), "
+            "throughput {:.1f} tiles/s, errors {:.0%}."
+            .format(old_limit, self.limit, reason, latency * 1000, self.base_latency * 1000,
+                    throughput, error_rate)
+        )
+        self._reset_window()
+
+
+class TileCache():
+    """
+    A persistent cache of downloaded tiles, shared by all runs and batch entries.
+
+    Tiles are keyed by their URL and stored as files in the cache directory. An SQLite index
+    keeps the size and SHA-256 hash of each file, so that corrupt files are detected and
+    discarded, and when each tile was last used. When the total size exceeds max_size bytes,
+    the least recently used tiles are evicted. URLs that do not exist on the server (404)
+    are remembered for missing_ttl seconds.
+    """
+    index_name = 'index.sqlite'
+
+    def __init__(self, directory, max_size, missing_ttl):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+        self.missing_ttl = missing_ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, self.index_name),
+                                   check_same_thread=False, isolation_level=None, timeout=60)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS tiles ('
+                         'key TEXT PRIMARY KEY, url TEXT NOT NULL, size INTEGER NOT NULL, '
+                         'sha256 TEXT, last_used REAL NOT NULL, missing_until REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS tiles_last_used ON tiles (last_used)')
+        # The total size is kept in the database, so that processes sharing the cache all see it.
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            self._db.execute('CREATE TABLE IF NOT EXISTS total (size INTEGER NOT NULL)')
+            if self._db.execute('SELECT 1 FROM total').fetchone() is None:
+                self._db.execute('INSERT INTO total SELECT COALESCE(SUM(size), 0) FROM tiles')
+            self._db.execute('CREATE TRIGGER IF NOT EXISTS tiles_insert AFTER INSERT ON tiles '
+                             'BEGIN UPDATE total SET size = size + NEW.size; END')
+            self._db.execute('CREATE TRIGGER IF NOT EXISTS tiles_delete AFTER DELETE ON tiles '
+                             'BEGIN UPDATE total SET size = size - OLD.size; END')
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+
+    @property
+    def size(self):
+        """The total size of the cached tiles, written by any process."""
+        return self._db.execute('SELECT size FROM total').fetchone()[0]
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _remove(self, key):
+        """Remove an entry. Must be called with the lock held."""
+        row = self._db.execute('SELECT size FROM tiles WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return
+        self._db.execute('DELETE FROM tiles WHERE key = ?', (key,))
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, url):
+        """
+        Return the cached content of the URL, or None if it is not in the cache.
+        Raises urllib.error.HTTPError if the URL is remembered not to exist on the server.
+        """
+        key = self._key(url)
+        with self._lock:
+            row = self._db.execute('SELECT size, sha256, missing_until FROM tiles WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is None:
+                return None
+            size, digest, missing_until = row
+            if missing_until is not None:
+                if missing_until > time.time():
+                    raise urllib.error.HTTPError(url, 404, 'Not Found (cached)', None, None)
+                self._remove(key)
+                return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            data = None
+        with self._lock:
+            if data is None or len(data) != size or hashlib.sha256(data).hexdigest() != digest:
+                self._remove(key)
+                return None
+            self._db.execute('UPDATE tiles SET last_used = ? WHERE key = ?', (time.time(), key))
+        return data
+
+    def put(self, url, data):
+        """Store the content of the URL, evicting least recently used tiles if needed."""
+        key = self._key(url)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            # Not INSERT OR REPLACE, whose implicit delete does not fire the trigger keeping the total.
+            self._db.execute('DELETE FROM tiles WHERE key = ?', (key,))
+            self._db.execute('INSERT INTO tiles VALUES (?, ?, ?, ?, ?, NULL)',
+                             (key, url, len(data), hashlib.sha256(data).hexdigest(), time.time()))
+            if self.size > self.max_size:
+                self._evict()
+
+    def contains(self, url):
+        """Return whether the content of the URL is in the cache."""
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM tiles WHERE key = ? AND missing_until IS NULL',
+                                    (self._key(url),)).fetchone() is not None
+
+    def put_missing(self, url):
+        """Remember that the URL does not exist on the server."""
+        key = self._key(url)
+        with self._lock:
+            self._remove(key)
+            self._db.execute('INSERT INTO tiles VALUES (?, ?, 0, NULL, ?, ?)',
+                             (key, url, time.time(), time.time() + self.missing_ttl))
+
+    def _evict(self):
+        """Evict least recently used tiles until the cache fits in max_size. Must be called with the lock held."""
+        self._db.execute('DELETE FROM tiles WHERE missing_until < ?', (time.time(),))
+        while self.size > self.max_size:
+            rows = self._db.execute('SELECT key FROM tiles WHERE size > 0 ORDER BY last_used LIMIT 64').fetchall()
+            if not rows:
+                break
+            for key, in rows:
+                self._remove(key)
+                if self.size <= self.max_size:
+                    break
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class TileJournal():
+    """
+    Records which tiles of an image have been completely written to the tile directory,
+    with their size and CRC-32, so that an interrupted run can be resumed without downloading
+    the complete tiles again, and without joining tiles that were only partially written.
+
+    The journal is a small binary file: a header identifying the image and zoom level, followed
+    by one fixed-size record per tile of the x_tiles * y_tiles grid, which is updated in place.
+    """
+    header = struct.Struct('<4sIIIII')  # magic, zoom level, width, height, x_tiles, y_tiles
+    record = struct.Struct('<BII')  # status, size, CRC-32
+    magic = b'DZJ1'
+    PENDING, COMPLETE, MISSING = 0, 1, 2
+
+    def __init__(self, path, zoom_level, width, height, x_tiles, y_tiles):
+        self.path = path
+        self.y_tiles = y_tiles
+        header = self.header.pack(self.magic, zoom_level, width, height, x_tiles, y_tiles)
+        length = self.header.size + x_tiles * y_tiles * self.record.size
+
+        content = b''
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                content = f.read()
+        # A journal of another image or zoom level is started over.
+        self.resumed = len(content) == length and content.startswith(header)
+        if not self.resumed:
+            content = header + bytes(length - len(header))
+            with open(path, 'wb') as f:
+                f.write(content)
+        self._records = bytearray(content[self.header.size:])
+        self._file = open(path, 'r+b')
+        self._lock = threading.Lock()
+
+    def _offset(self, col, row):
+        return (col * self.y_tiles + row) * self.record.size
+
+    def entry(self, col, row):
+        """Return the (status, size, crc) record of a tile."""
+        return self.record.unpack_from(self._records, self._offset(col, row))
+
+    def mark(self, col, row, status, data=b''):
+        """Record the status of a tile, with the size and checksum of its data if it is complete."""
+        offset = self._offset(col, row)
+        entry = self.record.pack(status, len(data), zlib.crc32(data))
+        with self._lock:
+            self._records[offset:offset + self.record.size] = entry
+            self._file.seek(self.header.size + offset)
+            self._file.write(entry)
+            self._file.flush()
+
+    def verified_tiles(self, tile_path):
+        """
+        Return the set of (col, row) positions of the tiles recorded as complete whose files
+        still have the recorded size and checksum. tile_path(col, row) gives the path of a tile.
+        """
+        verified = set()
+        for index in range(len(self._records) // self.record.size):
+            col, row = divmod(index, self.y_tiles)
+            status, size, crc = self.entry(col, row)
+            if status != self.COMPLETE:
+                continue
+            try:
+                with open(tile_path(col, row), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            if len(data) == size and zlib.crc32(data) == crc:
+                verified.add((col, row))
+        return verified
+
+    def close(self):
+        self._file.close()
+
+
+class BatchState():
+    """
+    The state of the images of a list (-l), kept in an SQLite database so that a rerun of the
+    list only processes the images that are pending or failed.
+
+    Images are keyed by their URL, requested zoom level and output file. The outcome of each
+    is recorded with the error that made it fail, or with its zoom level, size, tile counts,
+    the bytes written and how long it took. Images with missing tiles, or with tiles filled
+    from the lower zoom level, are partial. Images whose run was interrupted are left running,
+    and are pending like the images that have no record.
+    """
+    RUNNING, COMPLETE, PARTIAL, FAILED = 'running', 'complete', 'partial', 'failed'
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS images ('
+                         'url TEXT NOT NULL, zoom_level INTEGER NOT NULL, destination TEXT NOT NULL, '
+                         'status TEXT NOT NULL, error TEXT, level INTEGER, width INTEGER, height INTEGER, '
+                         'tiles INTEGER, missing_tiles INTEGER, bytes INTEGER, started REAL, seconds REAL, '
+                         'filled_tiles INTEGER, PRIMARY KEY (url, zoom_level, destination))')
+        if 'filled_tiles' not in {row[1] for row in self._db.execute('PRAGMA table_info(images)')}:
+            self._db.execute('ALTER TABLE images ADD COLUMN filled_tiles INTEGER')
+        self._db.execute('CREATE INDEX IF NOT EXISTS images_status ON images (status)')
+
+    def status(self, url, zoom_level, destination):
+        """Return the status of an image, or None if it has no record."""
+        with self._lock:
+            row = self._db.execute('SELECT status FROM images WHERE url = ? AND zoom_level = ? AND destination = ?',
+                                   (url, zoom_level, destination)).fetchone()
+        return row[0] if row else None
+
+    def done(self, url, zoom_level, destination):
+        """Return whether the image has already been created, completely or with missing tiles."""
+        return self.status(url, zoom_level, destination) in (self.COMPLETE, self.PARTIAL)
+
+    def start(self, url, zoom_level, destination):
+        """Record that the image is being processed, replacing the record of an earlier run."""
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO images (url, zoom_level, destination, status, started) '
+                             'VALUES (?, ?, ?, ?, ?)', (url, zoom_level, destination, self.RUNNING, time.time()))
+
+    def finish(self, url, zoom_level, destination, status, error=None, level=None, width=None, height=None,
+               tiles=None, missing_tiles=None, filled_tiles=None, size=None):
+        """Record the outcome of an image started with start()."""
+        with self._lock:
+            self._db.execute('UPDATE images SET status = ?, error = ?, level = ?, width = ?, height = ?, '
+                             'tiles = ?, missing_tiles = ?, filled_tiles = ?, bytes = ?, seconds = ? - started '
+                             'WHERE url = ? AND zoom_level = ? AND destination = ?',
+                             (status, error, level, width, height, tiles, missing_tiles, filled_tiles, size,
+                              time.time(), url, zoom_level, destination))
+
+    def records(self, zoom_level):
+        """
+        Return the records of the images at the requested zoom level, as a dictionary of
+        (status, tiles, missing_tiles, filled_tiles, bytes, seconds, error) tuples by (url, destination).
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT url, destination, status, tiles, missing_tiles, filled_tiles, bytes, '
+                                    'seconds, error '
+                                    'FROM images WHERE zoom_level = ?', (zoom_level,)).fetchall()
+        return {(url, destination): record for url, destination, *record in rows}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class TurboJPEGError(Exception):
+    pass
+
+
+class JpegHeader():
+    """
+    The markers of a JPEG image up to the start of its first scan: the size, the components
+    as (id, horizontal sampling, vertical sampling, quantization table id) tuples,
+    the quantization tables in zigzag order and the raw APPn and COM segments, the frame
+    marker and the spectral selection (Ss, Se) of the first scan.
+    """
+
+    def __init__(self, data):
+        self.precision = self.width = self.height = None
+        self.frame = self.spectral = None
+        self.components = []
+        self.qtables = {}
+        self.markers = []
+        pos = 2
+        if data[:2] != b'\xff\xd8':
+            raise TurboJPEGError("Not a JPEG image.")
+        try:
+            while True:
+                while data[pos + 1] == 0xFF:  # fill bytes
+                    pos += 1
+                marker = data[pos + 1]
+                length, = struct.unpack_from('>H', data, pos + 2)
+                payload = data[pos + 4:pos + 2 + length]
+                if marker == 0xDB:
+                    i = 0
+                    while i < len(payload):
+                        precision, table = payload[i] >> 4, payload[i] & 0x0F
+                        if precision:
+                            self.qtables[table] = struct.unpack_from('>64H', payload, i + 1)
+                            i += 129
+                        else:
+                            self.qtables[table] = tuple(payload[i + 1:i + 65])
+                            i += 65
+                elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    if marker in (0xC3, 0xC7, 0xCB, 0xCF):
+                        raise TurboJPEGError("Lossless JPEG images are not supported.")
+                    self.frame = marker
+                    self.precision, self.height, self.width, ncomponents = struct.unpack_from('>BHHB', payload)
+                    for i in range(ncomponents):
+                        cid, sampling, table = payload[6 + 3 * i:9 + 3 * i]
+                        self.components.append((cid, sampling >> 4, sampling & 0x0F, table))
+                elif 0xE0 <= marker <= 0xEF or marker == 0xFE:
+                    self.markers.append(data[pos:pos + 2 + length])
+                elif marker == 0xDA:
+                    self.spectral = tuple(payload[1 + 2 * payload[0]:3 + 2 * payload[0]])
+                    break
+                pos += 2 + length
+        except (IndexError, struct.error, ValueError):
+            raise TurboJPEGError("Corrupt JPEG header.")
+        if not self.components:
+            raise TurboJPEGError("No frame header found in the JPEG image.")
+
+    def standard_blocks(self):
+        """
+        Return whether the image is coded in the 8x8 DCT blocks every decoder reads. The SmartScale
+        images of libjpeg 8 and later, which jpegtran -scale writes, have larger blocks (Se > 63).
+        """
+        if self.frame in (0xC0, 0xC1):
+            return self.spectral == (0, 63)
+        return self.frame == 0xC2 and self.spectral is not None and self.spectral[1] <= 63
+
+    def layout(self):
+        """Return the parameters that must be equal for the coefficients of two images to be interchangeable."""
+        return self.precision, tuple((h, v, self.qtables.get(table)) for _, h, v, table in self.components)
+
+    def blocks(self, width, height):
+        """Return the (width, height) in DCT blocks of each component of an image of the given size."""
+        hmax = max(h for _, h, _, _ in self.components)
+        vmax = max(v for _, _, v, _ in self.components)
+        return [(int(ceil(width * h / (8. * hmax))), int(ceil(height * v / (8. * vmax))))
+                for _, h, v, _ in self.components]
+
+
+def standard_jpeg(data):
+    """Return whether the data is a JPEG image coded in standard 8x8 DCT blocks."""
+    try:
+        return JpegHeader(data).standard_blocks()
+    except TurboJPEGError:
+        return False
+
+
+def standard_jpeg_file(path):
+    """Return whether the file is a JPEG image coded in standard 8x8 DCT blocks."""
+    with open(path, 'rb') as f:
+        return standard_jpeg(f.read(1 << 20))
+
+
+def blank_jpeg(header, width, height):
+    """
+    Create a gray baseline JPEG image of the given size with the components, quantization tables
+    and APPn and COM markers of a JpegHeader. All DCT coefficients of the image are zero, coded
+    with Huffman tables that only have a one-bit code for a zero DC difference and end of block.
+    """
+    def segment(marker, payload):
+        return struct.pack('>BBH', 0xFF, marker, len(payload) + 2) + payload
+
+    parts = [b'\xff\xd8'] + header.markers
+    extended = False
+    for table, values in sorted(header.qtables.items()):
+        if max(values) > 255:
+            parts.append(segment(0xDB, bytes([0x10 | table]) + struct.pack('>64H', *values)))
+            extended = True
+        else:
+            parts.append(segment(0xDB, bytes([table]) + bytes(values)))
+    components = header.components
+    parts.append(segment(0xC1 if extended else 0xC0,
+                         struct.pack('>BHHB', 8, height, width, len(components)) +
+                         b''.join(bytes([cid, h << 4 | v, table]) for cid, h, v, table in components)))
+    single_code = bytes([1] + [0] * 15) + b'\x00'
+    parts.append(segment(0xC4, b'\x00' + single_code + b'\x10' + single_code))
+    parts.append(segment(0xDA, bytes([len(components)]) +
+                         b''.join(bytes([cid, 0]) for cid, _, _, _ in components) + b'\x00\x3f\x00'))
+    # Every block is coded as two zero bits.
+    if len(components) == 1:
+        blocks = header.blocks(width, height)[0]
+        num_blocks = blocks[0] * blocks[1]
+    else:
+        hmax = max(h for _, h, _, _ in components)
+        vmax = max(v for _, _, v, _ in components)
+        num_mcus = int(ceil(width / (8. * hmax))) * int(ceil(height / (8. * vmax)))
+        num_blocks = num_mcus * sum(h * v for _, h, v, _ in components)
+    num_bytes, num_bits = divmod(2 * num_blocks, 8)
+    parts.append(bytes(num_bytes))
+    if num_bits:
+        parts.append(bytes([0xFF >> num_bits]))  # pad the last byte with one bits
+    parts.append(b'\xff\xd9')
+    return b''.join(parts)
+
+
+def extend_jpeg(turbojpeg, data, width, height):
+    """
+    Losslessly extend JPEG image data to the given size, with gray at the right and the bottom.
+    Unlike with the crop extension of jpegtran, the blocks of partial MCUs at the right
+    and bottom edges of the image are kept.
+    """
+    rows = {}
+
+    def read_row(address, component, block_row, width_in_blocks):
+        rows[component, block_row] = ctypes.string_at(address, width_in_blocks * 128)
+
+    def write_row(address, component, block_row, width_in_blocks):
+        row = rows.get((component, block_row))
+        if row is not None:
+            ctypes.memmove(address, row, min(len(row), width_in_blocks * 128))
+
+    turbojpeg.transform(data, read_row, output=False)
+    return turbojpeg.transform(blank_jpeg(JpegHeader(data), width, height), write_row, optimize=True)
+
+
+class TurboJPEG():
+    """
+    Minimal ctypes binding to the lossless transform function of the TurboJPEG library of libjpeg-turbo,
+    used to read and replace the DCT coefficients of JPEG images without any loss.
+    """
+    TJXOPT_NOOUTPUT = 1 << 4
+    TJXOPT_OPTIMIZE = 1 << 8
+    TJERR_WARNING = 0
+
+    class Region(ctypes.Structure):
+        _fields_ = [('x', ctypes.c_int), ('y', ctypes.c_int), ('w', ctypes.c_int), ('h', ctypes.c_int)]
+
+    class Transform(ctypes.Structure):
+        pass
+
+    CustomFilter = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.POINTER(ctypes.c_short), Region, Region,
+                                    ctypes.c_int, ctypes.c_int, ctypes.POINTER(Transform))
+    Transform._fields_ = [('r', Region), ('op', ctypes.c_int), ('options', ctypes.c_int),
+                          ('data', ctypes.c_void_p), ('customFilter', CustomFilter)]
+
+    def __init__(self, path=None):
+        if path is None:
+            path = ctypes.util.find_library('turbojpeg')
+            if path is None:
+                raise TurboJPEGError("The TurboJPEG library was not found.")
+        try:
+            lib = ctypes.CDLL(path)
+            lib.tjInitTransform.restype = ctypes.c_void_p
+            lib.tjInitTransform.argtypes = []
+            lib.tjTransform.restype = ctypes.c_int
+            lib.tjTransform.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_int,
+                                        ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_ulong),
+                                        ctypes.POINTER(self.Transform), ctypes.c_int]
+            lib.tjFree.argtypes = [ctypes.c_void_p]
+            lib.tjDestroy.argtypes = [ctypes.c_void_p]
+            lib.tjGetErrorStr2.restype = ctypes.c_char_p
+            lib.tjGetErrorStr2.argtypes = [ctypes.c_void_p]
+            lib.tjGetErrorCode.argtypes = [ctypes.c_void_p]
+        except (OSError, AttributeError) as e:
+            raise TurboJPEGError("Cannot load the TurboJPEG library {}: {}.".format(path, e))
+        self.lib = lib
+        self.path = path
+        # The optimize option of transforms is supported from libjpeg-turbo 3.0.
+        self.optimizes = hasattr(lib, 'tj3Init')
+
+    def transform(self, data, coefficients, output=True, optimize=False):
+        """
+        Losslessly transcode JPEG image data. coefficients(address, component, block_row, width_in_blocks)
+        is called for every row of DCT blocks of every component, with the address of the row's
+        8x8 blocks of 64 coefficients (C shorts in natural order), which it may read or replace.
+        Returns the transcoded image, or None if output is false. If output is a file object, the image
+        is written to it from the buffer of the library instead, without another copy in memory.
+        """
+        error = []
+
+        def custom_filter(coeffs, array_region, plane_region, component, transform_index, transform):
+            try:
+                block_row = array_region.y // 8
+                if block_row < plane_region.h // 8:  # skip the padding rows of the last iMCU row
+                    coefficients(ctypes.addressof(coeffs.contents), component, block_row, array_region.w // 8)
+                return 0
+            except BaseException as e:
+                error.append(e)
+                return -1
+
+        options = (self.TJXOPT_OPTIMIZE if optimize and self.optimizes else 0) | (0 if output else self.TJXOPT_NOOUTPUT)
+        transform = self.Transform(options=options, customFilter=self.CustomFilter(custom_filter))
+        dst_buf = ctypes.c_void_p()
+        dst_size = ctypes.c_ulong()
+        handle = self.lib.tjInitTransform()
+        if not handle:
+            raise TurboJPEGError("Cannot initialize a TurboJPEG transform.")
+        try:
+            result = self.lib.tjTransform(handle, data, len(data), 1, ctypes.byref(dst_buf), ctypes.byref(dst_size),
+                                          ctypes.byref(transform), 0)
+            if error:
+                raise error[0]
+            if result != 0 and self.lib.tjGetErrorCode(handle) != self.TJERR_WARNING:
+                raise TurboJPEGError(self.lib.tjGetErrorStr2(handle).decode(errors='replace'))
+            if hasattr(output, 'write'):
+                output.write((ctypes.c_char * dst_size.value).from_address(dst_buf.value))
+            elif output:
+                return ctypes.string_at(dst_buf, dst_size.value)
+        finally:
+            if dst_buf:
+                self.lib.tjFree(dst_buf)
+            self.lib.tjDestroy(handle)
+
+
+class BigTiffWriter():
+    """
+    Writes a tiled BigTIFF image in a single pass. The tiles are written as they are given,
+    in any order, and the image file directory with the tile offsets is written at the end.
+    """
+    SHORT, LONG, RATIONAL, LONG8 = 3, 4, 5, 16
+    # Struct format of a value of each type, rationals are given as numerator and denominator.
+    formats = {SHORT: 'H', LONG: 'I', RATIONAL: 'II', LONG8: 'Q'}
+
+    def __init__(self, path, width, height, tile_size):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.tiles_across = int(ceil(width / tile_size))
+        num_tiles = self.tiles_across * int(ceil(height / tile_size))
+        self.offsets = [0] * num_tiles
+        self.byte_counts = [0] * num_tiles
+        self.file = open(path, 'wb')
+        # Byte order, version, size of offsets and the offset of the image file directory.
+        self.file.write(struct.pack('<2sHHHQ', b'II', 43, 8, 0, 0))
+
+    def write_tile(self, positions, data):
+        """Write the data of the tiles at the (col, row) positions, which all share it."""
+        offset = self.file.tell()
+        self.file.write(data)
+        for col, row in positions:
+            index = row * self.tiles_across + col
+            self.offsets[index] = offset
+            self.byte_counts[index] = len(data)
+
+    def missing_tiles(self):
+        """Return the (col, row) positions of the tiles that have not been written."""
+        return [(index % self.tiles_across, index // self.tiles_across)
+                for index, byte_count in enumerate(self.byte_counts) if byte_count == 0]
+
+    def close(self, tags):
+        """Write the image file directory with the given (tag, type, values) tags and close the file."""
+        tags = tags + [
+            (256, self.LONG, [self.width]),  # ImageWidth
+            (257, self.LONG, [self.height]),  # ImageLength
+            (322, self.LONG, [self.tile_size]),  # TileWidth
+            (323, self.LONG, [self.tile_size]),  # TileLength
+            (324, self.LONG8, self.offsets),  # TileOffsets
+            (325, self.LONG8, self.byte_counts),  # TileByteCounts
+        ]
+        entries = []
+        for tag, value_type, values in sorted(tags):
+            count = len(values) // len(self.formats[value_type])
+            data = struct.pack('<' + self.formats[value_type] * count, *values)
+            if len(data) <= 8:
+                value = data.ljust(8, b'\x00')
+            else:
+                self.file.write(b'\x00' * (self.file.tell() % 2))  # offsets are word aligned
+                value = struct.pack('<Q', self.file.tell())
+                self.file.write(data)
+            entries.append(struct.pack('<HHQ', tag, value_type, count) + value)
+        self.file.write(b'\x00' * (self.file.tell() % 2))
+        directory = self.file.tell()
+        self.file.write(struct.pack('<Q', len(entries)) + b''.join(entries) + struct.pack('<Q', 0))
+        self.file.seek(8)
+        self.file.write(struct.pack('<Q', directory))
+        self.file.close()
+
+    def discard(self):
+        """Close and delete an unfinished image."""
+        self.file.close()
+        os.unlink(self.path)
+
+
+# Joining algorithms by name. The backends register themselves with @register_joiner.
+joiners = {}
+# Memory libjpeg needs for the DCT coefficients of an image, per pixel, with 4:2:0 chroma subsampling.
+coefficient_bytes_per_pixel = 3
+# Size of JPEG data per pixel, conservatively.
+jpeg_bytes_per_pixel = 1
+
+# The umask of the process, read once at import: reading it means setting it, which would
+# change the mode of the files other threads create meanwhile.
+process_umask = os.umask(0)
+os.umask(process_umask)
+
+
+def move_into_place(source, destination):
+    """Move a temporary file to destination, with the permissions of a newly created file."""
+    os.chmod(source, 0o666 & ~process_umask)
+    shutil.move(source, destination)
+
+
+def register_joiner(joiner):
+    """Class decorator registering a joining algorithm under its name."""
+    joiners[joiner.name] = joiner
+    return joiner
+
+
+class Joiner(abc.ABC):
+    """
+    Base class of the joining algorithms, which join the downloaded tiles of an image into the
+    output file. A joiner is created for each image. join() consumes untiler.downloaded_iterator
+    and writes the image to output_destination.
+    """
+    # Name of the algorithm, used to select it.
+    name = None
+    # Format of the images it writes. The jpeg joiners are the ones selectable with -a.
+    format = 'jpeg'
+    # Description for the help of -a.
+    description = ''
+    # Resource profile, reported in the help and the log.
+    memory = ''
+    cpu = ''
+    # Rough upper bound of the temporary files written, in bytes per pixel of the image.
+    working_storage_per_pixel = 0
+    # Ways of cutting the image into strips of tiles the joiner can assemble it from.
+    orientations = ('columns',)
+    # Only lossless joiners are chosen by the planner.
+    lossless = True
+
+    def __init__(self, untiler, output_destination, update_progressbars, finish_progressbars):
+        self.untiler = untiler
+        self.log = untiler.log
+        self.output_destination = output_destination
+        self.update_progressbars = update_progressbars
+        self.finish_progressbars = finish_progressbars
+        self.by_rows = untiler.plan.orientation == 'rows'
+
+    @classmethod
+    def profile(cls):
+        return "memory: {}; CPU: {}".format(cls.memory, cls.cpu)
+
+    @classmethod
+    def available(cls, untiler):
+        """Return whether the joiner can run on this machine."""
+        return True
+
+    @classmethod
+    @abc.abstractmethod
+    def cost(cls, untiler, orientation):
+        """
+        Estimate the work of joining the image as (serial, parallel) numbers of pixels
+        rewritten, where the parallel part is shared by the join workers.
+        """
+
+    @classmethod
+    def peak_memory(cls, untiler, orientation):
+        """Estimate the peak memory use in bytes. By default libjpeg holds the coefficients of the image."""
+        return untiler.width * untiler.height * coefficient_bytes_per_pixel
+
+    @abc.abstractmethod
+    def join(self):
+        """Join the tiles of the image and write it to output_destination."""
+
+    def fall_back(self, name):
+        """Join the image with another algorithm instead."""
+        self.log.info("Joining the tiles with {} ({}).".format(name, joiners[name].profile()))
+        joiners[name](self.untiler, self.output_destination,
+                      self.update_progressbars, self.finish_progressbars).join()
+
+    def tile_joined(self):
+        with self.untiler.progress_lock:
+            self.untiler.num_joined += 1
+            self.update_progressbars()
+
+    def finish_joining(self):
+        untiler = self.untiler
+        num_missing = untiler.num_tiles - untiler.num_joined
+        if num_missing > 0:
+            self.log.warning(
+                "Image '{3}' is missing {0} tile{1}. "
+                "You might want to download the image at a different zoom level "
+                "(currently {2}) to get the missing part{1}."
+                .format(num_missing, '' if num_missing == 1 else 's', untiler.zoom_level,
+                        self.output_destination)
+            )
+        self.finish_progressbars()
+
+    def write_image(self, path):
+        """
+        Write the joined image at path to destination, with its Huffman tables optimized
+        as selected with --optimize. The file at path is used up.
+        """
+        untiler = self.untiler
+        if untiler.optimize == 'skip':
+            move_into_place(path, self.output_destination)
+            self.log.info("Wrote {} without optimizing it: {:.1f} MB.".format(
+                self.output_destination, os.path.getsize(self.output_destination) / 1e6))
+        elif untiler.optimize == 'background':
+            # Move the image out of the tile directory, which is removed once the image is done.
+            fhandle, unoptimized = tempfile.mkstemp(suffix='.jpg', prefix='.unoptimized_',
+                                                    dir=os.path.dirname(os.path.abspath(self.output_destination)))
+            os.close(fhandle)
+            shutil.move(path, unoptimized)
+            untiler.optimize_later(unoptimized, self.output_destination)
+        else:
+            untiler.optimize_image(path, self.output_destination)
+
+    def log_merged_optimization(self, elapsed):
+        self.log.info("Optimized {} in the last joining step, which took {:.1f} s: {:.1f} MB.".format(
+            self.output_destination, elapsed, os.path.getsize(self.output_destination) / 1e6))
+
+    def column_width(self, col):
+        return min(self.untiler.tile_size, self.untiler.width - col * self.untiler.tile_size)
+
+    def tile_height(self, row):
+        return min(self.untiler.tile_size, self.untiler.height - row * self.untiler.tile_size)
+
+    def tile_position(self, strip, index):
+        """Return the (col, row) position of a tile from its strip and index in the strip."""
+        return (index, strip) if self.by_rows else (strip, index)
+
+    def strip_size(self, strip):
+        """Return the width and height of a strip."""
+        if self.by_rows:
+            return self.untiler.width, self.tile_height(strip)
+        return self.column_width(strip), self.untiler.height
+
+    def strip_offset(self, strip):
+        """Return the offset of a strip in the image."""
+        if self.by_rows:
+            return 0, strip * self.untiler.tile_size
+        return strip * self.untiler.tile_size, 0
+
+    def tile_offset(self, index):
+        """Return the offset of a tile in its strip."""
+        if self.by_rows:
+            return index * self.untiler.tile_size, 0
+        return 0, index * self.untiler.tile_size
+
+    def assemble_strips(self, build_strip, add_strip, keep_tiles=False):
+        """
+        Collect the downloaded tiles by strip, a column or a row of tiles depending on
+        untiler.orientation. As soon as all tiles of a strip have arrived,
+        build_strip(strip, tiles) is called to build the strip image, in one of up to
+        untiler.join_workers parallel jobs. tiles lists the tile_source of each tile in the strip,
+        or None for missing tiles. Meanwhile, add_strip(strip, image) is called in a single
+        separate job for each built strip, in strip order, to assemble the final image.
+        Tiles kept in memory are released once their strip has been added, unless keep_tiles is set.
+        """
+        untiler = self.untiler
+        strip_length = untiler.x_tiles if self.by_rows else untiler.y_tiles
+        builders = ThreadPoolExecutor(max_workers=untiler.join_workers)
+        assembler = ThreadPoolExecutor(max_workers=1)
+        # Limit the number of built strips waiting on disk to be added to the final image.
+        pending = threading.BoundedSemaphore(2 * untiler.join_workers)
+
+        def build_with_slot(strip, tiles):
+            with untiler.join_slots:
+                return build_strip(strip, tiles)
+
+        def add_when_built(strip, image):
+            try:
+                add_strip(strip, image.result())
+                if untiler.tile_data is not None and not keep_tiles:
+                    for index in range(strip_length):
+                        untiler.tile_data.pop(self.tile_position(strip, index), None)
+            finally:
+                pending.release()
+
+        additions = []
+        try:
+            tiles = []
+            for i, (col, row) in enumerate(untiler.downloaded_iterator):
+                strip, index = divmod(i, strip_length)
+                if col is None:
+                    self.log.debug("Missing tile (row {1:3}, col {0:3})!".format(*self.tile_position(strip, index)))
+                    tiles.append(None)
+                else:
+                    tiles.append(untiler.tile_source(col, row))
+                if index == strip_length - 1:
+                    pending.acquire()
+                    image = builders.submit(build_with_slot, strip, tiles)
+                    additions.append(assembler.submit(add_when_built, strip, image))
+                    tiles = []
+                # Fail early if building or adding a strip has failed.
+                while additions and additions[0].done():
+                    additions.pop(0).result()
+            for addition in additions:
+                addition.result()
+        finally:
+            builders.shutdown(cancel_futures=True)
+            assembler.shutdown(cancel_futures=True)
+
+
+@register_joiner
+class JpegtranLargeJoiner(Joiner):
+    """
+    Faster untilig algorithm, assembling strips (columns or rows of tiles)
+    separately, then assembling those into final image. Cuts down on the cost
+    of constantly opening two huge final images.
+    Strips are assembled in parallel, the final image alongside them.
+    """
+    name = 'jt_xl'
+    description = ('jt_xl (jpegtran large image - lossless): assembles columns tile by tile, '
+                   'then drops them into the final image one by one.')
+    memory = 'low, a few jpegtran processes'
+    cpu = 'high, the image is rewritten for every strip and each strip for every tile'
+    working_storage_per_pixel = 3
+    orientations = ('columns', 'rows')
+
+    @classmethod
+    def cost(cls, untiler, orientation):
+        strips, length = untiler.x_tiles, untiler.y_tiles
+        if orientation == 'rows':
+            strips, length = length, strips
+        pixels = untiler.width * untiler.height
+        # Every strip is rewritten for each of its tiles, the image for every strip and once more to optimize it.
+        return (strips + 1) * pixels, length * pixels
+
+    def join(self):
+        untiler = self.untiler
+        # Use 2 temporary files per strip being assembled and 2 for the final image.
+        tmpimgs = set()
+        tmpimgs_lock = threading.Lock()
+
+        def new_tmpimg(prefix):
+            fhandle = tempfile.NamedTemporaryFile(suffix='.jpg', prefix=prefix, dir=untiler.tile_dir, delete=False)
+            fhandle.close()
+            with tmpimgs_lock:
+                tmpimgs.add(fhandle.name)
+            self.log.debug("Created temporary image file: " + fhandle.name)
+            return fhandle.name
+
+        def delete_tmpimg(path):
+            with tmpimgs_lock:
+                tmpimgs.remove(path)
+            os.unlink(path)
+
+        def build_strip(strip, tiles):
+            present = [(index, path) for index, path in enumerate(tiles) if path is not None]
+            if not present:
+                return None
+            image = [new_tmpimg('tmp_'), new_tmpimg('tmp_')]
+            # The index of the strip temp image to be used for output, toggles between 0 and 1.
+            active_tmp = 0
+            first_index, first_path = present[0]
+            if first_index == 0:
+                # As the very first step create an (almost) empty temp strip image,
+                # with the target strip dimensions.
+                untiler.run_jpegtran('-copy', 'all',
+                                     '-crop', '{:d}x{:d}+0+0'.format(*self.strip_size(strip)),
+                                     '-outfile', image[active_tmp],
+                                     first_path)
+                self.tile_joined()
+                present = present[1:]
+            else:
+                # The first tile is missing, start from an empty strip.
+                col, row = self.tile_position(strip, first_index)
+                untiler.blank_image(*self.strip_size(strip), first_path, self.tile_height(row), image[active_tmp])
+            # Keep adding tiles.
+            for index, path in present:
+                active_tmp = (active_tmp + 1) % 2  # toggle between the two temp images
+                untiler.run_jpegtran('-perfect',
+                                     '-copy', 'all',
+                                     '-drop', '+{:d}+{:d}'.format(*self.tile_offset(index)), path,
+                                     '-outfile', image[active_tmp],
+                                     image[(active_tmp + 1) % 2])
+                self.tile_joined()
+            delete_tmpimg(image[(active_tmp + 1) % 2])
+            return image[active_tmp]
+
+        finalimage = [new_tmpimg('final_'), new_tmpimg('final_')]
+        # The index of the final temp image holding the result so far, None until there is one.
+        active_final = [None]
+        last_strip = (untiler.y_tiles if self.by_rows else untiler.x_tiles) - 1
+
+        def add_strip(strip, image):
+            if image is None:
+                return
+            if active_final[0] is None:
+                if strip == 0:
+                    # After untiling of a first strip,
+                    # create a full sized temp image with the just untiled strip
+                    untiler.run_jpegtran('-perfect',
+                                         '-copy', 'all',
+                                         '-crop', '{:d}x{:d}+0+0'.format(untiler.width, untiler.height),
+                                         '-outfile', finalimage[0],
+                                         image)
+                    active_final[0] = 0
+                    delete_tmpimg(image)
+                    return
+                # The first strip is missing, start from an empty image.
+                untiler.blank_image(untiler.width, untiler.height, image, self.strip_size(strip)[1], finalimage[1])
+                active_final[0] = 1
+            # Drop just untiled strip into the full sized temp image.
+            active = (active_final[0] + 1) % 2
+            options = ()
+            if strip == last_strip and untiler.optimize == 'merge':
+                # The image is complete after this step, write it to destination optimized right away.
+                finalimage[active], options = self.output_destination, ('-optimize',)
+                start = time.perf_counter()
+            untiler.run_jpegtran('-perfect',
+                                 '-copy', 'all',
+                                 *options,
+                                 '-drop', '+{:d}+{:d}'.format(*self.strip_offset(strip)), image,
+                                 '-outfile', finalimage[active],
+                                 finalimage[active_final[0]])
+            if options:
+                self.log_merged_optimization(time.perf_counter() - start)
+            active_final[0] = active
+            delete_tmpimg(image)
+
+        # Join tiles into a single image in parallel to them being downloaded.
+        try:
+            self.assemble_strips(build_strip, add_strip)
+            if active_final[0] is None:
+                raise FileNotFoundError("None of the tiles could be downloaded.")
+
+            if finalimage[active_final[0]] != self.output_destination:
+                # Optimize the final image and write it to destination
+                with tmpimgs_lock:
+                    tmpimgs.remove(finalimage[active_final[0]])
+                self.write_image(finalimage[active_final[0]])
+
+            self.finish_joining()
+
+        except KeyboardInterrupt:
+            # Kill the jpegtran subprocesses.
+            untiler.kill_jpegtran()
+            raise
+        finally:
+            # Delete the temporary images.
+            for path in tmpimgs:
+                os.unlink(path)
+
+
+@register_joiner
+class JpegtranTreeJoiner(Joiner):
+    """
+    Merge tree untiling algorithm. Tiles are merged pairwise into blocks,
+    and blocks of equal size into bigger blocks, first within each strip
+    (column or row of tiles) and then across the strips, as the tiles arrive.
+    Every tile is rewritten O(log n) times instead of O(n) times as in jt_xl.
+    Strips are merged in parallel, and merged across alongside them.
+    """
+    name = 'jt_tree'
+    description = ('jt_tree (jpegtran merge tree - lossless): merges tiles pairwise into ever bigger blocks, '
+                   'so each tile is rewritten O(log n) instead of O(n) times. Faster for large images.')
+    memory = 'low, a few jpegtran processes'
+    cpu = 'medium, every tile is rewritten once per doubling of the blocks'
+    working_storage_per_pixel = 3
+    orientations = ('columns', 'rows')
+
+    @classmethod
+    def cost(cls, untiler, orientation):
+        strips, length = untiler.x_tiles, untiler.y_tiles
+        if orientation == 'rows':
+            strips, length = length, strips
+        pixels = untiler.width * untiler.height
+        # Every merge crops the first block to the merged size and drops the second one into it.
+        return (2 * (strips - 1).bit_length() + 1) * pixels, 2 * (length - 1).bit_length() * pixels
+
+    def join(self):
+        untiler = self.untiler
+        # A block is a (path, width, height) tuple. Blocks of missing tiles only
+        # have no path and are not written to disk until they are merged with an image.
+        tmpimgs = set()
+        tmpimgs_lock = threading.Lock()
+
+        def new_tmpimg():
+            fhandle, path = tempfile.mkstemp(suffix='.jpg', prefix='tree_', dir=untiler.tile_dir)
+            os.close(fhandle)
+            with tmpimgs_lock:
+                tmpimgs.add(path)
+            return path
+
+        def discard(block):
+            with tmpimgs_lock:
+                if block[0] not in tmpimgs:
+                    return
+                tmpimgs.remove(block[0])
+            os.unlink(block[0])
+
+        def merge(first, second, vertical):
+            """Merge two blocks, placing the second one below or to the right of the first one."""
+            if vertical:
+                width, height, x, y = first[1], first[2] + second[2], 0, first[2]
+            else:
+                width, height, x, y = first[1] + second[1], first[2], first[1], 0
+            if first[0] is None and second[0] is None:
+                return (None, width, height)
+            canvas = new_tmpimg()
+            if first[0] is not None:
+                untiler.run_jpegtran('-copy', 'all',
+                                     '-crop', '{:d}x{:d}+0+0'.format(width, height),
+                                     '-outfile', canvas, first[0])
+                discard(first)
+            else:
+                untiler.blank_image(width, height, second[0], second[2], canvas)
+            if second[0] is None:
+                return (canvas, width, height)
+            if (width, height) == (untiler.width, untiler.height) and untiler.optimize == 'merge':
+                # This is the last merge, write the image to destination optimized right away.
+                merged, options = self.output_destination, ('-optimize',)
+                start = time.perf_counter()
+            else:
+                merged, options = new_tmpimg(), ()
+            untiler.run_jpegtran('-perfect',
+                                 '-copy', 'all',
+                                 *options,
+                                 '-drop', '+{:d}+{:d}'.format(x, y), second[0],
+                                 '-outfile', merged, canvas)
+            if options:
+                self.log_merged_optimization(time.perf_counter() - start)
+            discard((canvas,))
+            discard(second)
+            return (merged, width, height)
+
+        def push(stack, block, vertical):
+            """
+            Push a block of one unit (tile or strip) on a stack of (block, units) pairs,
+            merging the topmost blocks while they consist of an equal number of units.
+            """
+            stack.append((block, 1))
+            while len(stack) >= 2 and stack[-1][1] == stack[-2][1]:
+                (second, units), (first, _) = stack.pop(), stack.pop()
+                stack.append((merge(first, second, vertical), 2 * units))
+
+        def collapse(stack, vertical):
+            """Merge all blocks on a stack into a single block."""
+            block = stack.pop()[0]
+            while stack:
+                block = merge(stack.pop()[0], block, vertical)
+            return block
+
+        def build_strip(strip, tiles):
+            blocks = []
+            for index, path in enumerate(tiles):
+                col, row = self.tile_position(strip, index)
+                push(blocks, (path, self.column_width(col), self.tile_height(row)), vertical=not self.by_rows)
+                if path is not None:
+                    self.tile_joined()
+            return collapse(blocks, vertical=not self.by_rows)
+
+        strips = []
+
+        def add_strip(strip, block):
+            push(strips, block, vertical=self.by_rows)
+
+        try:
+            self.assemble_strips(build_strip, add_strip)
+            final = collapse(strips, vertical=self.by_rows)
+            if final[0] is None:
+                raise FileNotFoundError("None of the tiles could be downloaded.")
+            if final[0] != self.output_destination and final[0] not in tmpimgs:
+                # The image is a single tile, which is copied rather than used up.
+                path = new_tmpimg()
+                with open(path, 'wb') as f:
+                    f.write(untiler.read_tile_source(final[0]))
+                final = (path,) + final[1:]
+
+            if final[0] != self.output_destination:
+                # Optimize the final image and write it to destination
+                with tmpimgs_lock:
+                    tmpimgs.remove(final[0])
+                self.write_image(final[0])
+
+            self.finish_joining()
+
+        except KeyboardInterrupt:
+            # Kill the jpegtran subprocesses.
+            untiler.kill_jpegtran()
+            raise
+        finally:
+            # Delete the temporary images.
+            for path in tmpimgs:
+                os.unlink(path)
+
+
+@register_joiner
+class TurboJPEGJoiner(Joiner):
+    """
+    In-process untiling algorithm. The DCT coefficients of the tiles are copied into
+    a coefficient canvas of the final image with the TurboJPEG library, in parallel,
+    and the final image is encoded once from the canvas. The canvas is a memory-mapped
+    file in the tile directory, so it can be larger than the available memory.
+    Falls back to jt_xl if the library cannot be loaded or the tiles differ in their
+    sampling or quantization, as their coefficients cannot be mixed then.
+    """
+    name = 'tj_mem'
+    description = ('tj_mem (TurboJPEG in memory - lossless): copies the DCT coefficients of the tiles into '
+                   'a memory-mapped canvas with the libjpeg-turbo library and writes the final image once, '
+                   'without running jpegtran. Falls back to jt_xl if the library cannot be loaded '
+                   'or the tiles cannot be joined this way.')
+    memory = 'medium, the coefficient canvas is memory-mapped, libjpeg holds a copy and the output while writing'
+    cpu = 'low, every tile is transcoded once and the image is written once'
+    working_storage_per_pixel = 8
+
+    @classmethod
+    def available(cls, untiler):
+        try:
+            untiler.load_turbojpeg()
+        except TurboJPEGError:
+            return False
+        return True
+
+    @classmethod
+    def cost(cls, untiler, orientation):
+        pixels = untiler.width * untiler.height
+        return pixels, pixels
+
+    @classmethod
+    def peak_memory(cls, untiler, orientation):
+        # The library holds the coefficients and the encoded image while writing it,
+        # and with --in-memory all the tiles are kept until then.
+        pixels = untiler.width * untiler.height
+        memory = pixels * (coefficient_bytes_per_pixel + jpeg_bytes_per_pixel)
+        if untiler.in_memory and not untiler.store:
+            memory += pixels * jpeg_bytes_per_pixel
+        return memory
+
+    def join(self):
+        untiler = self.untiler
+        try:
+            turbojpeg = untiler.load_turbojpeg()
+        except TurboJPEGError as e:
+            self.log.warning("{} Joining the tiles with jpegtran instead.".format(e))
+            return self.fall_back('jt_xl')
+
+        # Remember the tiles seen, to join them again with jpegtran if this fails.
+        seen = []
+        remaining = untiler.downloaded_iterator
+        untiler.downloaded_iterator = (seen.append(tile) or tile for tile in remaining)
+
+        tile_size = untiler.tile_size
+        canvas = {}
+        canvas_lock = threading.Lock()
+
+        def open_canvas(header, description):
+            """Create the canvas for tiles like the first one, or check that a tile is like it."""
+            with canvas_lock:
+                if not canvas:
+                    hmax = max(h for _, h, _, _ in header.components)
+                    vmax = max(v for _, _, v, _ in header.components)
+                    if header.precision != 8 or tile_size % (8 * hmax) or tile_size % (8 * vmax):
+                        raise TurboJPEGError("The tiles are not 8-bit JPEG images aligned to the DCT block grid.")
+                    blocks = header.blocks(untiler.width, untiler.height)
+                    offsets = [0]
+                    for width, height in blocks:
+                        offsets.append(offsets[-1] + width * height * 128)
+                    fhandle, canvas['path'] = tempfile.mkstemp(suffix='.coef', prefix='canvas_', dir=untiler.tile_dir)
+                    with os.fdopen(fhandle, 'r+b') as f:
+                        f.truncate(offsets[-1])
+                        canvas['mmap'] = mmap.mmap(f.fileno(), offsets[-1])
+                    canvas['buffer'] = ctypes.c_char.from_buffer(canvas['mmap'])
+                    canvas.update(header=header, layout=header.layout(), blocks=blocks, offsets=offsets,
+                                  sampling=[(h * tile_size // (8 * hmax), v * tile_size // (8 * vmax))
+                                            for _, h, v, _ in header.components])
+                    self.log.debug("Created a coefficient canvas of {} bytes: {}".format(offsets[-1], canvas['path']))
+                elif header.layout() != canvas['layout']:
+                    raise TurboJPEGError("Tile {} differs in its sampling or quantization tables.".format(description))
+            return canvas
+
+        def build_column(col, tiles):
+            for row, source in enumerate(tiles):
+                if source is None:
+                    continue  # the canvas is gray where tiles are missing
+                data = untiler.read_tile_source(source)
+                header = JpegHeader(data)
+                description = '(row {}, col {})'.format(row, col)
+                if (header.width, header.height) != (self.column_width(col), self.tile_height(row)):
+                    raise TurboJPEGError("Tile {} does not have the expected size.".format(description))
+                canvas = open_canvas(header, description)
+                base = ctypes.addressof(canvas['buffer'])
+
+                def copy_row(address, component, block_row, width_in_blocks):
+                    canvas_width, canvas_height = canvas['blocks'][component]
+                    x, y = canvas['sampling'][component]
+                    y = row * y + block_row
+                    if y < canvas_height:
+                        x *= col
+                        ctypes.memmove(base + canvas['offsets'][component] + (y * canvas_width + x) * 128,
+                                       address, min(width_in_blocks, canvas_width - x) * 128)
+
+                turbojpeg.transform(data, copy_row, output=False)
+                self.tile_joined()
+
+        def add_column(col, column):
+            pass
+
+        try:
+            # Keep the tiles in memory, to join them with jpegtran if this fails.
+            self.assemble_strips(build_column, add_column, keep_tiles=True)
+            if not canvas:
+                raise FileNotFoundError("None of the tiles could be downloaded.")
+
+            base = ctypes.addressof(canvas['buffer'])
+
+            def paste_row(address, component, block_row, width_in_blocks):
+                canvas_width = canvas['blocks'][component][0]
+                ctypes.memmove(address, base + canvas['offsets'][component] + block_row * canvas_width * 128,
+                               canvas_width * 128)
+
+            # The library can optimize the image while writing it, which merges the optimization.
+            optimize = turbojpeg.optimizes and untiler.optimize in ('final', 'merge')
+            blank = blank_jpeg(canvas['header'], untiler.width, untiler.height)
+            start = time.perf_counter()
+            if optimize or untiler.optimize == 'skip':
+                with open(self.output_destination, 'wb') as f:
+                    turbojpeg.transform(blank, paste_row, output=f, optimize=optimize)
+                if optimize:
+                    self.log_merged_optimization(time.perf_counter() - start)
+                else:
+                    self.log.info("Wrote {} without optimizing it: {:.1f} MB.".format(
+                        self.output_destination, os.path.getsize(self.output_destination) / 1e6))
+            else:
+                # Optimize the final image with jpegtran and write it to destination
+                fhandle, path = tempfile.mkstemp(suffix='.jpg', prefix='final_', dir=untiler.tile_dir)
+                try:
+                    with os.fdopen(fhandle, 'wb') as f:
+                        turbojpeg.transform(blank, paste_row, output=f)
+                except BaseException:
+                    os.unlink(path)
+                    raise
+                self.write_image(path)
+
+            self.finish_joining()
+
+        except TurboJPEGError as e:
+            self.log.warning("Cannot join the tiles in memory: {} Joining them with jpegtran instead.".format(e))
+            untiler.downloaded_iterator = itertools.chain(seen, remaining)
+            untiler.num_joined = 0
+            self.fall_back('jt_xl')
+        finally:
+            if canvas:
+                del canvas['buffer']
+                canvas['mmap'].close()
+                os.unlink(canvas['path'])
+
+
+@register_joiner
+class PillowJoiner(Joiner):
+    """
+    Decodes the tiles with Pillow into a pixel canvas, in parallel, and encodes the canvas
+    into the final image with the quantization tables and chroma subsampling of the tiles.
+    The canvas is a memory-mapped file in the tile directory, which Pillow encodes strip by
+    strip, so neither the canvas nor the encoded image has to fit into memory.
+    Unlike the other algorithms, this re-encodes the image and loses some quality.
+    """
+    name = 'pil'
+    description = ('pil (Pillow - lossy): decodes the tiles into a memory-mapped pixel canvas and '
+                   're-encodes it strip by strip with the quality settings of the tiles. '
+                   'Needs the Pillow module, falls back to jt_xl without it.')
+    memory = 'low, the pixel canvas is memory-mapped'
+    cpu = 'high, every pixel is decoded and encoded again'
+    working_storage_per_pixel = 4
+    lossless = False
+    # Value of the canvas where tiles are missing: mid gray, like the blank areas of the other algorithms.
+    blank = b'\x80'
+
+    @classmethod
+    def available(cls, untiler):
+        return Image is not None
+
+    @classmethod
+    def cost(cls, untiler, orientation):
+        pixels = untiler.width * untiler.height
+        # Encoding is slower than decoding.
+        return 2 * pixels, pixels
+
+    @classmethod
+    def peak_memory(cls, untiler, orientation):
+        # A decoded tile per join worker, and the strip being encoded.
+        return 4 * untiler.tile_size ** 2 * untiler.join_workers + 4 * 16 * untiler.width
+
+    def join(self):
+        untiler = self.untiler
+        if Image is None:
+            self.log.warning("The Pillow module is not installed. Joining the tiles with jpegtran instead.")
+            return self.fall_back('jt_xl')
+
+        tile_size = untiler.tile_size
+        row_bytes = 4 * untiler.width
+        size = row_bytes * untiler.height
+        fhandle, canvas_path = tempfile.mkstemp(suffix='.rgbx', prefix='canvas_', dir=untiler.tile_dir)
+        with os.fdopen(fhandle, 'r+b') as f:
+            f.truncate(size)
+            canvas = mmap.mmap(f.fileno(), size)
+        self.log.debug("Created a pixel canvas of {} bytes: {}".format(size, canvas_path))
+        # Encoder settings of the first tile decoded.
+        settings = {}
+        settings_lock = threading.Lock()
+
+        def paste(pixels, x, y, width, height):
+            line = 4 * width
+            for i in range(height):
+                start = (y + i) * row_bytes + 4 * x
+                canvas[start:start + line] = pixels[i * line:(i + 1) * line]
+
+        def build_column(col, tiles):
+            x, width = col * tile_size, self.column_width(col)
+            for row, source in enumerate(tiles):
+                y, height = row * tile_size, self.tile_height(row)
+                if source is None:
+                    paste(self.blank * (4 * width * height), x, y, width, height)
+                    continue
+                tile = Image.open(io.BytesIO(untiler.read_tile_source(source)))
+                with settings_lock:
+                    if not settings and tile.format == 'JPEG':
+                        settings['qtables'] = tile.quantization
+                        subsampling = JpegImagePlugin.get_sampling(tile)
+                        if subsampling != -1:
+                            settings['subsampling'] = subsampling
+                # Tiles of the wrong size are cropped or padded with black.
+                paste(tile.convert('RGBX').crop((0, 0, width, height)).tobytes(), x, y, width, height)
+                self.tile_joined()
+
+        def add_column(col, column):
+            pass
+
+        try:
+            self.assemble_strips(build_column, add_column)
+            if untiler.num_joined == 0:
+                raise FileNotFoundError("None of the tiles could be downloaded.")
+
+            image = Image.frombuffer('RGBX', (untiler.width, untiler.height), canvas, 'raw', 'RGBX', 0, 1)
+            try:
+                # Without optimize, Pillow writes the image in small strips instead of buffering it.
+                image.save(self.output_destination, 'JPEG', **settings)
+            finally:
+                # Release the canvas buffer.
+                del image
+
+            self.finish_joining()
+        finally:
+            canvas.close()
+            os.unlink(canvas_path)
+
+
+@register_joiner
+class BigTiffJoiner(Joiner):
+    """
+    Writes the tiles into a tiled BigTIFF image with JPEG compression, in a single pass
+    without decoding or re-encoding them. Edge tiles are losslessly extended to the full
+    tile size, as TIFF tiles all have the same size, and the missing tiles all point to
+    a single gray tile.
+    """
+    name = 'tiff'
+    format = 'tiff'
+    memory = 'low, one tile at a time'
+    cpu = 'minimal, the tiles are copied as they are'
+    working_storage_per_pixel = 0
+
+    @classmethod
+    def cost(cls, untiler, orientation):
+        # Only edge tiles are rewritten.
+        return untiler.tile_size * (untiler.width + untiler.height), 0
+
+    @classmethod
+    def peak_memory(cls, untiler, orientation):
+        return 4 * untiler.tile_size ** 2
+
+    def join(self):
+        untiler = self.untiler
+        tile_size = untiler.tile_size
+        if tile_size % 16:
+            raise ValueError("TIFF tiles must be a multiple of 16 pixels, but the tile size is {}."
+                             .format(tile_size))
+        writer = BigTiffWriter(self.output_destination, untiler.width, untiler.height, tile_size)
+        first_header = None
+        turbojpeg = []
+
+        def extend_tile(source, data):
+            if not turbojpeg:
+                try:
+                    turbojpeg.append(untiler.load_turbojpeg())
+                except TurboJPEGError as e:
+                    self.log.warning("{} Extending the edge tiles with jpegtran instead, "
+                                     "which loses their partial MCUs.".format(e))
+                    turbojpeg.append(None)
+            if turbojpeg[0] is not None:
+                return extend_jpeg(turbojpeg[0], data, tile_size, tile_size)
+            fhandle, extended = tempfile.mkstemp(suffix='.jpg', prefix='edge_', dir=untiler.tile_dir)
+            os.close(fhandle)
+            try:
+                untiler.run_jpegtran('-copy', 'none',
+                                     '-crop', '{0:d}x{0:d}+0+0'.format(tile_size),
+                                     '-outfile', extended, source)
+                with open(extended, 'rb') as f:
+                    return f.read()
+            finally:
+                os.unlink(extended)
+
+        try:
+            for i, (col, row) in enumerate(untiler.downloaded_iterator):
+                if col is None:
+                    tile_col, tile_row = divmod(i, untiler.y_tiles)
+                    self.log.debug("Missing tile (row {:3}, col {:3})!".format(tile_row, tile_col))
+                    continue
+                source = untiler.tile_source(col, row)
+                data = untiler.read_tile_source(source)
+                header = JpegHeader(data)
+                if first_header is None:
+                    first_header = header
+                elif [c[1:3] for c in header.components] != [c[1:3] for c in first_header.components]:
+                    raise ValueError("Tile (row {}, col {}) does not have the same color components and "
+                                     "subsampling as the other tiles, which a TIFF image cannot store. "
+                                     "Create a JPEG image instead.".format(row, col))
+                if (header.width, header.height) != (tile_size, tile_size):
+                    data = extend_tile(source, data)
+                writer.write_tile([(col, row)], data)
+                if untiler.tile_data is not None:
+                    del untiler.tile_data[col, row]
+                self.tile_joined()
+
+            if first_header is None:
+                raise FileNotFoundError("None of the tiles could be downloaded.")
+            missing = writer.missing_tiles()
+            if missing:
+                writer.write_tile(missing, blank_jpeg(first_header, tile_size, tile_size))
+
+            components = first_header.components
+            tags = [
+                (258, BigTiffWriter.SHORT, [8] * len(components)),  # BitsPerSample
+                (259, BigTiffWriter.SHORT, [7]),  # Compression: JPEG
+                (277, BigTiffWriter.SHORT, [len(components)]),  # SamplesPerPixel
+                (284, BigTiffWriter.SHORT, [1]),  # PlanarConfiguration: chunky
+            ]
+            if len(components) == 3:
+                tags += [
+                    (262, BigTiffWriter.SHORT, [6]),  # PhotometricInterpretation: YCbCr
+                    # YCbCrSubSampling
+                    (530, BigTiffWriter.SHORT, [components[0][1] // components[1][1],
+                                                components[0][2] // components[1][2]]),
+                    # ReferenceBlackWhite
+                    (532, BigTiffWriter.RATIONAL, [0, 1, 255, 1, 128, 1, 255, 1, 128, 1, 255, 1]),
+                ]
+            elif len(components) == 1:
+                tags.append((262, BigTiffWriter.SHORT, [1]))  # PhotometricInterpretation: BlackIsZero
+            else:
+                raise ValueError("JPEG tiles with {} color components cannot be stored in a TIFF image."
+                                 .format(len(components)))
+            writer.close(tags)
+        except BaseException:
+            writer.discard()
+            raise
+
+        self.finish_joining()
+
+
+# The -a choices are the registered JPEG joining algorithms.
+algorithm_option.choices = ['auto'] + [name for name, joiner in joiners.items() if joiner.format == 'jpeg']
+algorithm_option.help = ('which image untiler algorithm to use. Options: '
+                         'auto: the lossless algorithm estimated to be fastest for the image and the machine, '
+                         'see --plan. ' +
+                         ' '.join(joiner.description for joiner in joiners.values() if joiner.format == 'jpeg') +
+                         ' Default: auto')
+
+
+def available_memory():
+    """Return the memory available for new processes in bytes, or None if it is unknown."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class JoinPlan():
+    """
+    How an image is joined: the joiner, the orientation of its strips and the directory
+    of the temporary files, with the estimates they were chosen by.
+    """
+    def __init__(self, joiner, orientation, directory, automatic, options, peak_memory, storage, memory, free,
+                 pieces=(), parallel=1, region=None, crop=None):
+        self.joiner = joiner
+        self.orientation = orientation
+        self.directory = directory
+        # The ImagePiece of the tiles intersecting the rectangle selected with --region, and the
+        # rectangle as (x, y, width, height) in pixels, which the joined image is cropped to.
+        self.region = region
+        self.crop = crop
+        # The ImagePieces the image is joined as with --max-memory, and how many are joined at a time.
+        self.pieces = pieces
+        self.parallel = parallel
+        # Whether the joiner was chosen by the planner rather than with -a or --format.
+        self.automatic = automatic
+        # (work, joiner, orientation) of every option considered, work in pixels rewritten.
+        self.options = options
+        self.peak_memory = peak_memory
+        self.storage = storage
+        # Available memory and free space in the directory, in bytes, None if unknown.
+        self.memory = memory
+        self.free = free
+        self.warnings = []
 
-    # spoof the user-agent and referrer, in case that matters.
-    req_headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 6.2; WOW64; rv:24.0) Gecko/20100101 Firefox/24.0',
-        'Referer': 'http://google.com'
-    }
-    # create a request object for the URL
-    request = urllib.request.Request(url, headers=req_headers)
-    # create an opener object
-    opener = urllib.request.build_opener()
-    # open a connection and receive the http response headers + contents
-    return opener.open(request)
+    def describe(self, untiler, destination):
+        """Return a report of the plan, as a list of lines."""
+        def megabytes(size):
+            return 'unknown' if size is None else '{:.0f} MB'.format(size / 1e6)
 
+        def option(joiner, orientation):
+            return joiner.name + (' by ' + orientation if len(joiner.orientations) > 1 else '')
 
-def download_url(url, destination):
+        work = min(options[0] for options in self.options)
+        lines = [
+            "Join plan for {}:".format(destination),
+            "  Image:      {} x {} pixels, {} x {} tiles of {} pixels".format(
+                untiler.width, untiler.height, untiler.x_tiles, untiler.y_tiles, untiler.tile_size),
+        ]
+        if self.region:
+            lines.append("  Region:     {2} x {3} pixels at {0},{1}, in {4} x {5} tiles from column {6}, row {7}"
+                         .format(*self.crop, self.region.x_tiles, self.region.y_tiles, self.region.col, self.region.row))
+        lines += [
+            "  Machine:    {} join worker{}, {} of memory available".format(
+                untiler.join_workers, '' if untiler.join_workers == 1 else 's', megabytes(self.memory)),
+            "  Algorithm:  {} ({}), {}".format(
+                option(self.joiner, self.orientation), 'chosen automatically' if self.automatic else 'selected',
+                self.joiner.profile()),
+            "  Estimates:  {:.0f} Mpx rewritten, peak memory {}, temporary files {}".format(
+                work / 1e6, megabytes(self.peak_memory), megabytes(self.storage)),
+        ]
+        if len(self.options) > 1:
+            lines.append("  Options:    " + ', '.join(
+                "{} {:.0f} Mpx".format(option(joiner, orientation), work / 1e6)
+                for work, joiner, orientation in sorted(self.options, key=lambda option: option[0])))
+        if self.pieces:
+            piece = self.pieces[0]
+            kind = 'bands' if piece.x_tiles == untiler.x_tiles else 'pieces'
+            lines.append("  Pieces:     {} {} of up to {} x {} tiles, {} at a time, indexed in {}".format(
+                len(self.pieces), kind, piece.x_tiles, piece.y_tiles, self.parallel,
+                os.path.splitext(destination)[0] + '.json'))
+        lines.append("  Directory:  {} ({} free)".format(self.directory or tempfile.gettempdir(), megabytes(self.free)))
+        lines += ["  Warning:    " + warning for warning in self.warnings]
+        return lines
+
+
+class ImagePiece():
     """
-    Copy a network object denoted by a URL to a local file.
+    A rectangle of whole tiles of an image, joined into a file of its own with --max-memory.
+    It stands in for the untiler towards a joiner, with the geometry of the piece and tile
+    positions relative to the piece. Everything else is looked up on the untiler.
     """
-    with open_url(url) as response, open(destination, 'wb') as out_file:
-        shutil.copyfileobj(response, out_file)
+    def __init__(self, untiler, col, row, x_tiles, y_tiles):
+        self.untiler = untiler
+        self.col, self.row = col, row
+        self.x_tiles = min(x_tiles, untiler.x_tiles - col)
+        self.y_tiles = min(y_tiles, untiler.y_tiles - row)
+        self.x, self.y = col * untiler.tile_size, row * untiler.tile_size
+        self.width = min(self.x_tiles * untiler.tile_size, untiler.width - self.x)
+        self.height = min(self.y_tiles * untiler.tile_size, untiler.height - self.y)
+        self.num_tiles = self.x_tiles * self.y_tiles
+        self.joined = 0
+        # The untiler releases the tiles kept in memory once the piece is joined.
+        self.tile_data = None
+        self.downloaded_iterator = None
+        self.destination = None
+
+    def __getattr__(self, name):
+        return getattr(self.untiler, name)
+
+    @property
+    def num_joined(self):
+        return self.joined
+
+    @num_joined.setter
+    def num_joined(self, value):
+        # Count the tiles towards the whole image too.
+        self.untiler.num_joined += value - self.joined
+        self.joined = value
+
+    def tile_source(self, col, row):
+        return self.untiler.tile_source(self.col + col, self.row + row)
+
 
 class JpegtranException(Exception):
     pass
@@ -127,16 +2518,68 @@ class ZoomLevelError(Exception):
     pass
 
 class ImageUntiler():
+    # Journal of the tiles written to the tile directory, only kept when tiles are stored (-s).
+    journal = None
+    # Tiles of the current image already in the tile directory from a previous run.
+    completed_tiles = frozenset()
+    # Downloaded tiles of the current image by position, when they are kept in memory.
+    tile_data = None
+    # Tiles of the current image filled from the lower zoom level, none when copying a tile pyramid.
+    filled_tiles = ()
+    # Tiles fetched to estimate the size and download time of a zoom level.
+    num_sample_tiles = 4
+
     def __init__(self, args):
         self.verbose = int(args.verbose)
         self.store = args.store
         self.out = args.out
         self.jpegtran = args.jpegtran
         self.no_download = args.no_download
+        self.in_memory = args.in_memory
         self.nthreads = args.nthreads
+        self.engine = args.engine
+        self.window = args.window if args.window is not None else max(64, 4 * self.nthreads)
+        self.adaptive = args.adaptive
+        self.min_threads = args.min_threads
+        self.cache = None
+        if args.cache:
+            self.cache = TileCache(args.cache, args.cache_size, args.cache_missing_ttl)
+        self.retries = args.retries
+        self.retry_delay = args.retry_delay
+        self.retry_budget = args.retry_budget
+        http_pool.maxsize = args.pool_size if args.pool_size is not None else self.nthreads
+        http_pool.timeout = self.timeout = args.timeout
         self.base = args.base
         self.zoom_level = args.zoom_level
-        # self.algorithm = args.algorithm
+        # The zoom level of the current image is in zoom_level.
+        self.requested_zoom_level = args.zoom_level
+        self.max_pixels = args.max_pixels
+        self.max_bytes = args.max_bytes
+        self.deadline = args.deadline
+        self.algorithm = args.algorithm
+        self.plan_only = args.plan
+        self.max_memory = args.max_memory
+        self.region = args.region
+        self.scales = args.scales
+        self.fill_missing = args.fill_missing
+        self.optimize = args.optimize
+        # Runs the optimization of images with --optimize background.
+        self.background = ThreadPoolExecutor(max_workers=1) if self.optimize == 'background' else None
+        self.background_jobs = []
+        self.format = args.format
+        self.mirror_levels = args.levels
+        self.join_workers = args.join_workers or os.cpu_count() or 1
+        # Taken while building a strip of tiles, so the images processed with --jobs share the join workers.
+        self.join_slots = threading.BoundedSemaphore(self.join_workers)
+        self.jobs = max(1, args.jobs)
+        self.prefetch = max(0, args.prefetch)
+        self.shard = args.shard
+        # The content of the pages and ImageProperties.xml files fetched ahead of time, as futures by URL.
+        self.prefetched = {}
+        self.turbojpeg = args.turbojpeg
+        self.turbojpeg_library = None
+        self.subprocesses = set()
+        self.subprocesses_lock = threading.Lock()
         self.ext = 'jpg'
 
         if self.no_download:
@@ -144,17 +2587,37 @@ class ImageUntiler():
 
         # Set up logging.
         log_level = logging.WARNING  # default
-        if args.verbose == 0:
+        if args.verbose == 0 or self.jobs > 1:
             # Disable the progressbar
             global progressbar
             progressbar = False
-        elif args.verbose == 1:
+        if args.verbose == 1:
             log_level = logging.INFO
         elif args.verbose >= 2:
             log_level = logging.DEBUG
         logging.basicConfig(level=log_level, format='%(levelname)s: %(message)s')
         self.log = logging.getLogger(__name__)
 
+        self.state = BatchState(args.state) if args.state else None
+        if args.status:
+            if self.state is None:
+                self.log.error("--status needs the --state database of the list.")
+                return
+            self.print_status(self.get_url_list(args.url, args.list))
+            self.state.close()
+            if self.cache is not None:
+                self.cache.close()
+            return
+
+        if self.engine == 'asyncio' and any(scheme in urllib.request.getproxies() for scheme in ('http', 'https')):
+            self.log.warning("The asyncio engine does not support proxies, using the thread engine instead.")
+            self.engine = 'thread'
+        # The simultaneous downloads shared by the images processed with --jobs.
+        self.download_slots = None
+        if self.jobs > 1:
+            self.download_slots = ConcurrencyController(self.min_threads if self.adaptive else self.nthreads,
+                                                        self.nthreads, self.log)
+
         # Set up jpegtran.
         if self.jpegtran is None:  # we need to locate jpegtran
             mod_dir = os.path.dirname(__file__)  # location of this script
@@ -190,43 +2653,123 @@ class ImageUntiler():
                 .format(self.jpegtran))
                 subproc.kill()
                 raise JpegtranException
+            # Only the jpegtran of libjpeg 8 and later can scale.
+            self.jpegtran_scales = '-scale' in jpegtran_help_info
         except Exception:
             subproc.kill()
             self.log.error("Communication with Jpegtran has failed and the process was killed.")
             raise JpegtranException
+        if self.fill_missing and not self.jpegtran_scales and Image is None:
+            self.log.warning("Missing tiles cannot be filled: {} cannot scale images and Pillow is not installed."
+                             .format(self.jpegtran))
+            self.fill_missing = False
 
         self.tile_dir = None
-        self.get_url_list(args.url, args.list)
+        entries = self.get_url_list(args.url, args.list)
 
-        if len(self.image_urls) == 1:
-            self.log.info("Processing image {})...".format(self.image_urls[0]))
-            self.process_image(self.image_urls[0], self.out_names[0])
-            self.log.info("Dezoomifed image created and saved to {}.".format(self.out_names[0]))
-        else:
-            for i, image_url in enumerate(self.image_urls):
-                destination = self.out_names[i]
-                self.log.info("[{}/{}] Processing image {}...".format(i + 1, len(self.image_urls), image_url))
-                try:
-                    self.process_image(image_url, destination)
-                except Exception as e:
-                    if not isinstance(e, (FileNotFoundError, JpegtranException, ZoomLevelError)):
-                        self.log.warning("Unknown exception occurred while processing image {}: {} ()".format(image_url, e.__class__.__name__, e))
-                self.log.info("Dezoomifed image created and saved to {}.".format(destination))
+        def done(image_url, destination):
+            return self.state is not None and self.state.done(image_url, self.requested_zoom_level, destination)
+
+        try:
+            if not args.list:
+                _, image_url, destination = next(entries)
+                if done(image_url, destination):
+                    self.log.info("Skipping image {}, already created in {}.".format(image_url, destination))
+                else:
+                    self.log.info("Processing image {})...".format(image_url))
+                    self.process_recorded_image(image_url, destination)
+                    if not self.plan_only:
+                        self.log.info("Dezoomifed image created and saved to {}.".format(destination))
+            else:
+                prefetcher = ThreadPoolExecutor(max_workers=self.prefetch) if self.prefetch else None
+
+                def prefetching(entries):
+                    # Fetch the metadata of the next images of the list while an image is processed.
+                    upcoming = collections.deque()
+                    for entry in entries:
+                        if not done(*entry[1:]):
+                            self.prefetch_metadata(entry[1], prefetcher)
+                        upcoming.append(entry)
+                        if len(upcoming) > self.prefetch:
+                            yield upcoming.popleft()
+                    yield from upcoming
+
+                def process(number, image_url, destination):
+                    if done(image_url, destination):
+                        self.log.info("[{}] Skipping image {}, already created in {}."
+                                      .format(number, image_url, destination))
+                        return
+                    # Concurrent images each have their own copy of the state of the current image.
+                    untiler = copy.copy(self) if self.jobs > 1 else self
+                    self.log.info("[{}] Processing image {}...".format(number, image_url))
+                    try:
+                        untiler.process_recorded_image(image_url, destination)
+                    except Exception as e:
+                        if not isinstance(e, (FileNotFoundError, JpegtranException, ZoomLevelError)):
+                            self.log.warning("Unknown exception occurred while processing image {}: {} ({})".format(image_url, e.__class__.__name__, e))
+                    else:
+                        if not self.plan_only:
+                            self.log.info("Dezoomifed image created and saved to {}.".format(destination))
+
+                if prefetcher is not None:
+                    entries = prefetching(entries)
+                if self.jobs > 1:
+                    # Only read the next entry of the list when a job is free.
+                    with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                        running = set()
+                        for entry in entries:
+                            if len(running) >= self.jobs:
+                                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                                for job in finished:
+                                    job.result()
+                            running.add(executor.submit(process, *entry))
+                        for job in running:
+                            job.result()
+                else:
+                    for entry in entries:
+                        process(*entry)
+                if prefetcher is not None:
+                    prefetcher.shutdown(wait=False)
+                self.prefetched.clear()
+        finally:
+            # Wait for the images being optimized in the background, which records them in the --state.
+            self.finish_background()
+            if self.state is not None:
+                self.state.close()
+            if self.cache is not None:
+                self.cache.close()
 
     def process_image(self, image_url, destination):
         """Scrapes image info and calls the untiler."""
+        # The tile directory of the previous image is already erased.
+        self.tile_dir = None
         if not self.base:
             # locate the base directory of the zoomify tile images
             self.base_dir = self.get_base_directory(image_url)
         else:
-            self.base_dir = image_url
-            if self.base_dir.endswith('/ImageProperties.xml'):
-                self.base_dir = urllib.parse.urljoin(self.base_dir, '.')
-            self.base_dir = self.base_dir.rstrip('/') + '/'
+            self.base_dir = self.given_base_directory(image_url)
 
         try:
             # inspect the ImageProperties.xml file to get properties, and derive the rest
-            self.get_properties(self.base_dir, self.zoom_level)
+            self.get_properties(self.base_dir, self.requested_zoom_level)
+
+            if self.format in ('dzi', 'zoomify'):
+                # copy the tiles into a new tile pyramid instead of joining them
+                self.tile_dir = None
+                if self.plan_only:
+                    print("{}: copying zoom levels {} into a {} tile tree, without joining."
+                          .format(destination, ','.join(str(level) for level in self.get_mirror_levels()), self.format))
+                    return
+                self.mirror_image(destination)
+                return
+
+            # choose how to join the tiles
+            self.plan = self.plan_join(destination)
+            if self.plan_only:
+                print('\n'.join(self.plan.describe(self, destination)))
+                return
+            for warning in self.plan.warnings:
+                self.log.warning(warning)
 
             # create the directory where the tiles are stored
             self.setup_tile_directory(self.store, destination)
@@ -234,19 +2777,165 @@ class ImageUntiler():
             # download and join tiles to create the dezoomified file
             self.untile_image(destination)
 
+            if self.scales:
+                if self.format != 'jpeg' or self.plan.pieces:
+                    self.log.warning("--scales only applies to images joined into a single JPEG file.")
+                elif any(job_destination == destination for job_destination, _ in self.background_jobs):
+                    # Scale the image once it is optimized. The job gets its own copy of the state of the
+                    # image, which the next image of the list replaces meanwhile.
+                    self.background_jobs.append(
+                        (destination, self.background.submit(copy.copy(self).write_scaled_images, destination)))
+                else:
+                    self.write_scaled_images(destination)
+
         finally:
             if not self.store and self.tile_dir:
                 shutil.rmtree(self.tile_dir)
                 self.log.debug("Erased the temporary directory and its contents")
 
+    def process_recorded_image(self, image_url, destination):
+        """Calls process_image, recording the outcome of the image in the --state database if there is one."""
+        if self.state is None or self.plan_only:
+            self.process_image(image_url, destination)
+            return
+        key = (image_url, self.requested_zoom_level, destination)
+        self.state.start(*key)
+        try:
+            self.process_image(image_url, destination)
+        except Exception as e:
+            self.state.finish(*key, BatchState.FAILED, error=str(e) or e.__class__.__name__)
+            raise
+        if self.format in ('dzi', 'zoomify'):
+            outputs = [os.path.splitext(destination)[0] + '.dzi' if self.format == 'dzi'
+                       else os.path.join(os.path.splitext(destination)[0], 'ImageProperties.xml')]
+        else:
+            outputs = [destination] + [piece.destination for piece in self.plan.pieces]
+        # Tiles filled from the lower zoom level count as joined, but the image is not complete.
+        status = BatchState.PARTIAL if self.num_missing or self.filled_tiles else BatchState.COMPLETE
+        details = dict(level=self.zoom_level, width=self.width, height=self.height, tiles=self.num_tiles,
+                       missing_tiles=self.num_missing, filled_tiles=len(self.filled_tiles))
+        pending = [job for job_destination, job in self.background_jobs if job_destination == destination]
+        if not pending:
+            self.state.finish(*key, status, size=sum(os.path.getsize(path) for path in outputs
+                                                     if os.path.isfile(path)), **details)
+            return
+
+        def finish():
+            # The image is only done once it is optimized and scaled, which the jobs before this one did.
+            for job in pending:
+                e = job.exception()
+                if e is not None:
+                    self.state.finish(*key, BatchState.FAILED, error=str(e) or e.__class__.__name__)
+                    return
+            self.state.finish(*key, status, size=sum(os.path.getsize(path) for path in outputs
+                                                     if os.path.isfile(path)), **details)
+
+        self.background_jobs.append((destination, self.background.submit(finish)))
+
+    def print_status(self, entries):
+        """
+        Print how many images of the list are complete, partial, failed and pending according to --state.
+        entries are the (number, URL, output file name) entries of the list.
+        """
+        records = self.state.records(self.requested_zoom_level)
+        counts = collections.Counter()
+        totals = collections.defaultdict(lambda: [0, 0, 0, 0, 0.0])
+        failed = []
+        for _, image_url, destination in entries:
+            status, *values, error = records.get((image_url, destination), (None,) * 7)
+            if status not in (BatchState.COMPLETE, BatchState.PARTIAL, BatchState.FAILED):
+                status = 'pending'
+            counts[status] += 1
+            totals[status] = [total + (value or 0) for total, value in zip(totals[status], values)]
+            if status == BatchState.FAILED:
+                failed.append('  {} ({}): {}'.format(image_url, destination, error))
+        num_images = sum(counts.values())
+        print("{} image{} in the list{}:".format(num_images, '' if num_images == 1 else 's',
+                                                 ' shard {}/{}'.format(*self.shard) if self.shard else ''))
+        for status in (BatchState.COMPLETE, BatchState.PARTIAL, BatchState.FAILED, 'pending'):
+            tiles, missing_tiles, filled_tiles, size, seconds = totals[status]
+            details = ''
+            if status in (BatchState.COMPLETE, BatchState.PARTIAL):
+                details = ' ({} tiles{}{}, {:.1f} MB, {:.0f} s)'.format(
+                    tiles, ', {} missing'.format(missing_tiles) if missing_tiles else '',
+                    ', {} filled'.format(filled_tiles) if filled_tiles else '', size / 1e6, seconds)
+            print("  {}: {}{}".format(status, counts[status], details))
+        if failed:
+            print("Failed images:")
+            print('\n'.join(failed))
+
+    @staticmethod
+    def given_base_directory(url):
+        """Return the base directory given with -b as URL, which may also be the URL of its ImageProperties.xml."""
+        if url.endswith('/ImageProperties.xml'):
+            url = urllib.parse.urljoin(url, '.')
+        return url.rstrip('/') + '/'
+
+    def read_url(self, url):
+        """Return the content at the URL as text, from the metadata prefetched for it if there is some."""
+        prefetched = self.prefetched.pop(url, None)
+        if prefetched is not None:
+            return prefetched.result()
+        with open_url(url) as handle:
+            return handle.read().decode(errors='ignore')
+
+    def prefetch_metadata(self, image_url, executor):
+        """
+        Fetch the page of an image and its ImageProperties.xml in the executor, ahead of processing
+        the image, for read_url. Each URL is registered before it is fetched, the page here and the
+        XML before the page is handed over, so read_url never fetches a URL being prefetched again.
+        Errors are kept with the prefetched content, to be reported when the image is processed.
+        """
+        def fetch(url, future):
+            try:
+                with open_url(url) as handle:
+                    future.set_result(handle.read().decode(errors='ignore'))
+            except Exception as e:
+                future.set_exception(e)
+
+        def fetch_page(page):
+            try:
+                with open_url(image_url) as handle:
+                    content = handle.read().decode(errors='ignore')
+            except Exception as e:
+                page.set_exception(e)
+                return
+            properties = None
+            try:
+                base_dir = self.find_base_directory(image_url, content)
+                if base_dir is not None:
+                    url = urllib.parse.urljoin(base_dir, 'ImageProperties.xml')
+                    properties = self.prefetched[url] = Future()
+            finally:
+                page.set_result(content)
+            if properties is not None:
+                fetch(url, properties)
+
+        if self.base:
+            url = urllib.parse.urljoin(self.given_base_directory(image_url), 'ImageProperties.xml')
+            future = self.prefetched[url] = Future()
+            executor.submit(fetch, url, future)
+        else:
+            future = self.prefetched[image_url] = Future()
+            executor.submit(fetch_page, future)
+
     def untile_image(self, output_destination):
         """
         Downloads image tiles and joins them.
         These processes are done in parallel.
         """
-        self.num_tiles = self.x_tiles * self.y_tiles
+        image = self.plan.region or self
+        self.num_tiles = image.x_tiles * image.y_tiles
         self.num_downloaded = 0
+        self.num_missing = 0
+        # Positions of the tiles filled from the lower zoom level, and the parent tiles by position.
+        self.filled_tiles = []
+        self.parent_tiles = {}
+        self.parent_tiles_lock = threading.Lock()
         self.num_joined = 0
+        self.tile_data = {} if self.in_memory and not self.store else None
+        # Serializes the counting of joined tiles and the progressbar updates of the joining.
+        self.progress_lock = threading.Lock()
 
         # Progressbars for downloading and joining.
         download_progressbar = None
@@ -283,215 +2972,902 @@ class ImageUntiler():
                 else:
                     joining_progressbar.update(self.num_joined)
 
-        def local_tile_path(col, row):
-            return os.path.join(self.tile_dir, "{}_{}.{}".format(col, row, self.ext))
+        if self.store:
+            self.open_journal()
 
-        def download(tile_position):
-            col, row = tile_position
-            url = self.get_tile_url(col, row)
-            destination = local_tile_path(col, row)
-            if not progressbar:
-                self.log.debug("Downloading tile (row {:3}, col {:3})".format(row, col))
-            try:
-                download_url(url, destination)
-            except urllib.error.HTTPError as e:
-                self.num_downloaded += 1
-                self.log.warning(
-                    "{}. Tile {} (row {}, col {}) does not exist on the server."
-                    .format(e, url, row, col)
-                )
-                return (None, None)
-            self.num_downloaded += 1
-            return tile_position
+        # Download tiles in self.nthreads parallel downloads.
+        def grid(col, row, x_tiles, y_tiles):
+            if self.plan.orientation == 'rows':
+                return ((c, r) for r in range(row, row + y_tiles) for c in range(col, col + x_tiles))
+            return itertools.product(range(col, col + x_tiles), range(row, row + y_tiles))
 
-        # Download tiles in self.nthreads parallel threads.
-        tile_positions = itertools.product(range(self.x_tiles), range(self.y_tiles))
+        if self.plan.pieces:
+            tile_positions = itertools.chain.from_iterable(
+                grid(piece.col, piece.row, piece.x_tiles, piece.y_tiles) for piece in self.plan.pieces)
+        elif self.plan.region:
+            region = self.plan.region
+            tile_positions = grid(region.col, region.row, region.x_tiles, region.y_tiles)
+        else:
+            tile_positions = grid(0, 0, self.x_tiles, self.y_tiles)
         if not self.no_download:
-            pool = ThreadPool(processes=self.nthreads)
-            self.downloaded_iterator = pool.imap(download, tile_positions)
+            self.downloaded_iterator = self.download_tiles(tile_positions)
         else:
-            self.downloaded_iterator = tile_positions
+            # Only join the tiles that are known to be complete.
+            self.downloaded_iterator = (
+                position if position in self.completed_tiles else (None, None)
+                for position in tile_positions
+            )
             self.num_downloaded = self.num_tiles
 
-        def jplarge(self, joining_progressbar):
-            """
-            Faster untilig algorithm, assembling columns separately,
-            then assembling those into final image. Cuts down on the cost
-            of constantly opening two huge final images.
-            """
-            # Do tile joining in parallel with the downloading.
-            # Use 4 temporary files for the joining process.
-            tmpimgs = []
-            finalimage = []
-            tempinfo = {'tmp_': tmpimgs, 'final_': finalimage}
-            for i in range(2):
-                for f in iter(tempinfo):
-                    fhandle = tempfile.NamedTemporaryFile(suffix='.jpg', prefix=f, dir=self.tile_dir, delete=False)
-                    tempinfo[f].append(fhandle.name)
-                    fhandle.close()
-                    self.log.debug("Created temporary image file: " + tempinfo[f][i])
-
-            # The index of current_col temp image to be used for input, toggles between 0 and 1.
-            active_tmp = 0
-            active_final = 0
+        def finish_progressbars():
+            if progressbar and joining_progressbar.start_time is not None:
+                joining_progressbar.finish()
+
+        # Select untiling algorithm
+        joiner = self.plan.joiner
+        self.log.info("Joining the tiles with {}{} ({}).".format(
+            joiner.name, ' by rows' if self.plan.orientation == 'rows' else '', joiner.profile()))
+        try:
+            if self.plan.pieces:
+                self.join_pieces(output_destination, update_progressbars)
+                finish_progressbars()
+            elif self.plan.region:
+                self.join_region(output_destination, update_progressbars, finish_progressbars)
+            else:
+                joiner(self, output_destination, update_progressbars, finish_progressbars).join()
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            self.tile_data = None
+        self.num_missing = self.num_tiles - self.num_joined
+        if not self.no_download:
+            self.log_download_report(output_destination)
+
+    def optimize_image(self, source, destination):
+        """
+        Write the image at source to destination with optimized Huffman tables and log
+        the size saved against the time it took. source is deleted. If jpegtran fails,
+        the image is moved to destination as it is.
+        """
+        start = time.perf_counter()
+        if self.run_jpegtran('-copy', 'all', '-optimize', '-outfile', destination, source):
+            if os.path.exists(destination):
+                os.unlink(destination)
+            move_into_place(source, destination)
+            self.log.warning("Optimizing {} failed, it was written without optimizing it.".format(destination))
+            return
+        elapsed = time.perf_counter() - start
+        before, after = os.path.getsize(source), os.path.getsize(destination)
+        os.unlink(source)
+        self.log.info("Optimized {} in {:.1f} s: {:.1f} MB instead of {:.1f} MB ({:+.1%}).".format(
+            destination, elapsed, after / 1e6, before / 1e6, after / before - 1 if before else 0))
 
-            # Join tiles into a single image in parallel to them being downloaded.
+    def optimize_later(self, source, destination):
+        """Optimize an image in the background, while the next image is processed."""
+        def optimize():
             try:
-                subproc = None # Popen class of the most recently called subprocess.
-                current_col = 0
-                tile_in_column = 0
-                for i, (col, row) in enumerate(self.downloaded_iterator):
-                    if col is None:
-                        self.log.debug("Missing col tile!")
-                        continue # Tile failed to download.
-
-                    if col == current_col:
-                        if not progressbar:
-                            self.log.debug("Adding tile (row {:3}, col {:3}) to the image".format(row, col))
-
-                        # As the very first step create an (almost) empty temp column image,
-                        # with the target column dimensions.
-                        # Don't reuse old tempfile without overwriting it first -
-                        # if the file is broken, we want an empty space instead of an image from previous iteration.
-                        if tile_in_column == 0 and not current_col == self.x_tiles - 1:
-                            subproc = subprocess.Popen([self.jpegtran,
-                                '-copy', 'all',
-                                '-crop', '{:d}x{:d}+0+0'.format(self.tile_size, self.height),
-                                '-outfile', tmpimgs[active_tmp],
-                                local_tile_path(col, row)
-                            ])
-                            subproc.wait()
-                        # Last column may have different width - create tempfile with correct dimensions
-                        elif tile_in_column == 0 and current_col == self.x_tiles - 1:
-                            subproc = subprocess.Popen([self.jpegtran,
-                                '-copy', 'all',
-                                '-crop', '{:d}x{:d}+0+0'.format(self.width - ((self.x_tiles - 1) * self.tile_size), self.height),
-                                '-outfile', tmpimgs[active_tmp],
-                                local_tile_path(col, row)
-                            ])
-                            subproc.wait()
-                        # Not working on a complete column - just keep adding images.
-                        else:
-                            subproc = subprocess.Popen([self.jpegtran,
-                                '-perfect',
-                                '-copy', 'all',
-                                '-drop', '+{:d}+{:d}'.format(0, row * self.tile_size), local_tile_path(col, row),
-                                '-outfile', tmpimgs[active_tmp],
-                                tmpimgs[(active_tmp + 1) % 2]
-                            ])
-                            subproc.wait()
-
-                        self.num_joined += 1
-                        update_progressbars()
-
-                        # After untiling of a first column,
-                        # create a full sized temp image with the just untiled column
-                        if tile_in_column == self.y_tiles - 1 and current_col == 0:
-                            subproc = subprocess.Popen([self.jpegtran,
-                                '-perfect',
-                                '-copy', 'all',
-                                '-crop', '{:d}x{:d}+0+0'.format(self.width, self.height),
-                                '-outfile', finalimage[active_final],
-                                tmpimgs[active_tmp]
-                            ])
-                            subproc.wait()
-                            current_col += 1
-                            tile_in_column = 0
-                            active_final = (active_final + 1) % 2
-                            active_tmp = (active_tmp + 1) % 2
-                        # Drop just untiled column (other then first) into the full sized temp image.
-                        elif tile_in_column == self.y_tiles - 1 and not current_col == 0:
-                            subproc = subprocess.Popen([self.jpegtran,
-                                '-perfect',
-                                '-copy', 'all',
-                                '-drop', '+{:d}+{:d}'.format(current_col * self.tile_size, 0), tmpimgs[active_tmp],
-                                '-outfile', finalimage[active_final],
-                                finalimage[(active_final + 1) % 2]
-                            ])
-                            subproc.wait()
-                            current_col += 1
-                            tile_in_column = 0
-                            active_final = (active_final + 1) % 2
-                            active_tmp = (active_tmp + 1) % 2
-                        # No column completely untiled, keep working
-                        else:
-                            tile_in_column += 1
-                            active_tmp = (active_tmp + 1) % 2  # toggle between the two temp images
-
-                # Optimize the final  image and write it to destination
-                subproc = subprocess.Popen([self.jpegtran,
-                    '-copy', 'all',
-                    '-optimize',
-                    '-outfile', output_destination,
-                    finalimage[(active_final + 1) % 2]
-                ])
-                subproc.wait()
-
-                num_missing = self.num_tiles - self.num_joined
-                if num_missing > 0:
-                    self.log.warning(
-                        "Image '{3}' is missing {0} tile{1}. "
-                        "You might want to download the image at a different zoom level "
-                        "(currently {2}) to get the missing part{1}."
-                        .format(num_missing, '' if num_missing == 1 else 's', self.zoom_level,
-                                output_destination)
-                    )
-                if progressbar and joining_progressbar.start_time is not None:
-                    joining_progressbar.finish()
-
-            except KeyboardInterrupt:
-                # Kill the jpegtran subprocess.
-                if subproc and subproc.poll() is None:
+                self.optimize_image(source, destination)
+            finally:
+                # Do not leave the unoptimized image behind if the optimization failed.
+                if os.path.exists(source):
+                    os.unlink(source)
+
+        self.background_jobs.append((destination, self.background.submit(optimize)))
+
+    def finish_background(self):
+        """Wait for the images being optimized in the background."""
+        if self.background is None:
+            return
+        for destination, job in self.background_jobs:
+            try:
+                job.result()
+            except Exception as e:
+                self.log.error("Optimizing {} failed: {}".format(destination, e))
+        self.background.shutdown()
+        self.background, self.background_jobs = None, []
+
+    def write_scaled_images(self, destination):
+        """
+        Writes the smaller copies of the image at destination selected with --scales. A scale
+        halving the image a whole number of times is joined from the lower zoom level if all its
+        tiles are in the tile cache, which is cheaper and keeps the tiles as they are. The other
+        scales are made by decoding the image at a reduced size with Pillow, which libjpeg does
+        on the DCT coefficients, and encoding it again. Without Pillow, jpegtran -scale is used,
+        but only kept if it wrote a standard JPEG image: the jpegtran of libjpeg 8 and later
+        writes SmartScale images, which most decoders cannot read.
+        """
+        root, ext = os.path.splitext(destination)
+        for scale in self.scales:
+            path = '{}_{}-{}{}'.format(root, scale.numerator, scale.denominator, ext)
+            level = self.zoom_level - (scale.denominator.bit_length() - 1)
+            start = time.perf_counter()
+            if scale.numerator == 1 and level >= 0 and not self.plan.region and self.level_cached(level):
+                self.join_cached_level(level, path)
+                method = "joined zoom level {} from the tile cache".format(level)
+            elif Image is not None:
+                with Image.open(destination) as image:
+                    settings = {'qtables': image.quantization}
+                    subsampling = JpegImagePlugin.get_sampling(image)
+                    if subsampling != -1:
+                        settings['subsampling'] = subsampling
+                    size = (int(ceil(image.width * scale)), int(ceil(image.height * scale)))
+                    # Decode at the nearest size libjpeg can scale to, 1/2, 1/4 or 1/8, resizing the rest of the way.
+                    image.draft(image.mode, size)
+                    scaled = image if image.size == size else image.resize(size, Image.LANCZOS)
+                    scaled.save(path, 'JPEG', optimize=self.optimize != 'skip', **settings)
+                method = "scaled with Pillow"
+            elif self.jpegtran_scales:
+                optimize = () if self.optimize == 'skip' else ('-optimize',)
+                if (self.run_jpegtran('-copy', 'all', *optimize, '-scale', '{}/{}'.format(
+                        scale.numerator, scale.denominator), '-outfile', path, destination) or
+                        not standard_jpeg_file(path)):
+                    if os.path.exists(path):
+                        os.unlink(path)
+                    self.log.warning("Cannot write {}: {} did not scale the image to a standard JPEG image "
+                                     "and Pillow is not installed.".format(path, self.jpegtran))
+                    continue
+                method = "scaled with jpegtran"
+            else:
+                self.log.warning("Cannot write {}: {} cannot scale images and Pillow is not installed."
+                                 .format(path, self.jpegtran))
+                continue
+            self.log.info("Wrote {} at {} of the size, {} in {:.1f} s: {:.1f} MB.".format(
+                path, scale, method, time.perf_counter() - start, os.path.getsize(path) / 1e6))
+
+    def level_cached(self, level):
+        """Return whether all tiles of a zoom level are in the tile cache."""
+        if self.cache is None:
+            return False
+        x_tiles, y_tiles = self.levels[level]
+        return all(self.cache.contains(self.get_tile_url(col, row, level))
+                   for col in range(x_tiles) for row in range(y_tiles))
+
+    def join_cached_level(self, level, destination):
+        """Joins a lower zoom level of the image from the tile cache into destination."""
+        untiler = copy.copy(self)
+        untiler.zoom_level = level
+        untiler.width, untiler.height = self.level_size(level)
+        untiler.x_tiles, untiler.y_tiles = self.levels[level]
+        untiler.store = untiler.no_download = False
+        untiler.completed_tiles = frozenset()
+        untiler.region = untiler.max_memory = None
+        if untiler.optimize == 'background':
+            untiler.optimize = 'final'
+        untiler.plan = untiler.plan_join(destination)
+        untiler.setup_tile_directory(False)
+        try:
+            untiler.untile_image(destination)
+        finally:
+            shutil.rmtree(untiler.tile_dir)
+
+    def join_pieces(self, output_destination, update_progressbars):
+        """
+        Joins the image as the pieces of the plan, into files named after output_destination
+        with the row and column of the piece, and writes an index of their pixel offsets.
+        Up to plan.parallel pieces are joined at a time, sharing the join workers. The downloaded
+        tiles are handed to the piece they belong to, in the order they are downloaded.
+        """
+        root, ext = os.path.splitext(output_destination)
+        bands = self.plan.pieces[0].x_tiles == self.x_tiles
+        running = threading.BoundedSemaphore(self.plan.parallel)
+        executor = ThreadPoolExecutor(max_workers=self.plan.parallel)
+        joined = []
+        aborted = threading.Event()
+
+        def receive(tiles):
+            yield from iter(tiles.get, None)
+            if aborted.is_set():
+                raise RuntimeError("Joining the image was aborted.")
+
+        def join_piece(piece, tiles):
+            try:
+                piece.downloaded_iterator = receive(tiles)
+                self.plan.joiner(piece, piece.destination, update_progressbars, lambda: None).join()
+                return True
+            except FileNotFoundError:
+                self.log.warning("None of the tiles of {} could be downloaded, it is left out.".format(piece.destination))
+                return False
+            finally:
+                if self.tile_data is not None:
+                    for col in range(piece.col, piece.col + piece.x_tiles):
+                        for row in range(piece.row, piece.row + piece.y_tiles):
+                            self.tile_data.pop((col, row), None)
+                running.release()
+
+        try:
+            downloaded = iter(self.downloaded_iterator)
+            for piece in self.plan.pieces:
+                piece_row, piece_col = piece.row // self.plan.pieces[0].y_tiles, piece.col // self.plan.pieces[0].x_tiles
+                piece.destination = ('{}_{}{}'.format(root, piece_row, ext) if bands
+                                     else '{}_{}_{}{}'.format(root, piece_row, piece_col, ext))
+                piece.join_workers = max(1, self.join_workers // self.plan.parallel)
+                running.acquire()
+                tiles = queue.Queue()
+                joined.append((piece, tiles, executor.submit(join_piece, piece, tiles)))
+                for _ in range(piece.num_tiles):
+                    col, row = next(downloaded)
+                    tiles.put((None, None) if col is None else (col - piece.col, row - piece.row))
+                tiles.put(None)
+                # Fail early if joining a piece has failed.
+                for _, _, job in joined:
+                    if job.done():
+                        job.result()
+            pieces = [piece for piece, _, job in joined if job.result()]
+        except BaseException:
+            # Stop the pieces still waiting for tiles.
+            aborted.set()
+            for _, tiles, _ in joined:
+                tiles.put(None)
+            raise
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+        if not pieces:
+            raise FileNotFoundError("None of the tiles could be downloaded.")
+        index = root + '.json'
+        with open(index, 'w') as f:
+            json.dump({
+                'width': self.width,
+                'height': self.height,
+                'pieces': [{'file': os.path.basename(piece.destination), 'x': piece.x, 'y': piece.y,
+                            'width': piece.width, 'height': piece.height} for piece in pieces],
+            }, f, indent=1)
+        self.log.info("Joined the image as {} pieces, indexed in {}.".format(len(pieces), index))
+
+    def join_region(self, output_destination, update_progressbars, finish_progressbars):
+        """
+        Joins the tiles of the region of the plan and crops the image to the region with jpegtran,
+        losslessly. jpegtran only cuts along the edges of the iMCUs, the blocks of 8 or 16 pixels
+        the image is coded in, so the top left corner moves up and left to the nearest edge.
+        The Huffman tables are optimized while cropping, unless --optimize skip is given.
+        """
+        region = self.plan.region
+        region.downloaded_iterator = ((None, None) if col is None else (col - region.col, row - region.row)
+                                      for col, row in self.downloaded_iterator)
+        if self.format != 'jpeg':
+            self.plan.joiner(region, output_destination, update_progressbars, finish_progressbars).join()
+            self.log.info("{} holds the whole tiles of the region: {} x {} pixels at {},{}.".format(
+                output_destination, region.width, region.height, region.x, region.y))
+            return
+
+        # Cropping rewrites the image anyway.
+        region.optimize = 'skip'
+        self.plan.joiner(region, output_destination, update_progressbars, finish_progressbars).join()
+        x, y, width, height = self.plan.crop
+        left, top = x - region.x, y - region.y
+        with open(output_destination, 'rb') as f:
+            header = JpegHeader(f.read(1 << 20))
+        imcu_width = 8 * max(h for _, h, _, _ in header.components)
+        imcu_height = 8 * max(v for _, _, v, _ in header.components)
+        snapped_left, snapped_top = left - left % imcu_width, top - top % imcu_height
+        if (snapped_left, snapped_top) != (left, top):
+            self.log.info("The region starts at {},{} instead of {},{}, on the {}x{} pixel blocks of the image."
+                          .format(region.x + snapped_left, region.y + snapped_top, x, y, imcu_width, imcu_height))
+
+        fhandle, cropped = tempfile.mkstemp(suffix='.jpg', prefix='.region_',
+                                            dir=os.path.dirname(os.path.abspath(output_destination)))
+        os.close(fhandle)
+        try:
+            optimize = () if self.optimize == 'skip' else ('-optimize',)
+            if self.run_jpegtran('-copy', 'all', *optimize, '-crop', '{}x{}+{}+{}'.format(width, height, left, top),
+                                 '-outfile', cropped, output_destination):
+                os.unlink(cropped)
+                self.log.warning("Cropping {} to the region failed, it holds the whole tiles of the region: "
+                                 "{} x {} pixels at {},{}.".format(output_destination, region.width, region.height,
+                                                                   region.x, region.y))
+                return
+            move_into_place(cropped, output_destination)
+        except BaseException:
+            if os.path.exists(cropped):
+                os.unlink(cropped)
+            raise
+        self.log.info("Cropped {} to the region{}: {} x {} pixels, {:.1f} MB.".format(
+            output_destination, '' if optimize else ' without optimizing it', width + left - snapped_left,
+            height + top - snapped_top, os.path.getsize(output_destination) / 1e6))
+
+    def mirror_image(self, destination):
+        """
+        Downloads the tiles of the selected zoom levels into a Deep Zoom or Zoomify directory tree
+        and writes its descriptor file, without joining them. The levels are downloaded together,
+        in a single window of simultaneous downloads. Tiles that are already in the directory tree
+        are not downloaded again.
+        """
+        levels = self.get_mirror_levels()
+        root = os.path.splitext(destination)[0]
+        if self.format == 'dzi':
+            # Deep Zoom levels go down to a single pixel, so the highest level is numbered
+            # ceil(log2(longest edge)). The smaller Deep Zoom levels are not in a Zoomify pyramid.
+            # Deep Zoom rounds the level sizes up where Zoomify rounds them down, so edge tiles of
+            # the lower levels can be up to a pixel narrower than a Deep Zoom viewer expects.
+            self.mirror_dir = root + '_files'
+            self.dzi_max_level = (max(self.max_width, self.max_height) - 1).bit_length()
+            descriptor = root + '.dzi'
+            properties = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                          '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+                          'Format="{}" Overlap="0" TileSize="{}">\n'
+                          '  <Size Width="{}" Height="{}"/>\n'
+                          '</Image>\n'.format(self.ext, self.tile_size, self.max_width, self.max_height))
+        else:
+            self.mirror_dir = root
+            descriptor = os.path.join(root, 'ImageProperties.xml')
+            num_tiles = sum(x_tiles * y_tiles for x_tiles, y_tiles in self.levels)
+            properties = ('<IMAGE_PROPERTIES WIDTH="{}" HEIGHT="{}" NUMTILES="{}" NUMIMAGES="1" '
+                          'VERSION="1.8" TILESIZE="{}"/>'
+                          .format(self.max_width, self.max_height, num_tiles, self.tile_size))
+
+        tile_positions = [(col, row, level) for level in levels
+                          for col in range(self.levels[level][0]) for row in range(self.levels[level][1])]
+        for directory in set(os.path.dirname(self.mirror_tile_path(*position)) for position in tile_positions):
+            os.makedirs(directory, exist_ok=True)
+        self.completed_tiles = set(position for position in tile_positions
+                                   if os.path.exists(self.mirror_tile_path(*position)))
+        self.num_tiles = len(tile_positions)
+        self.num_downloaded = 0
+        self.log.info("Copying {} tiles of zoom level{} {} to {}, {} of them are already there."
+                      .format(self.num_tiles, '' if len(levels) == 1 else 's', ', '.join(map(str, levels)),
+                              self.mirror_dir, len(self.completed_tiles)))
+
+        download_progressbar = None
+        if progressbar:
+            download_progressbar = progressbar.ProgressBar(
+                widgets=['Downloading tiles: ',
+                         progressbar.Counter(), '/', str(self.num_tiles), ' ',
+                         progressbar.Bar('>', left='[', right=']'), ' ',
+                         progressbar.ETA()],
+                maxval=self.num_tiles
+            ).start()
+        self.num_missing = num_missing = 0
+        for col, row, *_ in self.download_tiles(tile_positions):
+            if col is None:
+                num_missing += 1
+            if download_progressbar:
+                download_progressbar.update(self.num_downloaded)
+        if download_progressbar:
+            download_progressbar.finish()
+        self.completed_tiles = frozenset()
+
+        with open(descriptor + '.part', 'w') as f:
+            f.write(properties)
+        os.replace(descriptor + '.part', descriptor)
+        self.num_missing = num_missing
+        if num_missing > 0:
+            self.log.warning("Image '{}' is missing {} tile{}."
+                             .format(destination, num_missing, '' if num_missing == 1 else 's'))
+        self.log_download_report(destination)
+
+    def get_mirror_levels(self):
+        """Return the sorted zoom levels selected with --levels."""
+        if self.mirror_levels is None:
+            return list(range(self.max_zoom + 1))
+        levels = set()
+        for part in self.mirror_levels.split(','):
+            m = re.match(r'^\s*(-?\d+)\s*(?:-\s*(-?\d+)\s*)?$', part)
+            if not m:
+                self.log.error("Invalid zoom level selection: {}".format(self.mirror_levels))
+                raise ZoomLevelError
+            first, last = [int(level) if level is not None else None for level in m.groups()]
+            if last is None:
+                last = first
+            first, last = [level + self.max_zoom + 1 if level < 0 else level for level in (first, last)]
+            if not (0 <= first <= self.max_zoom and 0 <= last <= self.max_zoom):
+                self.log.error(
+                    "The requested zoom levels {} are not available. Possible values are {} to {}."
+                    .format(part.strip(), -self.max_zoom - 1, self.max_zoom)
+                )
+                raise ZoomLevelError
+            levels.update(range(min(first, last), max(first, last) + 1))
+        return sorted(levels)
+
+    def mirror_tile_path(self, col, row, level):
+        """Return the path of a tile in the copied tile pyramid."""
+        if self.format == 'dzi':
+            dzi_level = self.dzi_max_level - (self.max_zoom - level)
+            return os.path.join(self.mirror_dir, str(dzi_level), '{}_{}.{}'.format(col, row, self.ext))
+        return os.path.join(self.mirror_dir, *self.get_tile_name(col, row, level).split('/'))
+
+    def open_journal(self):
+        """
+        Open the journal of the tiles in the tile directory and find the tiles
+        that were completely downloaded by a previous run.
+        """
+        journal_path = os.path.join(self.tile_dir, 'tiles.journal')
+        journal_exists = os.path.exists(journal_path)
+        self.journal = TileJournal(journal_path, self.zoom_level, self.width, self.height,
+                                   self.x_tiles, self.y_tiles)
+        if self.journal.resumed:
+            self.completed_tiles = self.journal.verified_tiles(self.local_tile_path)
+            self.log.info("{} of {} tiles were already downloaded by a previous run."
+                          .format(len(self.completed_tiles), self.num_tiles))
+        elif self.no_download and not journal_exists:
+            # Tiles stored by older versions have no journal, assume they are complete
+            # and record them, as the next run resumes from the journal just created.
+            self.completed_tiles = set()
+            for col in range(self.x_tiles):
+                for row in range(self.y_tiles):
+                    try:
+                        with open(self.local_tile_path(col, row), 'rb') as f:
+                            data = f.read()
+                    except OSError:
+                        continue
+                    self.journal.mark(col, row, TileJournal.COMPLETE, data)
+                    self.completed_tiles.add((col, row))
+        else:
+            self.completed_tiles = frozenset()
+
+    def run_jpegtran(self, *args):
+        """
+        Run jpegtran with the given arguments and wait for it to finish.
+        Image data can be given as bytes in place of a file name, jpegtran then reads it from a pipe,
+        or from a temporary file on systems without /dev/fd.
+        """
+        args = list(args)
+        pipes = []
+        temporary_files = []
+        for i, arg in enumerate(args):
+            if not isinstance(arg, bytes):
+                continue
+            if os.path.isdir('/dev/fd'):
+                read_fd, write_fd = os.pipe()
+                pipes.append((read_fd, write_fd, arg))
+                args[i] = '/dev/fd/{}'.format(read_fd)
+            else:
+                fhandle, args[i] = tempfile.mkstemp(suffix='.jpg', prefix='tile_', dir=self.tile_dir)
+                with os.fdopen(fhandle, 'wb') as f:
+                    f.write(arg)
+                temporary_files.append(args[i])
+        feeders = []
+        try:
+            try:
+                subproc = subprocess.Popen([self.jpegtran] + args, pass_fds=[pipe[0] for pipe in pipes])
+            finally:
+                for read_fd, _, _ in pipes:
+                    os.close(read_fd)
+            for _, write_fd, data in pipes:
+                feeder = threading.Thread(target=self.feed_pipe, args=(write_fd, data), daemon=True)
+                feeder.start()
+                feeders.append(feeder)
+            pipes = []
+            with self.subprocesses_lock:
+                self.subprocesses.add(subproc)
+            try:
+                return subproc.wait()
+            finally:
+                with self.subprocesses_lock:
+                    self.subprocesses.discard(subproc)
+        finally:
+            for _, write_fd, _ in pipes:
+                os.close(write_fd)
+            for feeder in feeders:
+                feeder.join()
+            for path in temporary_files:
+                os.unlink(path)
+
+    @staticmethod
+    def feed_pipe(write_fd, data):
+        """Write data to a pipe and close it."""
+        try:
+            with open(write_fd, 'wb') as pipe:
+                pipe.write(data)
+        except BrokenPipeError:
+            pass  # jpegtran has stopped reading, it reports the error itself
+
+    def kill_jpegtran(self):
+        """Kill all running jpegtran subprocesses."""
+        with self.subprocesses_lock:
+            for subproc in self.subprocesses:
+                if subproc.poll() is None:
                     subproc.kill()
-                raise
+
+    def blank_image(self, width, height, reference, reference_height, destination):
+        """
+        Create a blank (gray) image with the JPEG parameters of the reference image,
+        which is reference_height pixels high.
+        """
+        # Extend the reference downwards, then crop out the extension.
+        # Start at an offset divisible by the largest possible iMCU height.
+        offset = int(ceil(reference_height / 16.)) * 16
+        fhandle, extended = tempfile.mkstemp(suffix='.jpg', prefix='blank_', dir=self.tile_dir)
+        os.close(fhandle)
+        try:
+            self.run_jpegtran('-copy', 'all',
+                              '-crop', '{:d}x{:d}+0+0'.format(width, offset + height),
+                              '-outfile', extended, reference)
+            self.run_jpegtran('-copy', 'all',
+                              '-crop', '{:d}x{:d}+0+{:d}'.format(width, height, offset),
+                              '-outfile', destination, extended)
+        finally:
+            os.unlink(extended)
+
+    def load_turbojpeg(self):
+        """Load the TurboJPEG library once."""
+        if self.turbojpeg_library is None:
+            self.turbojpeg_library = TurboJPEG(self.turbojpeg)
+            self.log.debug("Loaded the TurboJPEG library {}.".format(self.turbojpeg_library.path))
+        return self.turbojpeg_library
+
+    def tile_source(self, col, row):
+        """Return the data of a downloaded tile if it is kept in memory, or the path of its file."""
+        if self.tile_data is not None:
+            return self.tile_data[col, row]
+        return self.local_tile_path(col, row)
+
+    @staticmethod
+    def read_tile_source(source):
+        """Return the data of a tile given by tile_source."""
+        if isinstance(source, bytes):
+            return source
+        with open(source, 'rb') as f:
+            return f.read()
+
+    def local_tile_path(self, col, row):
+        return os.path.join(self.tile_dir, "{}_{}.{}".format(col, row, self.ext))
+
+    def download_tiles(self, tile_positions):
+        """
+        Download the tiles at the given positions to the tile directory with the selected engine,
+        in the order they are given in, a bounded window of tiles ahead of the consumer at a time.
+
+        Returns an iterator yielding the positions of the tiles in the same order,
+        or (None, None) for tiles that could not be downloaded.
+        """
+        budget = self.retry_budget
+        if budget is None:
+            budget = max(10, self.num_tiles // 10)
+        self.retry_policy = RetryPolicy(self.retries, self.retry_delay, budget)
+        if self.download_slots is not None:
+            self.concurrency = self.download_slots
+        else:
+            min_limit = self.min_threads if self.adaptive else self.nthreads
+            self.concurrency = ConcurrencyController(min_limit, self.nthreads, self.log)
+        self.num_cached = 0
+        scheduler = TileScheduler(tile_positions, self.window)
+        if self.engine == 'asyncio':
+            client = AsyncHTTPClient(maxsize=http_pool.maxsize, timeout=self.timeout)
+            start_async_workers(scheduler, functools.partial(self.download_tile_async, client),
+                                self.nthreads, finalize=client.close)
+        else:
+            start_thread_workers(scheduler, self.download_tile, self.nthreads)
+        return iter(scheduler)
+
+    def tile_failed(self, error, url, col, row):
+        self.num_downloaded += 1
+        if self.journal is not None:
+            self.journal.mark(col, row, TileJournal.MISSING)
+        if isinstance(error, urllib.error.HTTPError) and error.code == 404:
+            self.log.warning(
+                "{}. Tile {} (row {}, col {}) does not exist on the server."
+                .format(error, url, row, col)
+            )
+        else:
+            self.log.warning(
+                "Tile {} (row {}, col {}) could not be downloaded: {}"
+                .format(url, row, col, error)
+            )
+        return (None, None)
+
+    def tile_filled(self, error, url, tile_position, destination, data):
+        col, row = tile_position
+        self.filled_tiles.append(tile_position)
+        self.log.info("Tile {} (row {}, col {}) could not be downloaded ({}), it is filled from zoom level {}."
+                      .format(url, row, col, error, self.zoom_level - 1))
+        return self.save_tile(tile_position, destination, data, journal=False)
+
+    def retry_delay_after(self, error, attempt, url):
+        """Return the delay before retrying a failed tile download, or None if it is not retried."""
+        delay = self.retry_policy.next_delay(attempt, error)
+        if delay is None:
+            if self.retry_policy.exhausted and not self.retry_policy.exhaustion_reported:
+                self.retry_policy.exhaustion_reported = True
+                self.log.warning("The retry budget of {} retries for this image is exhausted, "
+                                 "failed tiles will not be retried anymore.".format(self.retry_policy.budget))
+            self.retry_policy.record(attempt, success=False)
+        else:
+            self.log.debug("Downloading {} failed ({}), retrying in {:.1f} s.".format(url, error, delay))
+        return delay
+
+    def cached_tile(self, url):
+        """Return the tile from the cache, or None. Raises HTTPError if the tile is known to be missing."""
+        if self.cache is None:
+            return None
+        data = self.cache.get(url)
+        if data is not None:
+            self.num_cached += 1
+        return data
+
+    def cache_tile(self, url, data=None, error=None):
+        """Store a downloaded tile in the cache, or remember that it does not exist."""
+        if self.cache is None:
+            return
+        if data is not None:
+            self.cache.put(url, data)
+        elif isinstance(error, urllib.error.HTTPError) and error.code == 404:
+            self.cache.put_missing(url)
+
+    def fetch_tile(self, url):
+        """
+        Return the content of the tile at the URL, from the cache or from the server.
+        Failed downloads are retried according to the retry policy.
+        """
+        data = self.cached_tile(url)
+        if data is not None:
+            return data
+        for attempt in itertools.count():
+            self.concurrency.acquire()
+            start = time.monotonic()
+            try:
+                with open_url(url) as response:
+                    data = response.read()
+                error = None
+            except Exception as e:
+                error = e
+            self.concurrency.release(time.monotonic() - start,
+                                     error is not None and self.retry_policy.is_retryable(error))
+            if error is None:
+                break
+            delay = self.retry_delay_after(error, attempt, url)
+            if delay is None:
+                self.cache_tile(url, error=error)
+                raise error
+            time.sleep(delay)
+        self.retry_policy.record(attempt, success=True)
+        self.cache_tile(url, data)
+        return data
+
+    async def fetch_tile_async(self, client, url):
+        """
+        Like fetch_tile, but downloads with an AsyncHTTPClient. The tile cache is used in
+        threads, as it may wait for its files and for other processes sharing its index.
+        """
+        loop = asyncio.get_running_loop()
+        if self.cache is not None:
+            data = await loop.run_in_executor(None, self.cached_tile, url)
+            if data is not None:
+                return data
+        for attempt in itertools.count():
+            await self.concurrency.acquire_async()
+            start = time.monotonic()
+            try:
+                data = await client.get(url)
+                error = None
+            except Exception as e:
+                error = e
+            self.concurrency.release(time.monotonic() - start,
+                                     error is not None and self.retry_policy.is_retryable(error))
+            if error is None:
+                break
+            delay = self.retry_delay_after(error, attempt, url)
+            if delay is None:
+                if self.cache is not None:
+                    await loop.run_in_executor(None, functools.partial(self.cache_tile, url, error=error))
+                raise error
+            await asyncio.sleep(delay)
+        self.retry_policy.record(attempt, success=True)
+        if self.cache is not None:
+            await loop.run_in_executor(None, self.cache_tile, url, data)
+        return data
+
+    def tile_location(self, tile_position):
+        """
+        Return the URL and the local path of the tile at a (col, row) position of the current
+        zoom level, or at a (col, row, level) position of the tile pyramid being copied.
+        """
+        if len(tile_position) == 3:
+            return self.get_tile_url(*tile_position), self.mirror_tile_path(*tile_position)
+        return self.get_tile_url(*tile_position), self.local_tile_path(*tile_position)
+
+    def save_tile(self, tile_position, destination, data, journal=True):
+        """
+        Keep a downloaded tile in memory, or write it to its local path and record it in the journal.
+        Tiles filled from the lower zoom level are not recorded, so they are downloaded again when resuming.
+        """
+        if self.tile_data is not None and len(tile_position) == 2:
+            self.tile_data[tile_position] = data
+            self.num_downloaded += 1
+            return tile_position
+        # Write to a temporary file first, so a tile file is never left half-written.
+        with open(destination + '.part', 'wb') as out_file:
+            out_file.write(data)
+        os.replace(destination + '.part', destination)
+        if journal and self.journal is not None:
+            self.journal.mark(tile_position[0], tile_position[1], TileJournal.COMPLETE, data)
+        self.num_downloaded += 1
+        return tile_position
+
+    def download_tile(self, tile_position):
+        """Download a single tile. Used by the thread engine."""
+        col, row = tile_position[:2]
+        if tile_position in self.completed_tiles:
+            self.num_downloaded += 1
+            return tile_position
+        url, destination = self.tile_location(tile_position)
+        if not progressbar:
+            self.log.debug("Downloading tile (row {:3}, col {:3})".format(row, col))
+        try:
+            data = self.fetch_tile(url)
+        except Exception as e:
+            filled = self.fill_tile(col, row) if self.fill_missing and len(tile_position) == 2 else None
+            if filled is None:
+                return self.tile_failed(e, url, col, row)
+            return self.tile_filled(e, url, tile_position, destination, filled)
+        return self.save_tile(tile_position, destination, data)
+
+    async def download_tile_async(self, client, tile_position):
+        """Download a single tile with an AsyncHTTPClient. Used by the asyncio engine."""
+        col, row = tile_position[:2]
+        if tile_position in self.completed_tiles:
+            self.num_downloaded += 1
+            return tile_position
+        url, destination = self.tile_location(tile_position)
+        if not progressbar:
+            self.log.debug("Downloading tile (row {:3}, col {:3})".format(row, col))
+        try:
+            data = await self.fetch_tile_async(client, url)
+        except Exception as e:
+            filled = None
+            if self.fill_missing and len(tile_position) == 2:
+                # Filling blocks, so it runs in a thread, fetching the parent tile like the thread engine.
+                filled = await asyncio.get_running_loop().run_in_executor(None, self.fill_tile, col, row)
+            if filled is None:
+                return self.tile_failed(e, url, col, row)
+            return self.tile_filled(e, url, tile_position, destination, filled)
+        return self.save_tile(tile_position, destination, data)
+
+    def fill_tile(self, col, row):
+        """
+        Return a stand-in for the missing tile at (col, row): the quarter of its parent tile in the
+        next lower zoom level that covers it, upscaled twice and cropped to the size of the tile.
+        Pillow resamples the pixels, keeping the quantization tables of the parent tile. Without
+        Pillow, jpegtran upscales in the DCT domain, but the jpegtran of libjpeg 8 and later writes
+        SmartScale images the joiners cannot read, so its tile is only used if it is a standard
+        JPEG image. Returns None if the parent tile is missing too, or if the tile cannot be upscaled.
+        """
+        if self.zoom_level == 0:
+            return None
+        parent = self.parent_tile(col // 2, row // 2)
+        if parent is None:
+            return None
+        width = min(self.tile_size, self.width - col * self.tile_size)
+        height = min(self.tile_size, self.height - row * self.tile_size)
+        x, y = col % 2 * self.tile_size // 2, row % 2 * self.tile_size // 2
+        try:
+            header = JpegHeader(parent)
+        except TurboJPEGError as e:
+            self.log.debug("The parent tile of tile (row {}, col {}) is not usable: {}".format(row, col, e))
+            return None
+        # The quarter, which may be cut short at the edges of the lower level.
+        crop_width, crop_height = min((width + 1) // 2, header.width - x), min((height + 1) // 2, header.height - y)
+        if crop_width <= 0 or crop_height <= 0:
+            return None
+        imcu_width = 8 * max(h for _, h, _, _ in header.components)
+        imcu_height = 8 * max(v for _, _, v, _ in header.components)
+
+        if Image is not None:
+            with Image.open(io.BytesIO(parent)) as image:
+                settings = {'qtables': image.quantization}
+                subsampling = JpegImagePlugin.get_sampling(image)
+                if subsampling != -1:
+                    settings['subsampling'] = subsampling
+                tile = image.resize((width, height), Image.BICUBIC,
+                                    box=(x, y, x + min(width / 2, crop_width), y + min(height / 2, crop_height)))
+            output = io.BytesIO()
+            tile.save(output, 'JPEG', **settings)
+            return output.getvalue()
+        elif self.jpegtran_scales and x % imcu_width == 0 and y % imcu_height == 0:
+            fhandle, quarter = tempfile.mkstemp(suffix='.jpg', prefix='fill_', dir=self.tile_dir)
+            os.close(fhandle)
+            fhandle, scaled = tempfile.mkstemp(suffix='.jpg', prefix='fill_', dir=self.tile_dir)
+            os.close(fhandle)
+            try:
+                if (self.run_jpegtran('-copy', 'all', '-crop', '{}x{}+{}+{}'.format(crop_width, crop_height, x, y),
+                                      '-outfile', quarter, parent) or
+                        self.run_jpegtran('-copy', 'all', '-scale', '2/1', '-outfile', scaled, quarter) or
+                        # Upscaled quarters of odd sizes are a pixel too large.
+                        self.run_jpegtran('-copy', 'all', '-crop', '{}x{}+0+0'.format(
+                            min(width, 2 * crop_width), min(height, 2 * crop_height)), '-outfile', quarter, scaled)):
+                    return None
+                with open(quarter, 'rb') as f:
+                    data = f.read()
             finally:
-                #Delete the temporary images.
-                for i in range(2):
-                    os.unlink(tmpimgs[i])
-                    os.unlink(finalimage[i])
+                os.unlink(quarter)
+                os.unlink(scaled)
+            if not standard_jpeg(data):
+                self.log.debug("Tile (row {}, col {}) cannot be filled: {} did not upscale its parent tile "
+                               "to a standard JPEG image.".format(row, col, self.jpegtran))
+                return None
+            return data
+        return None
 
-        # Select untiling algorithm
-        # if self.algorithm == 'jt_xl':
-            # jplarge(self, joining_progressbar)
-        # elif self.algorithm == 'jt_std':
-            # jpstandard(self, joining_progressbar)
+    def parent_tile(self, col, row):
+        """
+        Return the tile at (col, row) of the next lower zoom level, or None if it cannot be downloaded.
+        Each parent tile is downloaded once, for all of its missing children.
+        """
+        with self.parent_tiles_lock:
+            future = self.parent_tiles.get((col, row))
+            fetching = future is None
+            if fetching:
+                future = self.parent_tiles[col, row] = Future()
+        if fetching:
+            url = self.get_tile_url(col, row, self.zoom_level - 1)
+            try:
+                future.set_result(self.fetch_tile(url))
+            except Exception as e:
+                self.log.debug("Parent tile {} could not be downloaded: {}".format(url, e))
+                future.set_result(None)
+        return future.result()
 
-        jplarge(self, joining_progressbar)
+    def log_download_report(self, output_destination):
+        """Report how many tile downloads of the image had to be retried and how concurrency was tuned."""
+        concurrency = self.concurrency
+        if concurrency.adaptive:
+            self.log.info(
+                "Image '{}': ended with {} simultaneous downloads (ranged from {} to {})."
+                .format(output_destination, concurrency.limit, concurrency.lowest_limit, concurrency.highest_limit)
+            )
+        if self.cache is not None:
+            self.log.info("Image '{}': {} of {} tiles were taken from the cache."
+                          .format(output_destination, self.num_cached, self.num_tiles))
+        if self.filled_tiles:
+            self.log.warning(
+                "Image '{}': {} missing tile{} filled with the upscaled zoom level {}, at these regions "
+                "(width x height + x + y): {}."
+                .format(output_destination, len(self.filled_tiles), ' was' if len(self.filled_tiles) == 1 else 's were',
+                        self.zoom_level - 1, ', '.join(
+                            '{}x{}+{}+{}'.format(min(self.tile_size, self.width - col * self.tile_size),
+                                                 min(self.tile_size, self.height - row * self.tile_size),
+                                                 col * self.tile_size, row * self.tile_size)
+                            for col, row in sorted(self.filled_tiles, key=lambda position: position[::-1]))))
+        policy = self.retry_policy
+        if policy.num_retries > 0:
+            self.log.info(
+                "Image '{}': {} tile download{} retried, {} tile{} recovered, {} failed after retrying."
+                .format(output_destination, policy.num_retries, '' if policy.num_retries == 1 else 's',
+                        policy.num_recovered, '' if policy.num_recovered == 1 else 's', policy.num_failed)
+            )
 
     def get_url_list(self, url, use_list):
         """
-        Return a list of URLs to process and their respective output file names.
+        Return an iterator of the images to process, as (number, URL, output file name) entries,
+        numbered from 1 in the order of the list.
+
+        The list file, or the standard input if url is '-', is read lazily as the entries are
+        taken. With --shard i/N, only the entries numbered i, i + N, i + 2N... are returned,
+        with the same output file names as when the whole list is processed.
         """
         if not use_list:  # if we are dealing with a single object
-            self.image_urls = [url]
-            self.out_names = [self.out]
-
-        else:  # if we are dealing with a file with a list of objects
-            list_file = open(url, 'r')
-            self.image_urls = []  # empty list of directories
-            self.out_names = []
+            return iter([(1, url, self.out)])
+        return self.read_url_list(url)
 
+    def read_url_list(self, path):
+        """Yield the entries of the list file at path, see get_url_list."""
+        list_file = sys.stdin if path == '-' else open(path, 'r')
+        try:
             i = 1
+            number = 0
             for line in list_file:
                 line = line.strip().split('\t', 1)
                 if len(line[0]) > 0 and not line[0].isspace():    #Checks for empty lines - only eith newlines
 
                     if len(line) == 1:
                         root, ext = os.path.splitext(self.out)
-                        self.out_names.append("{}_{:03d}{}".format(root, i, ext))
+                        destination = "{}_{:03d}{}".format(root, i, ext)
                         i += 1
                     elif len(line) == 2:
                         # allow filenames to lack extensions
                         m = re.search('\\.' + self.ext + '$', line[1])
                         if not m:
                             line[1] += '.' + self.ext
-                        self.out_names.append(os.path.join(os.path.dirname(self.out), line[1]))
+                        destination = os.path.join(os.path.dirname(self.out), line[1])
                     else:
                         continue
 
-                    self.image_urls.append(line[0])
-
-            list_file.close()
+                    number += 1
+                    if self.shard is None or (number - 1) % self.shard[1] == self.shard[0] - 1:
+                        yield number, line[0], destination
+        finally:
+            if list_file is not sys.stdin:
+                list_file.close()
 
     def setup_tile_directory(self, in_local_dir, output_file_name=None):
         """
@@ -503,16 +3879,235 @@ class ImageUntiler():
             used to derive the local directory's location
         """
         if in_local_dir:
-            root = os.path.splitext(output_file_name)[0]
+            root = self.tile_directory_name(output_file_name)
 
             if not os.path.exists(root):
                 self.log.debug("Creating image storage directory: {}".format(root))
                 os.makedirs(root)
             self.tile_dir = root
         else:
-            self.tile_dir = tempfile.mkdtemp(prefix='dezoomify_')
+            self.tile_dir = tempfile.mkdtemp(prefix='dezoomify_', dir=self.plan.directory)
             self.log.debug("Created temporary image storage directory: {}".format(self.tile_dir))
 
+    def tile_directory_name(self, output_file_name):
+        """Return the directory the tiles are stored in with -s."""
+        return os.path.splitext(output_file_name)[0]
+
+    def plan_join(self, destination):
+        """
+        Plan how to join the image: estimate the work, peak memory and temporary disk use
+        of each lossless joiner from the image geometry, and choose the joiner and the
+        orientation of the strips that take the least time on the available join workers.
+        An algorithm selected with -a or --format is kept. The temporary files go to the
+        RAM-backed /dev/shm if they fit alongside the joining, to the system's temporary
+        directory otherwise, or next to the output if neither has room. With --region,
+        only the tiles intersecting the region are joined.
+        """
+        if self.format != 'jpeg':
+            candidates = [joiners[self.format]]
+        elif self.algorithm != 'auto':
+            candidates = [joiners[self.algorithm]]
+        else:
+            candidates = [joiner for joiner in joiners.values()
+                          if joiner.format == 'jpeg' and joiner.lossless and joiner.available(self)]
+
+        def rank(image, join_workers):
+            options = []
+            for joiner in candidates:
+                for orientation in joiner.orientations:
+                    serial, parallel = joiner.cost(image, orientation)
+                    options.append((serial + parallel / join_workers, joiner, orientation))
+            # The first of equally fast options wins, so jt_xl for the smallest images.
+            return options, min(options, key=lambda option: option[0])[1:]
+
+        crop = self.get_region()
+        image, region = self, None
+        if crop is not None:
+            x, y, width, height = crop
+            col, row = x // self.tile_size, y // self.tile_size
+            image = region = ImagePiece(self, col, row, (x + width - 1) // self.tile_size - col + 1,
+                                        (y + height - 1) // self.tile_size - row + 1)
+        options, (joiner, orientation) = rank(image, self.join_workers)
+        pixels = image.width * image.height
+        peak_memory = joiner.peak_memory(image, orientation)
+        pieces, parallel = (), 1
+        # Regions are not cut into pieces.
+        if self.max_memory and self.format == 'jpeg' and not region and peak_memory > self.max_memory:
+            pieces, parallel = self.plan_pieces(peak_memory / pixels)
+            options, (joiner, orientation) = rank(pieces[0], max(1, self.join_workers // parallel))
+            # Roughly, as if every piece took as long as the first, largest one.
+            options = [(work * len(pieces) / parallel, joiner, orientation) for work, joiner, orientation in options]
+            peak_memory = parallel * joiner.peak_memory(pieces[0], orientation)
+        storage = pixels * joiner.working_storage_per_pixel
+        if not self.in_memory or self.store:
+            # The downloaded tiles.
+            storage += pixels * jpeg_bytes_per_pixel
+        memory = available_memory()
+
+        if self.store:
+            # The temporary files go to the tile directory.
+            directories = [os.path.dirname(os.path.abspath(self.tile_directory_name(destination)))]
+        else:
+            directories = []
+            if os.path.isdir('/dev/shm') and memory is not None:
+                # Files in /dev/shm take up memory, so they have to fit alongside the joining. Unless the
+                # image is to be kept in memory, leave half of the available memory to the rest of the system.
+                if storage + peak_memory <= (memory if self.in_memory else memory // 2):
+                    directories.append('/dev/shm')
+            directories += [tempfile.gettempdir(), os.path.dirname(os.path.abspath(destination))]
+        room = []
+        for directory in directories:
+            try:
+                room.append((directory, shutil.disk_usage(directory).free))
+            except OSError:
+                pass
+        # The first directory with enough room, or the one with the most.
+        fitting = [entry for entry in room if entry[1] >= storage]
+        directory, free = fitting[0] if fitting else max(room, key=lambda entry: entry[1], default=(None, None))
+        if self.store:
+            directory = self.tile_directory_name(destination)
+        plan = JoinPlan(joiner, orientation, directory, self.format == 'jpeg' and self.algorithm == 'auto',
+                        options, peak_memory, storage, memory, free, pieces, parallel, region, crop)
+        if free is not None and free < storage:
+            plan.warnings.append("The temporary files may need {:.0f} MB, but there are only {:.0f} MB free."
+                                 .format(storage / 1e6, free / 1e6))
+        if memory is not None and peak_memory > memory:
+            plan.warnings.append("Joining may need {:.0f} MB of memory, but only {:.0f} MB are available."
+                                 .format(peak_memory / 1e6, memory / 1e6))
+        if pieces and peak_memory > self.max_memory:
+            plan.warnings.append("Joining single tiles may need {:.0f} MB of memory, more than the {:.0f} MB "
+                                 "allowed by --max-memory.".format(peak_memory / 1e6, self.max_memory / 1e6))
+        if region and self.max_memory and peak_memory > self.max_memory:
+            plan.warnings.append("Joining the region may need {:.0f} MB of memory, more than the {:.0f} MB "
+                                 "allowed by --max-memory.".format(peak_memory / 1e6, self.max_memory / 1e6))
+        return plan
+
+    def get_region(self):
+        """
+        Return the rectangle selected with --region as (x, y, width, height) in pixels at
+        the zoom level, clipped to the image, or None for the whole image.
+        """
+        if self.region is None:
+            return None
+        sizes = (self.width, self.height, self.width, self.height)
+        x, y, width, height = (int(round(value * size)) if isinstance(value, float) else value
+                               for value, size in zip(self.region, sizes))
+        right, bottom = min(x + width, self.width), min(y + height, self.height)
+        if x >= right or y >= bottom:
+            self.log.error("The region {} is outside of the image, which is {} x {} pixels at zoom level {}."
+                           .format(','.join(str(value) for value in self.region), self.width, self.height,
+                                   self.zoom_level))
+            raise ZoomLevelError("The region is outside of the image.")
+        return x, y, right - x, bottom - y
+
+    def fit_zoom_level(self, highest):
+        """
+        Return the highest zoom level up to highest whose image fits in --max-pixels, and whose
+        tiles are estimated to fit in --max-bytes and to download within --deadline, or the lowest
+        level if none does. The estimates come from sample tiles of the highest level fitting
+        in --max-pixels: their size per pixel, and how long they took to fetch, spread over the
+        download threads. Lower levels have more detail per pixel, so their size is underestimated.
+        If all sample tiles come from the tile cache, there is no time to go by and --deadline is not applied.
+        """
+        def pixels(level):
+            width, height = self.level_size(level)
+            return width * height
+
+        def fits(level):
+            x_tiles, y_tiles = self.levels[level]
+            return ((not self.max_bytes or pixels(level) * bytes_per_pixel <= self.max_bytes) and
+                    (not self.deadline or seconds_per_tile is None or
+                     x_tiles * y_tiles * seconds_per_tile / self.nthreads <= self.deadline))
+
+        level = highest
+        while level > 0 and self.max_pixels and pixels(level) > self.max_pixels:
+            level -= 1
+        estimate = self.sample_level(level) if self.max_bytes or self.deadline else None
+        if estimate is not None:
+            bytes_per_pixel, seconds_per_tile = estimate
+            while level > 0 and not fits(level):
+                level -= 1
+            x_tiles, y_tiles = self.levels[level]
+            summary = ", about {:.1f} MB of tiles".format(pixels(level) * bytes_per_pixel / 1e6)
+            if seconds_per_tile is not None:
+                summary += " in {:.0f} s".format(x_tiles * y_tiles * seconds_per_tile / self.nthreads)
+        else:
+            summary = ''
+        if (self.max_pixels and pixels(level) > self.max_pixels) or (estimate is not None and not fits(level)):
+            self.log.warning("Even the lowest zoom level exceeds the budget, using zoom level 0.")
+        else:
+            self.log.info("Zoom level {} of {} fits the budget: {} x {} pixels{}.".format(
+                level, self.max_zoom, *self.level_size(level), summary))
+        return level
+
+    def sample_level(self, level):
+        """
+        Fetch a few tiles spread over a zoom level and return the bytes per pixel of the tiles
+        and the seconds a tile took to download on average, or None if none could be fetched.
+        With --cache the tiles are taken from the cache if they are in it, and cached otherwise,
+        so they are not downloaded again. The seconds are None if all of them came from the cache.
+        """
+        x_tiles, y_tiles = self.levels[level]
+        width, height = self.level_size(level)
+        count = min(self.num_sample_tiles, x_tiles * y_tiles)
+        # Along the diagonal, away from the edges.
+        positions = sorted(set((x_tiles * (2 * i + 1) // (2 * count), y_tiles * (2 * i + 1) // (2 * count))
+                               for i in range(count)))
+
+        def fetch(position):
+            url = self.get_tile_url(*position, level=level)
+            start = time.monotonic()
+            try:
+                data = self.cache.get(url) if self.cache is not None else None
+                # Tiles from the cache tell nothing about the download time.
+                elapsed = None
+                if data is None:
+                    with open_url(url) as response:
+                        data = response.read()
+                    elapsed = time.monotonic() - start
+                    self.cache_tile(url, data)
+            except Exception as e:
+                self.log.debug("Sample tile {} could not be fetched: {}".format(url, e))
+                return None
+            col, row = position
+            tile_pixels = (min(self.tile_size, width - col * self.tile_size) *
+                           min(self.tile_size, height - row * self.tile_size))
+            return len(data), tile_pixels, elapsed
+
+        with ThreadPoolExecutor(max_workers=len(positions)) as executor:
+            samples = [sample for sample in executor.map(fetch, positions) if sample is not None]
+        if not samples:
+            self.log.warning("None of the sample tiles of zoom level {} could be fetched, "
+                             "only --max-pixels is applied.".format(level))
+            return None
+        sizes, tile_pixels, seconds = zip(*samples)
+        seconds = [elapsed for elapsed in seconds if elapsed is not None]
+        seconds_per_tile = sum(seconds) / len(seconds) if seconds else None
+        self.log.debug("Sampled {} tiles of zoom level {}: {:.2f} bytes per pixel, {}.".format(
+            len(samples), level, sum(sizes) / sum(tile_pixels),
+            "{:.2f} s per tile".format(seconds_per_tile) if seconds else "all from the cache"))
+        return sum(sizes) / sum(tile_pixels), seconds_per_tile
+
+    def plan_pieces(self, bytes_per_pixel):
+        """
+        Cut the image into pieces of whole tiles, each joined within the --max-memory budget:
+        bands of full rows of tiles if a row of tiles fits, a mosaic of square pieces otherwise.
+        The pieces are made small enough to join several of them at a time, as many as there are
+        join workers for if possible. Returns the pieces, in the order they are joined,
+        and the number of pieces joined at a time.
+        """
+        tile_bytes = self.tile_size ** 2 * bytes_per_pixel
+        band_bytes = self.width * self.tile_size * bytes_per_pixel
+        parallel = min(self.join_workers, int(self.max_memory // band_bytes))
+        if parallel >= 1:
+            x_tiles, y_tiles = self.x_tiles, int(self.max_memory // parallel // band_bytes)
+        else:
+            parallel = max(1, min(self.join_workers, int(self.max_memory // tile_bytes)))
+            x_tiles = y_tiles = max(1, isqrt(int(self.max_memory // parallel // tile_bytes)))
+        pieces = [ImagePiece(self, col, row, x_tiles, y_tiles)
+                  for row in range(0, self.y_tiles, y_tiles) for col in range(0, self.x_tiles, x_tiles)]
+        return pieces, min(parallel, len(pieces))
+
 
 class UntilerDezoomify(ImageUntiler):
     def get_base_directory(self, url):
@@ -527,16 +4122,25 @@ class UntilerDezoomify(ImageUntiler):
         """
 
         try:
-            with open_url(url) as handle:
-                content = handle.read().decode(errors='ignore')
+            content = self.read_url(url)
         except Exception as e:
             self.log.error(
                 "Specified directory not found ({}).\n"
                 "Check the URL: {}"
                 .format(e, url)
             )
-            raise FileNotFoundError
+            raise FileNotFoundError("Specified directory not found ({}).".format(e))
+
+        base_dir = self.find_base_directory(url, content)
+        if base_dir is None:
+            self.log.error("Zoomify base directory not found. "
+                           "Ensure the given URL contains a Zoomify object.\n"
+                           "If that does not work, see \"Troubleshooting\" (http://sourceforge.net/p/dezoomify/wiki/Troubleshooting/) for additional help.")
+            raise FileNotFoundError("Zoomify base directory not found.")
+        return base_dir
 
+    def find_base_directory(self, url, content):
+        """Return the Zoomify image base directory found in the HTML code of the page at url, or None."""
         image_path = None
         image_path_regexes = [
             ('zoomifyImagePath=([^\'"&]*)[\'"&]', 1),
@@ -552,10 +4156,7 @@ class UntilerDezoomify(ImageUntiler):
                 break
 
         if not image_path:
-            self.log.error("Zoomify base directory not found. "
-                           "Ensure the given URL contains a Zoomify object.\n"
-                           "If that does not work, see \"Troubleshooting\" (http://sourceforge.net/p/dezoomify/wiki/Troubleshooting/) for additional help.")
-            raise FileNotFoundError
+            return None
 
         self.log.debug("Found ZoomifyImagePath: {}".format(image_path))
 
@@ -584,14 +4185,13 @@ class UntilerDezoomify(ImageUntiler):
         self.log.debug("xml_url=" + xml_url)
         content = None
         try:
-            with open_url(xml_url) as handle:
-                content = handle.read().decode(errors='ignore')
+            content = self.read_url(xml_url)
         except Exception:
             self.log.error(
                 "Could not open ImageProperties.xml ({}).\n"
                 "URL: {}".format(sys.exc_info()[1], xml_url)
             )
-            raise FileNotFoundError
+            raise FileNotFoundError("Could not open ImageProperties.xml ({}).".format(sys.exc_info()[1]))
 
         # example: <IMAGE_PROPERTIES WIDTH="2679" HEIGHT="4000" NUMTILES="241" NUMIMAGES="1" VERSION="1.8" TILESIZE="256"/>
         properties = dict(re.findall(r"\b(\w+)\s*=\s*[\"']([^\"']*)[\"']", content))
@@ -615,11 +4215,12 @@ class UntilerDezoomify(ImageUntiler):
                 "The requested zoom level {} is not available. Possible values are {} to {}."
                 .format(zoom_level, -self.max_zoom - 1, self.max_zoom)
             )
-            raise ZoomLevelError
+            raise ZoomLevelError("The requested zoom level {} is not available.".format(zoom_level))
+        if (self.max_pixels or self.max_bytes or self.deadline) and self.format not in ('dzi', 'zoomify'):
+            self.zoom_level = self.fit_zoom_level(self.zoom_level)
 
         # GET THE SIZE AT THE REQUESTED ZOOM LEVEL
-        self.width  = int(self.max_width  / 2 ** (self.max_zoom - self.zoom_level))
-        self.height = int(self.max_height / 2 ** (self.max_zoom - self.zoom_level))
+        self.width, self.height = self.level_size(self.zoom_level)
 
         # GET THE NUMBER OF TILES AT THE REQUESTED ZOOM LEVEL
         self.maxx_tiles, self.maxy_tiles = self.levels[-1]
@@ -633,7 +4234,6 @@ class UntilerDezoomify(ImageUntiler):
         self.log.debug('\tHeight (in tiles): {:d} (at given level: {:d})'.format(self.maxy_tiles, self.y_tiles))
         self.log.debug('\tTotal tiles:       {:d} (to be retrieved: {:d})'.format(self.maxx_tiles * self.maxy_tiles,
                                                                                  self.x_tiles * self.y_tiles))
-        # self.log.debug("\tUsing {} joining algorithm.".format(self.algorithm))
 
     def get_zoom_levels(self):
         """Construct a list of all zoomlevels with sizes in tiles"""
@@ -655,6 +4255,11 @@ class UntilerDezoomify(ImageUntiler):
         self.levels.reverse()
         self.log.debug("self.levels = {}".format(self.levels))
 
+    def level_size(self, level):
+        """Return the width and height of the image at a zoom level."""
+        return (int(self.max_width / 2 ** (self.max_zoom - level)),
+                int(self.max_height / 2 ** (self.max_zoom - level)))
+
     def get_tile_index(self, level, x, y):
         """
         Get the zoomify index of a tile in a given level, at given co-ordinates
@@ -667,22 +4272,30 @@ class UntilerDezoomify(ImageUntiler):
         Returns -- the zoomify index
         """
 
-        index = x + y * int(ceil(floor(self.width / pow(2, self.max_zoom - level)) / self.tile_size))
+        index = x + y * self.levels[level][0]
 
-        for i in range(level):
-            index += int(ceil(floor(self.width / pow(2, self.max_zoom - i)) / self.tile_size)) * \
-                     int(ceil(floor(self.height / pow(2, self.max_zoom - i)) / self.tile_size))
+        for width_in_tiles, height_in_tiles in self.levels[:level]:
+            index += width_in_tiles * height_in_tiles
 
         return index
 
-    def get_tile_url(self, col, row):
+    def get_tile_name(self, col, row, level):
         """
-        Return the full URL of an image at a given position in the Zoomify structure.
+        Return the path of an image at a given position in the Zoomify structure,
+        relative to the base directory.
         """
-        tile_index = self.get_tile_index(self.zoom_level, col, row)
+        tile_index = self.get_tile_index(level, col, row)
         tile_group = tile_index // self.tile_size
-        url = self.base_dir + 'TileGroup{}/{}-{}-{}.{}'.format(tile_group, self.zoom_level, col, row, self.ext)
-        return url
+        return 'TileGroup{}/{}-{}-{}.{}'.format(tile_group, level, col, row, self.ext)
+
+    def get_tile_url(self, col, row, level=None):
+        """
+        Return the full URL of an image at a given position in the Zoomify structure,
+        at the current zoom level by default.
+        """
+        if level is None:
+            level = self.zoom_level
+        return self.base_dir + self.get_tile_name(col, row, level)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+"""
+Compare the download engines on a local Zoomify test server.
+
+The server answers every tile request after a fixed delay, simulating a
+high-latency host. Only the downloading stage is timed, tiles are not joined.
+
+Usage: python benchmark_download_engines.py [-W WIDTH] [-H HEIGHT] [--latency SECONDS]
+                                            [-t THREADS [THREADS ...]] [--adaptive]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, '..')))
+import dezoomify
+
+
+class ZoomifyRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.endswith('ImageProperties.xml'):
+            body = '<IMAGE_PROPERTIES WIDTH="{}" HEIGHT="{}" NUMTILES="0" NUMIMAGES="1" VERSION="1.8" TILESIZE="256"/>' \
+                .format(self.server.width, self.server.height).encode()
+        else:
+            time.sleep(self.server.latency)
+            body = self.server.tile
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ZoomifyServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class DownloadBenchmark(dezoomify.UntilerDezoomify):
+    """Runs the untiler, but only downloads the tiles and records how long that took."""
+
+    def untile_image(self, output_destination):
+        self.num_tiles = self.x_tiles * self.y_tiles
+        self.num_downloaded = 0
+        tile_positions = ((col, row) for col in range(self.x_tiles) for row in range(self.y_tiles))
+        start = time.perf_counter()
+        for _ in self.download_tiles(tile_positions):
+            pass
+        self.elapsed = time.perf_counter() - start
+
+
+def main():
+    bench_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    bench_parser.add_argument('-W', dest='width', type=int, default=8192)
+    bench_parser.add_argument('-H', dest='height', type=int, default=8192)
+    bench_parser.add_argument('--latency', type=float, default=0.05)
+    bench_parser.add_argument('--tile-bytes', dest='tile_bytes', type=int, default=20000)
+    bench_parser.add_argument('-t', dest='nthreads', type=int, nargs='+', default=[16, 64, 256])
+    bench_parser.add_argument('--adaptive', action='store_true',
+                              help='tune the number of simultaneous downloads, using THREADS as the maximum')
+    bench_parser.add_argument('-j', dest='jpegtran')
+    bench_args = bench_parser.parse_args()
+
+    server = ZoomifyServer(('127.0.0.1', 0), ZoomifyRequestHandler)
+    server.width, server.height = bench_args.width, bench_args.height
+    server.latency = bench_args.latency
+    server.tile = os.urandom(bench_args.tile_bytes)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+    tempdir = tempfile.mkdtemp(prefix='dezoomify_bench_')
+    try:
+        print('{:>8} {:>8} {:>10} {:>10}'.format('engine', 'threads', 'seconds', 'tiles/s'))
+        for nthreads in bench_args.nthreads:
+            for engine in ('thread', 'asyncio'):
+                command = [base_url, os.path.join(tempdir, 'img.jpg'), '-b',
+                           '--engine', engine, '-t', str(nthreads)]
+                if bench_args.adaptive:
+                    command.append('--adaptive')
+                if bench_args.jpegtran:
+                    command += ['-j', bench_args.jpegtran]
+                benchmark = DownloadBenchmark(dezoomify.parser.parse_args(command))
+                print('{:>8} {:>8} {:>10.2f} {:>10.1f}'.format(
+                    engine, nthreads, benchmark.elapsed, benchmark.num_tiles / benchmark.elapsed))
+    finally:
+        shutil.rmtree(tempdir)
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
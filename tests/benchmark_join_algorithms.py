@@ -0,0 +1,102 @@
+"""
+Compare the joining algorithms on synthetic tile grids.
+
+Every tile of a grid is a copy of the same JPEG tile (TILE, which should be 256x256 pixels),
+with the edge tiles cropped from it. The tiles are put where -s would have stored them and
+the image is created with -x, so only the joining is timed.
+
+Usage: python benchmark_join_algorithms.py TILE [-g COLSxROWS [COLSxROWS ...]]
+                                                [-a ALGORITHM [ALGORITHM ...]] [-j JPEGTRAN]
+                                                [--turbojpeg LIBRARY]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, '..')))
+import dezoomify
+
+TILE_SIZE = 256
+# The edge tiles are cut short by this many pixels.
+EDGE_CUT = 56
+
+
+class PropertiesRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = '<IMAGE_PROPERTIES WIDTH="{}" HEIGHT="{}" NUMTILES="0" NUMIMAGES="1" VERSION="1.8" TILESIZE="{}"/>' \
+            .format(self.server.width, self.server.height, TILE_SIZE).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_tiles(jpegtran, tile, tile_dir, cols, rows):
+    """Fill tile_dir with the tiles of a cols x rows grid."""
+    os.makedirs(tile_dir)
+    edge = TILE_SIZE - EDGE_CUT
+    variants = {}
+    for width, height in ((TILE_SIZE, TILE_SIZE), (edge, TILE_SIZE), (TILE_SIZE, edge), (edge, edge)):
+        path = os.path.join(tile_dir, 'variant_{}x{}.jpg'.format(width, height))
+        subprocess.check_call([jpegtran, '-copy', 'all', '-crop', '{}x{}+0+0'.format(width, height),
+                               '-outfile', path, tile])
+        variants[width, height] = path
+    for col in range(cols):
+        for row in range(rows):
+            size = (edge if col == cols - 1 else TILE_SIZE, edge if row == rows - 1 else TILE_SIZE)
+            shutil.copyfile(variants[size], os.path.join(tile_dir, '{}_{}.jpg'.format(col, row)))
+    for path in variants.values():
+        os.unlink(path)
+
+
+def main():
+    bench_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    bench_parser.add_argument('tile', metavar='TILE')
+    bench_parser.add_argument('-g', dest='grids', nargs='+', default=['4x4', '8x8', '16x16', '32x24'])
+    bench_parser.add_argument('-a', dest='algorithms', nargs='+', default=dezoomify.algorithm_option.choices)
+    bench_parser.add_argument('-j', dest='jpegtran', default=None)
+    bench_parser.add_argument('--turbojpeg', dest='turbojpeg', default=None)
+    bench_args = bench_parser.parse_args()
+    jpegtran = bench_args.jpegtran or os.path.join(SCRIPT_DIR, '..', 'jpegtran')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PropertiesRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+    tempdir = tempfile.mkdtemp(prefix='dezoomify_bench_')
+    try:
+        print('{:>8} {:>10} {:>10} {:>12}'.format('grid', 'algorithm', 'seconds', 'output MB'))
+        for grid in bench_args.grids:
+            cols, rows = (int(n) for n in grid.split('x'))
+            server.width = cols * TILE_SIZE - EDGE_CUT
+            server.height = rows * TILE_SIZE - EDGE_CUT
+            for algorithm in bench_args.algorithms:
+                output = os.path.join(tempdir, '{}_{}.jpg'.format(grid, algorithm))
+                make_tiles(jpegtran, bench_args.tile, os.path.splitext(output)[0], cols, rows)
+                command = [base_url, output, '-b', '-x', '-a', algorithm, '-j', jpegtran]
+                if bench_args.turbojpeg:
+                    command += ['--turbojpeg', bench_args.turbojpeg]
+                start = time.perf_counter()
+                dezoomify.UntilerDezoomify(dezoomify.parser.parse_args(command))
+                elapsed = time.perf_counter() - start
+                print('{:>8} {:>10} {:>10.2f} {:>12.1f}'.format(
+                    grid, algorithm, elapsed, os.path.getsize(output) / 1e6))
+                shutil.rmtree(os.path.splitext(output)[0])
+    finally:
+        shutil.rmtree(tempdir)
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
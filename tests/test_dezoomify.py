@@ -1,9 +1,20 @@
 import unittest
+import asyncio
+import ctypes
+import ctypes.util
+import functools
+import json
 import sys
 import os
 import tempfile
 import shutil
+import struct
+import subprocess
+import threading
+import time
+import unittest.mock
 from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 PACKAGE_PARENT = '..'
 SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
@@ -14,6 +25,15 @@ def run_dezoomify(command):
     args = dezoomify.parser.parse_args(command.split())
     dezoomify.UntilerDezoomify(args)
 
+def marked_jpeg(number, width, height, qtable=1):
+    """A gray JPEG image with its number in a comment marker."""
+    header = object.__new__(dezoomify.JpegHeader)
+    header.components = [(1, 2, 2, 0), (2, 1, 1, 1), (3, 1, 1, 1)]
+    header.qtables = {0: (qtable,) * 64, 1: (2,) * 64}
+    comment = str(number).encode()
+    header.markers = [b'\xff\xfe' + struct.pack('>H', len(comment) + 2) + comment]
+    return dezoomify.blank_jpeg(header, width, height)
+
 testimage_url = 'http://www.bl.uk/onlinegallery/onlineex/apac/photocoll/s/zoomify64430.html'
 # Hash of image at testimage_url, zoom level 1.
 # This hash might change depending on the jpegtran implementation, I guess.
@@ -76,5 +96,1298 @@ class TestZoomLevels(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.tempdir_path)
 
+class CountingRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.num_connections += 1
+
+    def do_GET(self):
+        if self.path == '/stall':
+            time.sleep(1)
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = self.server.drop_connections
+
+    def log_message(self, *args):
+        pass
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), CountingRequestHandler)
+        self.server.num_connections = 0
+        self.server.drop_connections = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        self.pool = dezoomify.HTTPConnectionPool(maxsize=2)
+
+    def test_connection_reuse(self):
+        for i in range(10):
+            with self.pool.request(self.base_url + str(i), {}) as response:
+                self.assertEqual(response.read(), '/{}'.format(i).encode())
+        self.assertEqual(self.server.num_connections, 1)
+
+    def test_reconnect_after_server_close(self):
+        # The server silently drops every connection after one request, like an idle timeout would.
+        self.server.drop_connections = True
+        for i in range(3):
+            self.assertEqual(self.pool.request(self.base_url + str(i), {}).read(), '/{}'.format(i).encode())
+        self.assertEqual(self.server.num_connections, 3)
+
+    def test_async_client(self):
+        async def fetch_all():
+            client = dezoomify.AsyncHTTPClient(maxsize=2)
+            bodies = [await client.get(self.base_url + str(i)) for i in range(5)]
+            await client.close()
+            return bodies
+        self.assertEqual(asyncio.run(fetch_all()), [('/' + str(i)).encode() for i in range(5)])
+        self.assertEqual(self.server.num_connections, 1)
+
+    def test_timeout(self):
+        # A stalled server fails the download with a retryable error, in both engines.
+        policy = dezoomify.RetryPolicy(retries=3, delay=0, budget=10)
+        self.pool.timeout = 0.2
+        with self.assertRaises(dezoomify.urllib.error.URLError) as raised:
+            self.pool.request(self.base_url + 'stall', {})
+        self.assertIsInstance(raised.exception.reason, TimeoutError)
+        self.assertTrue(policy.is_retryable(raised.exception))
+
+        async def fetch():
+            client = dezoomify.AsyncHTTPClient(timeout=0.2)
+            try:
+                await client.get(self.base_url + 'stall')
+            finally:
+                await client.close()
+        with self.assertRaises(dezoomify.urllib.error.URLError) as raised:
+            asyncio.run(fetch())
+        self.assertIsInstance(raised.exception.reason, TimeoutError)
+        self.assertTrue(policy.is_retryable(raised.exception))
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+class TestTileScheduler(unittest.TestCase):
+
+    def test_thread_workers_keep_order(self):
+        scheduler = dezoomify.TileScheduler(range(50), window=8)
+        dezoomify.start_thread_workers(scheduler, lambda x: x * x, 4)
+        self.assertEqual(list(scheduler), [x * x for x in range(50)])
+
+    def test_async_workers_keep_order(self):
+        async def square(x):
+            await asyncio.sleep(0.001 * (x % 3))
+            return x * x
+        scheduler = dezoomify.TileScheduler(range(50), window=8)
+        dezoomify.start_async_workers(scheduler, square, 16)
+        self.assertEqual(list(scheduler), [x * x for x in range(50)])
+
+    def test_window_is_bounded(self):
+        scheduler = dezoomify.TileScheduler(range(1000), window=5)
+        handed_out = []
+        dezoomify.start_thread_workers(scheduler, handed_out.append, 4)
+        for i, _ in enumerate(scheduler):
+            # The joiner is slow, the workers must not run ahead of it.
+            time.sleep(0.001)
+            self.assertLessEqual(len(handed_out), i + 1 + 5)
+        self.assertEqual(len(handed_out), 1000)
+
+    def test_exceptions_are_reraised(self):
+        scheduler = dezoomify.TileScheduler(range(5), window=5)
+        dezoomify.start_thread_workers(scheduler, lambda x: 1 // (x - 3), 2)
+        with self.assertRaises(ZeroDivisionError):
+            list(scheduler)
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def http_error(self, code):
+        return dezoomify.urllib.error.HTTPError('http://example.com/', code, '', {}, None)
+
+    def test_retryable_errors(self):
+        policy = dezoomify.RetryPolicy(retries=3, delay=0.5, budget=10)
+        self.assertIsNone(policy.next_delay(0, self.http_error(404)))
+        self.assertIsNotNone(policy.next_delay(0, self.http_error(503)))
+        self.assertIsNotNone(policy.next_delay(0, dezoomify.urllib.error.URLError(ConnectionResetError())))
+        self.assertIsNone(policy.next_delay(3, self.http_error(503)))
+
+    def test_exponential_backoff(self):
+        policy = dezoomify.RetryPolicy(retries=5, delay=1, budget=100)
+        for attempt in range(5):
+            delay = policy.next_delay(attempt, self.http_error(500))
+            self.assertTrue(2 ** attempt / 2 <= delay <= 2 ** attempt)
+
+    def test_budget(self):
+        policy = dezoomify.RetryPolicy(retries=3, delay=0, budget=2)
+        self.assertIsNotNone(policy.next_delay(0, self.http_error(500)))
+        self.assertIsNotNone(policy.next_delay(0, self.http_error(500)))
+        self.assertIsNone(policy.next_delay(0, self.http_error(500)))
+        self.assertTrue(policy.exhausted)
+
+class TestConcurrencyController(unittest.TestCase):
+
+    def complete(self, controller, count, latency=0.01, congested=False):
+        for _ in range(count):
+            self.assertTrue(controller.try_acquire())
+            controller.release(latency, congested)
+
+    def test_fixed_limit(self):
+        controller = dezoomify.ConcurrencyController(16, 16)
+        self.assertFalse(controller.adaptive)
+        self.complete(controller, 100, congested=True)
+        self.assertEqual(controller.limit, 16)
+
+    def test_slow_start_and_decrease(self):
+        controller = dezoomify.ConcurrencyController(2, 64)
+        self.assertEqual(controller.limit, 2)
+        self.complete(controller, 8)
+        self.assertEqual(controller.limit, 4)
+        self.complete(controller, 8, congested=True)
+        self.assertEqual(controller.limit, 2)
+        self.assertFalse(controller.slow_start)
+
+    def test_limit_is_enforced(self):
+        controller = dezoomify.ConcurrencyController(1, 3)
+        self.assertTrue(controller.try_acquire())
+        self.assertFalse(controller.try_acquire())
+
+    def test_shared_by_event_loops(self):
+        controller = dezoomify.ConcurrencyController(2, 2)
+        in_flight = []
+
+        async def download():
+            await controller.acquire_async()
+            in_flight.append(controller.in_flight)
+            await asyncio.sleep(0.001)
+            controller.release(0.001, False)
+
+        async def downloads():
+            await asyncio.gather(*(download() for _ in range(20)))
+
+        threads = [threading.Thread(target=asyncio.run, args=(downloads(),)) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        self.assertEqual(len(in_flight), 60)
+        self.assertLessEqual(max(in_flight), 2)
+        self.assertEqual(controller.in_flight, 0)
+
+    def test_shared_with_threads(self):
+        # A thread waiting for a slot is woken up by a download of an event loop, and the other way around.
+        controller = dezoomify.ConcurrencyController(1, 1)
+        acquired = threading.Event()
+
+        def thread_download():
+            controller.acquire()
+            acquired.set()
+            time.sleep(0.01)
+            controller.release(0.01, False)
+
+        async def downloads():
+            await controller.acquire_async()
+            thread = threading.Thread(target=thread_download, daemon=True)
+            thread.start()
+            await asyncio.sleep(0.01)
+            self.assertFalse(acquired.is_set())
+            controller.release(0.01, False)
+            # Waits for the slot the thread took.
+            await asyncio.get_running_loop().run_in_executor(None, acquired.wait, 10)
+            await controller.acquire_async()
+            controller.release(0.01, False)
+            thread.join(timeout=10)
+
+        asyncio.run(downloads())
+        self.assertEqual(controller.in_flight, 0)
+
+class TestTileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir_path = tempfile.mkdtemp(prefix='dezoomify_test_')
+        self.cache = dezoomify.TileCache(self.tempdir_path, max_size=250, missing_ttl=60)
+
+    def test_put_get(self):
+        self.assertIsNone(self.cache.get('http://example.com/a.jpg'))
+        self.assertFalse(self.cache.contains('http://example.com/a.jpg'))
+        self.cache.put('http://example.com/a.jpg', b'a' * 100)
+        self.assertEqual(self.cache.get('http://example.com/a.jpg'), b'a' * 100)
+        self.assertTrue(self.cache.contains('http://example.com/a.jpg'))
+        # The cache persists across instances.
+        cache = dezoomify.TileCache(self.tempdir_path, max_size=250, missing_ttl=60)
+        self.assertEqual(cache.get('http://example.com/a.jpg'), b'a' * 100)
+        cache.close()
+
+    def test_corrupt_file_is_discarded(self):
+        self.cache.put('http://example.com/a.jpg', b'a' * 100)
+        with open(self.cache._path(self.cache._key('http://example.com/a.jpg')), 'wb') as f:
+            f.write(b'a' * 50)
+        self.assertIsNone(self.cache.get('http://example.com/a.jpg'))
+
+    def test_lru_eviction(self):
+        self.cache.put('http://example.com/a.jpg', b'a' * 100)
+        self.cache.put('http://example.com/b.jpg', b'b' * 100)
+        self.cache.get('http://example.com/a.jpg')
+        self.cache.put('http://example.com/c.jpg', b'c' * 100)
+        self.assertIsNone(self.cache.get('http://example.com/b.jpg'))
+        self.assertIsNotNone(self.cache.get('http://example.com/a.jpg'))
+        self.assertIsNotNone(self.cache.get('http://example.com/c.jpg'))
+        self.assertLessEqual(self.cache.size, 250)
+
+    def test_shared_size(self):
+        # Another process using the same cache directory.
+        other = dezoomify.TileCache(self.tempdir_path, max_size=250, missing_ttl=60)
+        self.cache.put('http://example.com/a.jpg', b'a' * 100)
+        other.put('http://example.com/b.jpg', b'b' * 100)
+        self.cache.put('http://example.com/a.jpg', b'a' * 100)
+        self.assertEqual((self.cache.size, other.size), (200, 200))
+        other.put('http://example.com/c.jpg', b'c' * 100)
+        self.assertEqual(self.cache.size, 200)
+        self.assertIsNone(self.cache.get('http://example.com/b.jpg'))
+        other.close()
+
+    def test_used_off_the_event_loop(self):
+        untiler = object.__new__(dezoomify.ImageUntiler)
+        untiler.cache, untiler.num_cached = unittest.mock.Mock(), 0
+        untiler.concurrency = dezoomify.ConcurrencyController(1, 1)
+        untiler.retry_policy = dezoomify.RetryPolicy(retries=0, delay=0, budget=0)
+        threads = []
+        untiler.cache.get.side_effect = lambda url: threads.append(threading.get_ident())
+        untiler.cache.put.side_effect = lambda url, data: threads.append(threading.get_ident())
+        client = unittest.mock.Mock()
+
+        async def get(url):
+            return b'tile'
+        client.get = get
+
+        async def fetch():
+            return threading.get_ident(), await untiler.fetch_tile_async(client, 'http://example.com/a.jpg')
+
+        loop_thread, data = asyncio.run(fetch())
+        self.assertEqual(data, b'tile')
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(loop_thread, threads)
+
+    def test_missing_tiles(self):
+        self.cache.put_missing('http://example.com/a.jpg')
+        with self.assertRaises(dezoomify.urllib.error.HTTPError):
+            self.cache.get('http://example.com/a.jpg')
+        self.assertFalse(self.cache.contains('http://example.com/a.jpg'))
+        self.cache.missing_ttl = -1
+        self.cache.put_missing('http://example.com/b.jpg')
+        self.assertIsNone(self.cache.get('http://example.com/b.jpg'))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tempdir_path)
+
+class TestBatchState(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir_path = tempfile.mkdtemp(prefix='dezoomify_test_')
+        self.state_path = os.path.join(self.tempdir_path, 'state.sqlite')
+        self.state = dezoomify.BatchState(self.state_path)
+
+    def test_records(self):
+        image = ('http://example.com/a/', -1, 'out_001.jpg')
+        self.assertIsNone(self.state.status(*image))
+        self.state.start(*image)
+        self.assertEqual(self.state.status(*image), dezoomify.BatchState.RUNNING)
+        self.assertFalse(self.state.done(*image))
+        self.state.finish(*image, dezoomify.BatchState.PARTIAL, level=4, width=3000, height=2100,
+                          tiles=108, missing_tiles=12, filled_tiles=3, size=250000)
+        self.assertTrue(self.state.done(*image))
+        # Another zoom level of the same image is another entry.
+        self.assertIsNone(self.state.status('http://example.com/a/', 3, 'out_001.jpg'))
+        self.state.start('http://example.com/b/', -1, 'out_002.jpg')
+        self.state.finish('http://example.com/b/', -1, 'out_002.jpg', dezoomify.BatchState.FAILED, error='Not found')
+        # The state persists across instances.
+        state = dezoomify.BatchState(self.state_path)
+        records = state.records(-1)
+        state.close()
+        self.assertEqual(set(records), {('http://example.com/a/', 'out_001.jpg'), ('http://example.com/b/', 'out_002.jpg')})
+        self.assertEqual(records['http://example.com/a/', 'out_001.jpg'][:5], ['partial', 108, 12, 3, 250000])
+        self.assertGreaterEqual(records['http://example.com/a/', 'out_001.jpg'][5], 0)
+        self.assertEqual(records['http://example.com/b/', 'out_002.jpg'][0], 'failed')
+        self.assertEqual(records['http://example.com/b/', 'out_002.jpg'][-1], 'Not found')
+        self.assertFalse(self.state.done('http://example.com/b/', -1, 'out_002.jpg'))
+
+    def test_background_optimization(self):
+        untiler = object.__new__(dezoomify.UntilerDezoomify)
+        untiler.log = dezoomify.logging.getLogger(__name__)
+        untiler.state, untiler.plan_only, untiler.requested_zoom_level, untiler.format = self.state, False, -1, 'jpeg'
+        untiler.background, untiler.background_jobs = dezoomify.ThreadPoolExecutor(max_workers=1), []
+        optimizing = threading.Event()
+
+        def process_image(image_url, destination):
+            untiler.plan = unittest.mock.Mock(pieces=[])
+            untiler.zoom_level, untiler.width, untiler.height, untiler.num_tiles = 2, 500, 400, 4
+            untiler.num_missing, untiler.filled_tiles = 0, []
+            unoptimized = destination + '.unoptimized'
+            with open(unoptimized, 'wb') as f:
+                f.write(b'\xff\xd8 image')
+            untiler.optimize_later(unoptimized, destination)
+
+        def optimize_image(source, destination):
+            optimizing.wait(10)
+            if destination.endswith('b.jpg'):
+                raise OSError('No space left on device')
+            os.rename(source, destination)
+
+        images = [('http://example.com/{}/'.format(name), -1, os.path.join(self.tempdir_path, name + '.jpg'))
+                  for name in 'ab']
+        with unittest.mock.patch.object(untiler, 'process_image', side_effect=process_image), \
+                unittest.mock.patch.object(untiler, 'optimize_image', side_effect=optimize_image):
+            for image in images:
+                untiler.process_recorded_image(image[0], image[2])
+            # The images are not done until they are optimized.
+            self.assertEqual([self.state.status(*image) for image in images], [dezoomify.BatchState.RUNNING] * 2)
+            optimizing.set()
+            untiler.finish_background()
+        records = self.state.records(-1)
+        self.assertEqual(records['http://example.com/a/', images[0][2]][:5], ['complete', 4, 0, 0, 8])
+        self.assertEqual(records['http://example.com/b/', images[1][2]][0], 'failed')
+        self.assertEqual(records['http://example.com/b/', images[1][2]][-1], 'No space left on device')
+        # The image that could not be optimized is not left behind.
+        self.assertEqual([name for name in os.listdir(self.tempdir_path) if not name.startswith('state.')], ['a.jpg'])
+
+    def tearDown(self):
+        self.state.close()
+        shutil.rmtree(self.tempdir_path)
+
+class TestUrlList(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir_path = tempfile.mkdtemp(prefix='dezoomify_test_')
+        self.list_path = os.path.join(self.tempdir_path, 'list.txt')
+        with open(self.list_path, 'w') as f:
+            f.write('http://example.com/a/\n\nhttp://example.com/b/\tb\nhttp://example.com/c/\n'
+                    'http://example.com/d/\nhttp://example.com/e/\td.jpg\n')
+        self.untiler = object.__new__(dezoomify.UntilerDezoomify)
+        self.untiler.out = os.path.join('images', 'img.jpg')
+        self.untiler.ext = 'jpg'
+
+    def test_shards_keep_names(self):
+        self.untiler.shard = None
+        entries = list(self.untiler.get_url_list(self.list_path, True))
+        self.assertEqual(entries, [(1, 'http://example.com/a/', os.path.join('images', 'img_001.jpg')),
+                                   (2, 'http://example.com/b/', os.path.join('images', 'b.jpg')),
+                                   (3, 'http://example.com/c/', os.path.join('images', 'img_002.jpg')),
+                                   (4, 'http://example.com/d/', os.path.join('images', 'img_003.jpg')),
+                                   (5, 'http://example.com/e/', os.path.join('images', 'd.jpg'))])
+        self.untiler.shard = dezoomify.parse_shard('2/2')
+        self.assertEqual(list(self.untiler.get_url_list(self.list_path, True)), entries[1::2])
+        self.untiler.shard = dezoomify.parse_shard('1/2')
+        self.assertEqual(list(self.untiler.get_url_list(self.list_path, True)), entries[0::2])
+        self.assertRaises(dezoomify.argparse.ArgumentTypeError, dezoomify.parse_shard, '0/2')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir_path)
+
+class TestTileJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir_path = tempfile.mkdtemp(prefix='dezoomify_test_')
+        self.journal_path = os.path.join(self.tempdir_path, 'tiles.journal')
+
+    def tile_path(self, col, row):
+        return os.path.join(self.tempdir_path, '{}_{}.jpg'.format(col, row))
+
+    def write_tile(self, journal, col, row, data):
+        with open(self.tile_path(col, row), 'wb') as f:
+            f.write(data)
+        journal.mark(col, row, dezoomify.TileJournal.COMPLETE, data)
+
+    def test_resume(self):
+        journal = dezoomify.TileJournal(self.journal_path, 2, 600, 500, 3, 2)
+        self.assertFalse(journal.resumed)
+        self.write_tile(journal, 0, 0, b'tile 0 0')
+        self.write_tile(journal, 2, 1, b'tile 2 1')
+        self.write_tile(journal, 1, 1, b'tile 1 1')
+        journal.mark(1, 0, dezoomify.TileJournal.MISSING)
+        journal.close()
+        # Simulate a tile that was being rewritten when the program was killed.
+        with open(self.tile_path(1, 1), 'wb') as f:
+            f.write(b'tile')
+
+        journal = dezoomify.TileJournal(self.journal_path, 2, 600, 500, 3, 2)
+        self.assertTrue(journal.resumed)
+        self.assertEqual(journal.verified_tiles(self.tile_path), {(0, 0), (2, 1)})
+        self.assertEqual(journal.entry(1, 0)[0], dezoomify.TileJournal.MISSING)
+        journal.close()
+
+    def test_other_zoom_level_starts_over(self):
+        journal = dezoomify.TileJournal(self.journal_path, 2, 600, 500, 3, 2)
+        self.write_tile(journal, 0, 0, b'tile 0 0')
+        journal.close()
+        journal = dezoomify.TileJournal(self.journal_path, 1, 300, 250, 2, 1)
+        self.assertFalse(journal.resumed)
+        self.assertEqual(journal.verified_tiles(self.tile_path), set())
+        journal.close()
+
+    def test_tiles_without_journal(self):
+        # Tiles stored by an older version, used with -x twice.
+        untiler = object.__new__(dezoomify.ImageUntiler)
+        untiler.tile_dir, untiler.ext, untiler.log = self.tempdir_path, 'jpg', unittest.mock.Mock()
+        untiler.zoom_level, untiler.width, untiler.height = 2, 600, 500
+        untiler.x_tiles, untiler.y_tiles, untiler.num_tiles = 3, 2, 6
+        untiler.no_download = True
+        for col, row in ((0, 0), (2, 1)):
+            with open(self.tile_path(col, row), 'wb') as f:
+                f.write(b'tile')
+        for run in range(2):
+            untiler.open_journal()
+            self.assertEqual(untiler.completed_tiles, {(0, 0), (2, 1)})
+            untiler.journal.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir_path)
+
+class TestRunJpegtran(unittest.TestCase):
+    def setUp(self):
+        self.tempdir_path = tempfile.mkdtemp()
+        self.untiler = object.__new__(dezoomify.ImageUntiler)
+        self.untiler.subprocesses = set()
+        self.untiler.subprocesses_lock = threading.Lock()
+        self.untiler.tile_dir = self.tempdir_path
+
+    @unittest.skipUnless(shutil.which('cat'), 'cat is not available')
+    def test_image_data_arguments(self):
+        # cat stands in for jpegtran, concatenating the files it is given.
+        self.untiler.jpegtran = shutil.which('cat')
+        destination = os.path.join(self.tempdir_path, 'out')
+        first = os.urandom(200000)  # more than fits into a pipe buffer
+        with open(destination, 'wb') as f:
+            with unittest.mock.patch('subprocess.Popen', functools.partial(subprocess.Popen, stdout=f)):
+                self.assertEqual(self.untiler.run_jpegtran(first, b'second'), 0)
+        with open(destination, 'rb') as f:
+            self.assertEqual(f.read(), first + b'second')
+        self.assertEqual(os.listdir(self.tempdir_path), ['out'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir_path)
+
+
+class TestTilePyramid(unittest.TestCase):
+    def make_untiler(self, zoom_level):
+        untiler = object.__new__(dezoomify.UntilerDezoomify)
+        untiler.log = dezoomify.logging.getLogger(__name__)
+        untiler.max_width, untiler.max_height, untiler.tile_size = 10000, 7000, 256
+        untiler.get_zoom_levels()
+        untiler.max_zoom = len(untiler.levels) - 1
+        untiler.zoom_level = zoom_level
+        untiler.width = untiler.max_width // 2 ** (untiler.max_zoom - zoom_level)
+        untiler.height = untiler.max_height // 2 ** (untiler.max_zoom - zoom_level)
+        untiler.base_dir = 'http://example.com/image/'
+        untiler.ext = 'jpg'
+        return untiler
+
+    def test_tile_groups_independent_of_zoom_level(self):
+        untiler = self.make_untiler(zoom_level=6)
+        self.assertEqual(untiler.levels, [(1, 1), (2, 1), (3, 2), (5, 4), (10, 7), (20, 14), (40, 28)])
+        # Tile 379 + 2 * 40 + 3 = 462, after the 1 + 2 + 6 + 20 + 70 + 280 tiles of the lower levels.
+        self.assertEqual(untiler.get_tile_url(3, 2), 'http://example.com/image/TileGroup1/6-3-2.jpg')
+        self.assertEqual(untiler.get_tile_url(3, 2, 5), 'http://example.com/image/TileGroup0/5-3-2.jpg')
+        self.assertEqual(self.make_untiler(zoom_level=3).get_tile_url(3, 2, 6), untiler.get_tile_url(3, 2))
+        self.assertEqual(untiler.get_tile_name(39, 27, 6), 'TileGroup5/6-39-27.jpg')
+
+    def test_mirror_levels(self):
+        untiler = self.make_untiler(zoom_level=6)
+        untiler.mirror_levels = None
+        self.assertEqual(untiler.get_mirror_levels(), list(range(7)))
+        untiler.mirror_levels = '0-2, 4,-1'
+        self.assertEqual(untiler.get_mirror_levels(), [0, 1, 2, 4, 6])
+        untiler.mirror_levels = '-3--2'
+        self.assertEqual(untiler.get_mirror_levels(), [4, 5])
+        untiler.mirror_levels = '7'
+        self.assertRaises(dezoomify.ZoomLevelError, untiler.get_mirror_levels)
+
+    def test_mirror_image(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            for image_format in ('dzi', 'zoomify'):
+                untiler = self.make_untiler(zoom_level=6)
+                untiler.format, untiler.mirror_levels, untiler.log = image_format, '0-2', unittest.mock.Mock()
+                destination = os.path.join(tempdir, image_format + '.jpg')
+                untiler.tile_data, untiler.fill_missing = None, False
+                requested = []
+
+                def fetch_tile(url):
+                    requested.append(url)
+                    if url == untiler.get_tile_url(2, 1, 2):
+                        raise OSError('Not found')
+                    return url.encode()
+
+                # Tile (1, 0) of level 1 is already there.
+                untiler.mirror_dir = os.path.join(tempdir, 'dzi_files' if image_format == 'dzi' else 'zoomify')
+                untiler.dzi_max_level = 14
+                os.makedirs(os.path.dirname(untiler.mirror_tile_path(1, 0, 1)))
+                with open(untiler.mirror_tile_path(1, 0, 1), 'w') as f:
+                    f.write('1-0-1')
+                with unittest.mock.patch.object(untiler, 'download_tiles', lambda positions: map(
+                        untiler.download_tile, positions)), \
+                        unittest.mock.patch.object(untiler, 'fetch_tile', fetch_tile), \
+                        unittest.mock.patch.object(untiler, 'log_download_report'), \
+                        unittest.mock.patch.object(dezoomify, 'progressbar', None):
+                    untiler.mirror_image(destination)
+                self.assertEqual(len(requested), 1 + 1 + 6)
+                self.assertNotIn(untiler.get_tile_url(1, 0, 1), requested)
+                # Every tile is where its URL belongs.
+                for col, row, level in [(0, 0, 0), (0, 0, 1)] + [(col, 0, 2) for col in range(3)]:
+                    with open(untiler.mirror_tile_path(col, row, level), 'rb') as f:
+                        self.assertEqual(f.read(), untiler.get_tile_url(col, row, level).encode())
+                self.assertEqual((untiler.num_tiles, untiler.num_missing), (9, 1))
+                files = {os.path.relpath(os.path.join(directory, name), tempdir)
+                         for directory, _, names in os.walk(tempdir) for name in names}
+                if image_format == 'dzi':
+                    # 10000 x 7000 pixels is Deep Zoom level 14, level 2 is two levels below level 4 of 2500 x 1750.
+                    self.assertEqual({name for name in files if name.startswith('dzi')}, {
+                        'dzi.dzi', os.path.join('dzi_files', '8', '0_0.jpg'),
+                        os.path.join('dzi_files', '9', '0_0.jpg'), os.path.join('dzi_files', '9', '1_0.jpg')} |
+                        {os.path.join('dzi_files', '10', '{}_{}.jpg'.format(col, row))
+                         for col in range(3) for row in range(2) if (col, row) != (2, 1)})
+                    with open(os.path.join(tempdir, 'dzi.dzi')) as f:
+                        self.assertEqual(f.read(), '<?xml version="1.0" encoding="UTF-8"?>\n'
+                                                   '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+                                                   'Format="jpg" Overlap="0" TileSize="256">\n'
+                                                   '  <Size Width="10000" Height="7000"/>\n'
+                                                   '</Image>\n')
+                else:
+                    self.assertEqual({name for name in files if name.startswith('zoomify')}, {
+                        os.path.join('zoomify', 'ImageProperties.xml'),
+                        os.path.join('zoomify', 'TileGroup0', '0-0-0.jpg'),
+                        os.path.join('zoomify', 'TileGroup0', '1-0-0.jpg'),
+                        os.path.join('zoomify', 'TileGroup0', '1-1-0.jpg')} |
+                        {os.path.join('zoomify', 'TileGroup0', '2-{}-{}.jpg'.format(col, row))
+                         for col in range(3) for row in range(2) if (col, row) != (2, 1)})
+                    # The tiles of all levels of the image are counted, not only the copied ones.
+                    with open(os.path.join(tempdir, 'zoomify', 'ImageProperties.xml')) as f:
+                        self.assertEqual(f.read(), '<IMAGE_PROPERTIES WIDTH="10000" HEIGHT="7000" NUMTILES="1499" '
+                                                   'NUMIMAGES="1" VERSION="1.8" TILESIZE="256"/>')
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_fit_zoom_level(self):
+        untiler = self.make_untiler(zoom_level=6)
+        untiler.max_bytes = untiler.deadline = None
+        untiler.nthreads = 16
+        # 5000 x 3500 pixels at level 5.
+        untiler.max_pixels = 20 * 10 ** 6
+        self.assertEqual(untiler.fit_zoom_level(6), 5)
+        untiler.max_pixels = 10
+        self.assertEqual(untiler.fit_zoom_level(6), 0)
+        untiler.max_pixels, untiler.max_bytes = None, 2 * 10 ** 6
+        with unittest.mock.patch.object(untiler, 'sample_level', return_value=(0.25, 0.1)) as sample_level:
+            # 2500 x 1750 pixels at level 4, a quarter of a byte each.
+            self.assertEqual(untiler.fit_zoom_level(6), 4)
+            sample_level.assert_called_once_with(6)
+            # 20 x 14 tiles at level 5, a tenth of a second each on 16 threads.
+            untiler.max_bytes, untiler.deadline = None, 2.0
+            self.assertEqual(untiler.fit_zoom_level(6), 5)
+            self.assertEqual(untiler.fit_zoom_level(3), 3)
+
+    def test_sample_level_uses_cache(self):
+        untiler = self.make_untiler(zoom_level=6)
+        untiler.cache = unittest.mock.Mock()
+        # Two of the four sample tiles are cached.
+        untiler.cache.get.side_effect = lambda url: b'c' * 1000 if url.endswith(('/4-3-2.jpg', '/4-8-6.jpg')) else None
+        with unittest.mock.patch.object(dezoomify, 'open_url',
+                                        side_effect=lambda url: dezoomify.io.BytesIO(b'd' * 1000)) as opened:
+            bytes_per_pixel, seconds_per_tile = untiler.sample_level(4)
+        self.assertEqual(opened.call_count, 2)
+        self.assertEqual(untiler.cache.put.call_count, 2)
+        self.assertIsNotNone(seconds_per_tile)
+        untiler.cache.get.side_effect = lambda url: b'c' * 1000
+        with unittest.mock.patch.object(dezoomify, 'open_url') as opened:
+            self.assertEqual(untiler.sample_level(4)[1], None)
+        opened.assert_not_called()
+
+    def test_prefetch_metadata(self):
+        untiler = self.make_untiler(zoom_level=6)
+        untiler.base, untiler.prefetched = False, {}
+        pages = {'http://example.com/a.html': b'<param name="zoomifyImagePath=image/">',
+                 'http://example.com/image/ImageProperties.xml': b'<IMAGE_PROPERTIES/>'}
+
+        def open_url(url):
+            if url not in pages:
+                raise OSError('HTTP Error 404')
+            return dezoomify.io.BytesIO(pages[url])
+
+        with unittest.mock.patch.object(dezoomify, 'open_url', side_effect=open_url) as opened, \
+                dezoomify.ThreadPoolExecutor(max_workers=2) as executor:
+            untiler.prefetch_metadata('http://example.com/a.html', executor)
+            untiler.prefetch_metadata('http://example.com/b.html', executor)
+            # The XML is read as soon as the page is, while it may still be being prefetched.
+            self.assertEqual(untiler.get_base_directory('http://example.com/a.html'), 'http://example.com/image/')
+            self.assertEqual(untiler.read_url('http://example.com/image/ImageProperties.xml'), '<IMAGE_PROPERTIES/>')
+            # The error of the prefetched page is reported when it is read.
+            self.assertRaises(OSError, untiler.read_url, 'http://example.com/b.html')
+            self.assertEqual(opened.call_count, 3)
+            self.assertEqual(untiler.prefetched, {})
+
+    @unittest.skipUnless(dezoomify.Image, 'Pillow is not installed')
+    def test_fill_tile(self):
+        untiler = self.make_untiler(zoom_level=6)
+        # Pillow is used even if jpegtran can scale.
+        untiler.jpegtran_scales = True
+        untiler.parent_tiles, untiler.parent_tiles_lock = {}, threading.Lock()
+        parent = dezoomify.Image.new('RGB', (256, 256))
+        for i, color in enumerate(((255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255))):
+            parent.paste(color, (i % 2 * 128, i // 2 * 128, i % 2 * 128 + 128, i // 2 * 128 + 128))
+        output = dezoomify.io.BytesIO()
+        parent.save(output, 'JPEG', quality=90)
+        with unittest.mock.patch.object(untiler, 'fetch_tile', return_value=output.getvalue()) as fetch_tile:
+            # The top right quarter of parent tile (1, 0).
+            tile = dezoomify.Image.open(dezoomify.io.BytesIO(untiler.fill_tile(3, 0)))
+            self.assertEqual(tile.size, (256, 256))
+            self.assertTrue(all(abs(a - b) < 8 for a, b in zip(tile.getpixel((128, 128)), (0, 255, 0))))
+            # The bottom left quarter, of the same parent tile.
+            tile = dezoomify.Image.open(dezoomify.io.BytesIO(untiler.fill_tile(2, 1)))
+            self.assertTrue(all(abs(a - b) < 8 for a, b in zip(tile.getpixel((128, 128)), (0, 0, 255))))
+            header = dezoomify.JpegHeader(untiler.fill_tile(3, 1))
+            self.assertTrue(header.standard_blocks())
+            self.assertEqual(header.frame, 0xC0)
+        fetch_tile.assert_called_once_with(untiler.get_tile_url(1, 0, 5))
+        with unittest.mock.patch.object(untiler, 'fetch_tile', side_effect=OSError):
+            self.assertIsNone(untiler.fill_tile(0, 2))
+
+    def test_fill_tile_with_jpegtran(self):
+        untiler = self.make_untiler(zoom_level=6)
+        untiler.jpegtran_scales, untiler.jpegtran = True, 'jpegtran'
+        untiler.parent_tiles, untiler.parent_tiles_lock = {}, threading.Lock()
+        untiler.tile_dir = tempfile.mkdtemp()
+        header = object.__new__(dezoomify.JpegHeader)
+        header.components, header.qtables, header.markers = [(1, 1, 1, 0)], {0: (1,) * 64}, []
+        standard = dezoomify.blank_jpeg(header, 256, 256)
+        outputs = []
+
+        def run_jpegtran(*args):
+            with open(args[args.index('-outfile') + 1], 'wb') as f:
+                f.write(outputs.pop(0))
+            return 0
+
+        try:
+            with unittest.mock.patch.object(untiler, 'fetch_tile', return_value=standard), \
+                    unittest.mock.patch.object(untiler, 'run_jpegtran', side_effect=run_jpegtran) as run, \
+                    unittest.mock.patch.object(dezoomify, 'Image', None):
+                outputs[:] = [standard, standard, standard]
+                self.assertEqual(untiler.fill_tile(3, 0), standard)
+                self.assertEqual(run.call_args_list[1][0][:4], ('-copy', 'all', '-scale', '2/1'))
+                # The SmartScale tiles of the jpegtran of libjpeg 8 and later are not used.
+                outputs[:] = [standard, self.smartscale_jpeg(), self.smartscale_jpeg()]
+                self.assertIsNone(untiler.fill_tile(2, 1))
+            self.assertEqual(os.listdir(untiler.tile_dir), [])
+        finally:
+            shutil.rmtree(untiler.tile_dir)
+
+    def test_scales(self):
+        self.assertEqual(dezoomify.parse_scales('1/2, 3/8,2/8'),
+                         [dezoomify.Fraction(1, 2), dezoomify.Fraction(3, 8), dezoomify.Fraction(1, 4)])
+        for scales in ('1/3', '2/2', '1/16', '1/2,half'):
+            self.assertRaises(dezoomify.argparse.ArgumentTypeError, dezoomify.parse_scales, scales)
+        untiler = self.make_untiler(zoom_level=6)
+        untiler.scales = dezoomify.parse_scales('1/2,1/4')
+        untiler.plan = unittest.mock.Mock(region=None)
+        untiler.jpegtran_scales, untiler.optimize, untiler.jpegtran = True, 'final', 'jpegtran'
+        untiler.cache = unittest.mock.Mock()
+        # Only zoom level 4 is in the cache.
+        untiler.cache.contains = lambda url: '/4-' in url
+        tempdir = tempfile.mkdtemp()
+        try:
+            destination = os.path.join(tempdir, 'out.jpg')
+            smartscale = self.smartscale_jpeg()
+
+            def run_jpegtran(*args):
+                with open(args[args.index('-outfile') + 1], 'wb') as f:
+                    f.write(smartscale)
+                return 0
+
+            def join_cached_level(level, path):
+                with open(path, 'wb') as f:
+                    f.write(smartscale)
+
+            with unittest.mock.patch.object(untiler, 'join_cached_level', side_effect=join_cached_level) as join, \
+                    unittest.mock.patch.object(untiler, 'run_jpegtran', side_effect=run_jpegtran) as run, \
+                    unittest.mock.patch.object(dezoomify, 'Image', None):
+                untiler.write_scaled_images(destination)
+            join.assert_called_once_with(4, os.path.join(tempdir, 'out_1-4.jpg'))
+            run.assert_called_once_with('-copy', 'all', '-optimize', '-scale', '1/2',
+                                        '-outfile', os.path.join(tempdir, 'out_1-2.jpg'), destination)
+            # jpegtran wrote a SmartScale image, which is not kept.
+            self.assertEqual(os.listdir(tempdir), ['out_1-4.jpg'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def smartscale_jpeg(self):
+        """A JPEG image marked as the SmartScale images of jpegtran -scale are, with 4x4 blocks."""
+        header = object.__new__(dezoomify.JpegHeader)
+        header.components, header.qtables, header.markers = [(1, 1, 1, 0)], {0: (1,) * 64}, []
+        image = bytearray(dezoomify.blank_jpeg(header, 16, 16))
+        image[image.index(b'\xff\xc0') + 1] = 0xC1
+        sos = image.index(b'\xff\xda')
+        image[sos + 8] = 15
+        return bytes(image)
+
+    @unittest.skipUnless(dezoomify.Image, 'Pillow is not installed')
+    def test_scales_with_pillow(self):
+        untiler = self.make_untiler(zoom_level=6)
+        untiler.scales = dezoomify.parse_scales('1/2,3/8')
+        untiler.plan = unittest.mock.Mock(region=None)
+        untiler.jpegtran_scales, untiler.optimize, untiler.cache = True, 'final', None
+        tempdir = tempfile.mkdtemp()
+        try:
+            destination = os.path.join(tempdir, 'out.jpg')
+            dezoomify.Image.new('RGB', (400, 300), (200, 40, 40)).save(destination, 'JPEG')
+            with unittest.mock.patch.object(untiler, 'run_jpegtran') as run_jpegtran:
+                untiler.write_scaled_images(destination)
+            run_jpegtran.assert_not_called()
+            for name, size in (('out_1-2.jpg', (200, 150)), ('out_3-8.jpg', (150, 113))):
+                with dezoomify.Image.open(os.path.join(tempdir, name)) as image:
+                    image.load()
+                    self.assertEqual(image.size, size)
+                self.assertTrue(dezoomify.standard_jpeg_file(os.path.join(tempdir, name)))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_standard_jpeg(self):
+        header = object.__new__(dezoomify.JpegHeader)
+        header.components, header.qtables, header.markers = [(1, 1, 1, 0)], {0: (1,) * 64}, []
+        self.assertTrue(dezoomify.standard_jpeg(dezoomify.blank_jpeg(header, 16, 16)))
+        self.assertFalse(dezoomify.standard_jpeg(self.smartscale_jpeg()))
+        self.assertFalse(dezoomify.standard_jpeg(b'not a JPEG image'))
+
+
+class TestBigTiffWriter(unittest.TestCase):
+    def setUp(self):
+        self.tempdir_path = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir_path, 'image.tif')
+
+    def read_tags(self):
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        self.assertEqual(content[:8], b'II\x2b\x00\x08\x00\x00\x00')
+        directory, = struct.unpack_from('<Q', content, 8)
+        num_entries, = struct.unpack_from('<Q', content, directory)
+        tags = {}
+        for i in range(num_entries):
+            tag, value_type, count = struct.unpack_from('<HHQ', content, directory + 8 + 20 * i)
+            value_format = '<' + dezoomify.BigTiffWriter.formats[value_type] * count
+            if struct.calcsize(value_format) > 8:
+                offset, = struct.unpack_from('<Q', content, directory + 20 + 20 * i)
+            else:
+                offset = directory + 20 + 20 * i
+            tags[tag] = struct.unpack_from(value_format, content, offset)
+        return content, tags
+
+    def test_tiles(self):
+        writer = dezoomify.BigTiffWriter(self.path, 600, 300, 256)
+        writer.write_tile([(2, 0)], b'tile 2 0')
+        writer.write_tile([(0, 0)], b'tile 0 0')
+        writer.write_tile([(1, 1)], b'tile 1 1')
+        self.assertEqual(writer.missing_tiles(), [(1, 0), (0, 1), (2, 1)])
+        writer.write_tile(writer.missing_tiles(), b'blank')
+        writer.close([(259, dezoomify.BigTiffWriter.SHORT, [7]),
+                      (532, dezoomify.BigTiffWriter.RATIONAL, [0, 1, 255, 1])])
+
+        content, tags = self.read_tags()
+        self.assertEqual(sorted(tags), [256, 257, 259, 322, 323, 324, 325, 532])
+        self.assertEqual((tags[256], tags[257], tags[322], tags[323]), ((600,), (300,), (256,), (256,)))
+        self.assertEqual(tags[532], (0, 1, 255, 1))
+        tiles = [content[offset:offset + size] for offset, size in zip(tags[324], tags[325])]
+        self.assertEqual(tiles, [b'tile 0 0', b'blank', b'tile 2 0', b'blank', b'tile 1 1', b'blank'])
+
+    def test_joiner(self):
+        untiler = object.__new__(dezoomify.UntilerDezoomify)
+        untiler.x_tiles, untiler.y_tiles, untiler.tile_size, untiler.width, untiler.height = 3, 2, 256, 668, 412
+        untiler.plan, untiler.log = unittest.mock.Mock(orientation='columns'), unittest.mock.Mock()
+        untiler.tile_dir, untiler.zoom_level, untiler.num_tiles = self.tempdir_path, 3, 6
+        untiler.progress_lock, untiler.num_joined = threading.Lock(), 0
+        # Tile (1, 0) is missing.
+        untiler.tile_data = {(col, row): marked_jpeg(1 + col + 3 * row, min(256, 668 - 256 * col),
+                                                     min(256, 412 - 256 * row))
+                             for col in range(3) for row in range(2) if (col, row) != (1, 0)}
+        untiler.downloaded_iterator = iter([(col, row) if (col, row) in untiler.tile_data else (None, None)
+                                            for col in range(3) for row in range(2)])
+        untiler.load_turbojpeg = unittest.mock.Mock(side_effect=dezoomify.TurboJPEGError("No TurboJPEG."))
+
+        def run_jpegtran(*args):
+            # Extend the edge tile, given as data, to the full tile size.
+            number = int(dezoomify.JpegHeader(args[-1]).markers[0][4:])
+            with open(args[args.index('-outfile') + 1], 'wb') as f:
+                f.write(marked_jpeg(number, 256, 256))
+            return 0
+
+        untiler.run_jpegtran = unittest.mock.Mock(side_effect=run_jpegtran)
+        dezoomify.BigTiffJoiner(untiler, self.path, lambda: None, lambda: None).join()
+
+        content, tags = self.read_tags()
+        self.assertEqual((tags[256], tags[257], tags[322], tags[323]), ((668,), (412,), (256,), (256,)))
+        self.assertEqual((tags[259], tags[262]), ((7,), (6,)))
+        tiles = [dezoomify.JpegHeader(content[offset:offset + size]) for offset, size in zip(tags[324], tags[325])]
+        self.assertTrue(all((tile.width, tile.height) == (256, 256) for tile in tiles))
+        # The tiles are stored by rows, the missing one is a blank tile.
+        self.assertEqual(content[tags[324][1]:tags[324][1] + tags[325][1]],
+                         dezoomify.blank_jpeg(dezoomify.JpegHeader(marked_jpeg(1, 256, 256)), 256, 256))
+        self.assertEqual([int(tile.markers[0][4:]) for i, tile in enumerate(tiles) if i != 1], [1, 3, 4, 5, 6])
+        # Only the edge tiles are extended.
+        self.assertEqual(untiler.run_jpegtran.call_count, 4)
+        self.assertEqual({call[0][:4] for call in untiler.run_jpegtran.call_args_list},
+                         {('-copy', 'none', '-crop', '256x256+0+0')})
+        self.assertEqual(untiler.num_joined, 5)
+        self.assertEqual(untiler.tile_data, {})
+        self.assertEqual(os.listdir(self.tempdir_path), ['image.tif'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir_path)
+
+
+class TestTurboJPEG(unittest.TestCase):
+    def make_header(self):
+        header = object.__new__(dezoomify.JpegHeader)
+        header.components = [(1, 2, 2, 0), (2, 1, 1, 1), (3, 1, 1, 1)]
+        header.qtables = {0: tuple(range(1, 65)), 1: (300,) * 64}
+        header.markers = [b'\xff\xfe\x00\x06test']
+        return header
+
+    def test_blank_jpeg_header(self):
+        header = dezoomify.JpegHeader(dezoomify.blank_jpeg(self.make_header(), 100, 60))
+        self.assertEqual((header.precision, header.width, header.height), (8, 100, 60))
+        self.assertEqual(header.components, self.make_header().components)
+        self.assertEqual(header.qtables, self.make_header().qtables)
+        self.assertEqual(header.markers, [b'\xff\xfe\x00\x06test'])
+        self.assertEqual(header.blocks(100, 60), [(13, 8), (7, 4), (7, 4)])
+
+    @unittest.skipUnless(os.environ.get('TURBOJPEG') or ctypes.util.find_library('turbojpeg'),
+                         'the TurboJPEG library is not available')
+    def test_coefficients_round_trip(self):
+        turbojpeg = dezoomify.TurboJPEG(os.environ.get('TURBOJPEG'))
+        blank = dezoomify.blank_jpeg(self.make_header(), 100, 60)
+        rows = []
+
+        def fill(address, component, block_row, width_in_blocks):
+            row = (ctypes.c_short * (64 * width_in_blocks)).from_address(address)
+            for block in range(width_in_blocks):
+                row[64 * block] = component * 10 + block_row - block
+                row[64 * block + 9] = block % 3
+            rows.append(bytes(row))
+
+        image = turbojpeg.transform(blank, fill, optimize=True)
+        self.assertEqual(len(rows), 8 + 4 + 4)
+        read = []
+        turbojpeg.transform(image, lambda address, component, block_row, width_in_blocks:
+                            read.append(ctypes.string_at(address, 128 * width_in_blocks)), output=False)
+        self.assertEqual(read, rows)
+        # Written straight to a file.
+        with tempfile.TemporaryFile() as f:
+            turbojpeg.transform(blank, fill, output=f, optimize=True)
+            f.seek(0)
+            self.assertEqual(f.read(), image)
+
+
+class TestJoiners(unittest.TestCase):
+    def test_registry(self):
+        self.assertEqual(dezoomify.algorithm_option.choices, ['auto', 'jt_xl', 'jt_tree', 'tj_mem', 'pil'])
+        for joiner in dezoomify.joiners.values():
+            self.assertTrue(joiner.memory and joiner.cpu, joiner.name)
+        self.assertEqual(dezoomify.parser.parse_args(['url', 'out', '-a', 'pil']).algorithm, 'pil')
+
+    def make_untiler(self, x_tiles, y_tiles, algorithm='auto'):
+        untiler = object.__new__(dezoomify.UntilerDezoomify)
+        untiler.x_tiles, untiler.y_tiles, untiler.tile_size = x_tiles, y_tiles, 256
+        untiler.width, untiler.height = 256 * x_tiles - 100, 256 * y_tiles - 100
+        untiler.algorithm, untiler.format = algorithm, 'jpeg'
+        untiler.store, untiler.in_memory, untiler.join_workers = False, False, 4
+        untiler.max_memory = untiler.region = None
+        return untiler
+
+    def test_plan(self):
+        with unittest.mock.patch.object(dezoomify.TurboJPEGJoiner, 'available', return_value=False):
+            plan = self.make_untiler(2, 2).plan_join('out.jpg')
+            self.assertEqual((plan.joiner.name, plan.orientation), ('jt_xl', 'columns'))
+            self.assertTrue(plan.automatic)
+            plan = self.make_untiler(40, 30).plan_join('out.jpg')
+            self.assertEqual(plan.joiner.name, 'jt_tree')
+        with unittest.mock.patch.object(dezoomify.TurboJPEGJoiner, 'available', return_value=True):
+            self.assertEqual(self.make_untiler(40, 30).plan_join('out.jpg').joiner.name, 'tj_mem')
+        # Wide images are assembled from fewer, longer strips.
+        plan = self.make_untiler(40, 4, 'jt_xl').plan_join('out.jpg')
+        self.assertEqual((plan.joiner.name, plan.orientation), ('jt_xl', 'rows'))
+        self.assertFalse(plan.automatic)
+        # The temporary images and the downloaded tiles.
+        self.assertEqual(plan.storage, (3 + 1) * (256 * 40 - 100) * (256 * 4 - 100))
+        untiler = self.make_untiler(4, 4)
+        untiler.format = 'tiff'
+        self.assertIs(untiler.plan_join('out.tif').joiner, dezoomify.BigTiffJoiner)
+
+    def test_turbojpeg_memory(self):
+        untiler = self.make_untiler(40, 30)
+        pixels = untiler.width * untiler.height
+        # The coefficients and the encoded image.
+        self.assertEqual(dezoomify.TurboJPEGJoiner.peak_memory(untiler, 'columns'), 4 * pixels)
+        # And the tiles kept in memory.
+        untiler.in_memory = True
+        self.assertEqual(dezoomify.TurboJPEGJoiner.peak_memory(untiler, 'columns'), 5 * pixels)
+
+    def test_pieces(self):
+        untiler = self.make_untiler(40, 30, 'jt_xl')
+        # A row of tiles takes 10140 * 256 * 3 bytes, two of them fit.
+        untiler.max_memory = 20 * 2 ** 20
+        plan = untiler.plan_join('out.jpg')
+        self.assertEqual((len(plan.pieces), plan.parallel), (30, 2))
+        self.assertEqual([(piece.x, piece.y, piece.width, piece.height) for piece in plan.pieces[:2]],
+                         [(0, 0, 10140, 256), (0, 256, 10140, 256)])
+        self.assertLessEqual(plan.peak_memory, untiler.max_memory)
+        # Not even a row of tiles fits, 20 tiles do.
+        untiler.max_memory, untiler.join_workers = 4 * 2 ** 20, 1
+        plan = untiler.plan_join('out.jpg')
+        self.assertEqual((len(plan.pieces), plan.parallel), (80, 1))
+        last = plan.pieces[-1]
+        self.assertEqual((last.col, last.row, last.x_tiles, last.y_tiles), (36, 28, 4, 2))
+        self.assertEqual((last.width, last.height), (10140 - 36 * 256, 7580 - 28 * 256))
+        untiler.tile_source = lambda col, row: (col, row)
+        self.assertEqual(last.tile_source(1, 1), (37, 29))
+
+    def test_region(self):
+        self.assertEqual(dezoomify.parse_region('0.25,0.5,100,1.0'), [0.25, 0.5, 100, 1.0])
+        for region in ('1,2,3', '1,2,3,x', '0,0,1.5,0.5', '0,0,0,10'):
+            self.assertRaises(dezoomify.argparse.ArgumentTypeError, dezoomify.parse_region, region)
+        untiler = self.make_untiler(12, 9, 'jt_xl')
+        untiler.log = dezoomify.logging.getLogger(__name__)
+        untiler.region = [300, 0.25, 700, 0.5]
+        plan = untiler.plan_join('out.jpg')
+        self.assertEqual(plan.crop, (300, 551, 700, 1102))
+        region = plan.region
+        self.assertEqual((region.col, region.row, region.x_tiles, region.y_tiles), (1, 2, 3, 5))
+        self.assertEqual(plan.storage, (region.width * region.height) * (plan.joiner.working_storage_per_pixel + 1))
+        # Clipped to the image.
+        untiler.region = [2900, 2000, 500, 500]
+        self.assertEqual(untiler.plan_join('out.jpg').crop, (2900, 2000, 72, 204))
+        untiler.region = [3100, 0, 10, 10]
+        untiler.zoom_level = 4
+        self.assertRaises(dezoomify.ZoomLevelError, untiler.plan_join, 'out.jpg')
+
+    def test_parallel_strips(self):
+        # Strips built in parallel, finishing in any order, are added as they are in a sequential join.
+        def join(join_workers):
+            untiler = self.make_untiler(5, 3)
+            untiler.join_workers, untiler.join_slots = join_workers, threading.BoundedSemaphore(join_workers)
+            untiler.log, untiler.plan, untiler.tile_data = unittest.mock.Mock(), unittest.mock.Mock(), None
+            untiler.plan.orientation = 'columns'
+            untiler.downloaded_iterator = iter([(None, None) if (col, row) == (2, 1) else (col, row)
+                                                for col in range(5) for row in range(3)])
+            untiler.tile_source = lambda col, row: '{}_{}.jpg'.format(col, row)
+            added = []
+
+            def build_strip(strip, tiles):
+                time.sleep(0.01 * ((strip * 7) % 5))
+                return '+'.join(str(tile) for tile in tiles)
+
+            dezoomify.JpegtranLargeJoiner(untiler, 'out.jpg', None, None).assemble_strips(
+                build_strip, lambda strip, image: added.append((strip, image)))
+            return added
+
+        sequential = join(1)
+        self.assertEqual(sequential[2], (2, '2_0.jpg+None+2_2.jpg'))
+        self.assertEqual(join(4), sequential)
+
+    @staticmethod
+    def layout_jpegtran(*args, drops):
+        """
+        A jpegtran which crops and drops the layout of the tiles of an image, a JSON file
+        with its size and the positions of its tiles, instead of the image. The offsets
+        and tiles of the drops are listed in drops.
+        """
+        args = list(args)
+        with open(args[-1]) as f:
+            image = json.load(f)
+        if '-crop' in args:
+            size, x, y = args[args.index('-crop') + 1].split('+')
+            (width, height), x, y = map(int, size.split('x')), int(x), int(y)
+            image = {'size': [width, height],
+                     'tiles': [[name, left - x, top - y] for name, left, top in image['tiles']
+                               if x <= left < x + width and y <= top < y + height]}
+        if '-drop' in args:
+            x, y = map(int, args[args.index('-drop') + 1].split('+')[1:])
+            with open(args[args.index('-drop') + 2]) as f:
+                dropped = json.load(f)
+            width, height = dropped['size']
+            drops.append((args[args.index('-drop') + 1], sorted(name for name, _, _ in dropped['tiles'])))
+            image['tiles'] = [[name, left, top] for name, left, top in image['tiles']
+                              if not (x <= left < x + width and y <= top < y + height)]
+            image['tiles'] += [[name, left + x, top + y] for name, left, top in dropped['tiles']]
+        with open(args[args.index('-outfile') + 1], 'w') as f:
+            json.dump(image, f)
+        return 0
+
+    def layout_tiles(self, untiler, tempdir, positions):
+        """
+        Write the layouts of the tiles of the untiler into tempdir, to be joined with the
+        layout_jpegtran, and return the list the drops of its merges are added to.
+        """
+        untiler.tile_dir, untiler.ext = tempdir, 'jpg'
+        untiler.log, untiler.tile_data, untiler.optimize = unittest.mock.Mock(), None, 'skip'
+        untiler.join_slots = threading.BoundedSemaphore(untiler.join_workers)
+        untiler.progress_lock, untiler.num_joined = threading.Lock(), 0
+        untiler.num_tiles, untiler.zoom_level = untiler.x_tiles * untiler.y_tiles, 3
+        drops = []
+        untiler.run_jpegtran = unittest.mock.Mock(side_effect=functools.partial(self.layout_jpegtran, drops=drops))
+        for col, row in positions:
+            with open(untiler.local_tile_path(col, row), 'w') as f:
+                json.dump({'size': [min(256, untiler.width - 256 * col), min(256, untiler.height - 256 * row)],
+                           'tiles': [['{}_{}'.format(col, row), 0, 0]]}, f)
+        return drops
+
+    def join_layout(self, untiler, joiner, missing=()):
+        """
+        Join the tiles of the untiler, but for the missing ones, with the layout_jpegtran, and
+        return the layout of the joined image, the drops and the list of the jpegtran calls.
+        """
+        tempdir = tempfile.mkdtemp()
+        try:
+            positions = [(col, row) for col in range(untiler.x_tiles) for row in range(untiler.y_tiles)]
+            if untiler.plan.orientation == 'rows':
+                positions.sort(key=lambda position: position[::-1])
+            drops = self.layout_tiles(untiler, tempdir, positions)
+            untiler.downloaded_iterator = iter([(None, None) if position in missing else position
+                                                for position in positions])
+            destination = os.path.join(tempdir, 'out.jpg')
+            joiner(untiler, destination, lambda: None, lambda: None).join()
+            with open(destination) as f:
+                layout = json.load(f)
+            os.unlink(destination)
+            # All temporary images are deleted.
+            self.assertEqual(sorted(os.listdir(tempdir)),
+                             sorted('{}_{}.jpg'.format(col, row) for col, row in positions))
+            return layout, drops, untiler.run_jpegtran.call_args_list
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_jpegtran_tree(self):
+        untiler = self.make_untiler(3, 3, 'jt_tree')
+        untiler.plan = unittest.mock.Mock(orientation='columns')
+        layout, drops, calls = self.join_layout(untiler, dezoomify.JpegtranTreeJoiner, missing={(1, 1)})
+        self.assertEqual(layout['size'], [668, 668])
+        self.assertEqual(sorted(layout['tiles']), sorted(['{}_{}'.format(col, row), 256 * col, 256 * row]
+                                                         for col in range(3) for row in range(3) if (col, row) != (1, 1)))
+        self.assertEqual(untiler.num_joined, 8)
+        # The tiles of a column are merged pairwise, then the columns are, the columns being built in parallel.
+        self.assertEqual(sorted(drops), sorted([('+0+256', ['0_1']), ('+0+512', ['0_2']),
+                                                # The second tile of column 1 is missing.
+                                                ('+0+512', ['1_2']),
+                                                ('+0+256', ['2_1']), ('+0+512', ['2_2']),
+                                                ('+256+0', ['1_0', '1_2']),
+                                                ('+512+0', ['2_0', '2_1', '2_2'])]))
+        # Columns 0 and 1 are merged before column 2 is added.
+        self.assertLess(drops.index(('+256+0', ['1_0', '1_2'])), drops.index(('+512+0', ['2_0', '2_1', '2_2'])))
+        # The missing tile leaves a blank block, cropped from the tile above it.
+        crops = [call[0][call[0].index('-crop') + 1] for call in calls if '-crop' in call[0]]
+        self.assertIn('256x512+0+0', crops)
+        # By rows, the same layout.
+        untiler = self.make_untiler(3, 2, 'jt_tree')
+        untiler.plan = unittest.mock.Mock(orientation='rows')
+        layout, drops, _ = self.join_layout(untiler, dezoomify.JpegtranTreeJoiner, missing={(0, 0)})
+        self.assertEqual(layout['size'], [668, 412])
+        self.assertEqual(sorted(layout['tiles']), sorted(['{}_{}'.format(col, row), 256 * col, 256 * row]
+                                                         for col in range(3) for row in range(2) if (col, row) != (0, 0)))
+        self.assertIn(('+0+256', ['0_1', '1_1', '2_1']), drops)
+
+    def test_join_pieces(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            untiler = self.make_untiler(5, 3, 'jt_tree')
+            # Four tiles fit in memory at one byte per pixel, a piece of 2x2 tiles is joined at a time.
+            untiler.max_memory, untiler.join_workers = 4 * 256 * 256, 1
+            pieces, parallel = untiler.plan_pieces(1)
+            self.assertEqual(([(piece.col, piece.row) for piece in pieces], parallel),
+                             ([(0, 0), (2, 0), (4, 0), (0, 2), (2, 2), (4, 2)], 1))
+            # Join two pieces at a time.
+            untiler.join_workers = 4
+            untiler.plan = unittest.mock.Mock(pieces=pieces, parallel=2, joiner=dezoomify.JpegtranTreeJoiner,
+                                              orientation='columns')
+            positions = [(col, row) for piece in pieces for col in range(piece.col, piece.col + piece.x_tiles)
+                         for row in range(piece.row, piece.row + piece.y_tiles)]
+            self.layout_tiles(untiler, tempdir, positions)
+            # None of the tiles of the piece at (2, 0) can be downloaded, nor tile (0, 2).
+            missing = {(2, 0), (3, 0), (2, 1), (3, 1), (0, 2)}
+            untiler.downloaded_iterator = iter([(None, None) if position in missing else position
+                                                for position in positions])
+            untiler.join_pieces(os.path.join(tempdir, 'out.jpg'), lambda: None)
+            self.assertEqual(untiler.num_joined, 10)
+            self.assertTrue(any('out_0_1.jpg' in call[0][0] and 'left out' in call[0][0]
+                                for call in untiler.log.warning.call_args_list))
+            with open(os.path.join(tempdir, 'out.json')) as f:
+                index = json.load(f)
+            self.assertEqual(index, {'width': 1180, 'height': 668, 'pieces': [
+                {'file': 'out_0_0.jpg', 'x': 0, 'y': 0, 'width': 512, 'height': 512},
+                {'file': 'out_0_2.jpg', 'x': 1024, 'y': 0, 'width': 156, 'height': 512},
+                {'file': 'out_1_0.jpg', 'x': 0, 'y': 512, 'width': 512, 'height': 156},
+                {'file': 'out_1_1.jpg', 'x': 512, 'y': 512, 'width': 512, 'height': 156},
+                {'file': 'out_1_2.jpg', 'x': 1024, 'y': 512, 'width': 156, 'height': 156}]})
+            # The tiles are placed relative to their piece.
+            for entry in index['pieces']:
+                with open(os.path.join(tempdir, entry['file'])) as f:
+                    layout = json.load(f)
+                self.assertEqual(layout['size'], [entry['width'], entry['height']])
+                self.assertEqual(sorted(layout['tiles']), sorted(
+                    ['{}_{}'.format(col, row), 256 * col - entry['x'], 256 * row - entry['y']]
+                    for col, row in positions if (col, row) not in missing and
+                    0 <= 256 * col - entry['x'] < entry['width'] and 0 <= 256 * row - entry['y'] < entry['height']))
+
+            # Bands of full rows when a row of tiles fits in memory, two of them are joined at a time.
+            untiler = self.make_untiler(5, 3, 'jt_tree')
+            untiler.max_memory, untiler.join_workers = 2 * 1180 * 256, 2
+            pieces, parallel = untiler.plan_pieces(1)
+            self.assertEqual(([(piece.col, piece.row, piece.x_tiles, piece.y_tiles) for piece in pieces], parallel),
+                             ([(0, 0, 5, 1), (0, 1, 5, 1), (0, 2, 5, 1)], 2))
+            untiler.plan = unittest.mock.Mock(pieces=pieces, parallel=parallel, joiner=dezoomify.JpegtranTreeJoiner,
+                                              orientation='columns')
+            positions = [(col, row) for piece in pieces for col in range(5) for row in range(piece.row, piece.row + 1)]
+            self.layout_tiles(untiler, tempdir, positions)
+            untiler.downloaded_iterator = iter(positions)
+            untiler.join_pieces(os.path.join(tempdir, 'bands.jpg'), lambda: None)
+            with open(os.path.join(tempdir, 'bands.json')) as f:
+                self.assertEqual([(entry['file'], entry['y'], entry['height']) for entry in json.load(f)['pieces']],
+                                 [('bands_0.jpg', 0, 256), ('bands_1.jpg', 256, 256), ('bands_2.jpg', 512, 156)])
+        finally:
+            shutil.rmtree(tempdir)
+
+    class MarkedTurboJPEG():
+        """
+        A TurboJPEG library whose tiles have the DC coefficients of all their blocks set to
+        the number in their comment marker, and whose output lists the DC coefficients.
+        """
+        optimizes = False
+
+        def transform(self, data, callback, output=None, optimize=False):
+            header = dezoomify.JpegHeader(data)
+            number = int(header.markers[0][4:]) if header.markers else 0
+            dc = []
+            for component, (width, height) in enumerate(header.blocks(header.width, header.height)):
+                dc.append([])
+                for block_row in range(height):
+                    row = (ctypes.c_short * (64 * width))(*[number if i % 64 == 0 else 0 for i in range(64 * width)])
+                    callback(ctypes.addressof(row), component, block_row, width)
+                    dc[-1].append(list(row[::64]))
+            if output:
+                output.write(json.dumps(dc).encode())
+
+    def test_turbojpeg_joiner(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            untiler = self.make_untiler(3, 3, 'tj_mem')
+            untiler.plan = unittest.mock.Mock(orientation='columns')
+            untiler.tile_dir, untiler.log, untiler.optimize = tempdir, unittest.mock.Mock(), 'skip'
+            untiler.join_slots = threading.BoundedSemaphore(untiler.join_workers)
+            untiler.progress_lock, untiler.num_joined, untiler.num_tiles, untiler.zoom_level = threading.Lock(), 0, 9, 3
+            untiler.load_turbojpeg = self.MarkedTurboJPEG
+            # The tiles are numbered from 1, tile (1, 1) is missing.
+            untiler.tile_data = {(col, row): marked_jpeg(1 + col + 3 * row, min(256, 668 - 256 * col),
+                                                            min(256, 668 - 256 * row))
+                                 for col in range(3) for row in range(3) if (col, row) != (1, 1)}
+            downloaded = [(col, row) if (col, row) in untiler.tile_data else (None, None)
+                          for col in range(3) for row in range(3)]
+            untiler.downloaded_iterator = iter(downloaded)
+            destination = os.path.join(tempdir, 'out.jpg')
+            dezoomify.TurboJPEGJoiner(untiler, destination, lambda: None, lambda: None).join()
+            with open(destination) as f:
+                luma, chroma, _ = json.load(f)
+            self.assertEqual(untiler.num_joined, 8)
+            # 32 luma blocks and 16 chroma blocks per tile, and 20 and 10 in the edge tiles.
+            self.assertEqual((len(luma[0]), len(luma), len(chroma[0]), len(chroma)), (84, 84, 42, 42))
+            for blocks, size in ((luma, 32), (chroma, 16)):
+                self.assertEqual(blocks, [[0 if (x // size, y // size) == (1, 1) else 1 + x // size + 3 * (y // size)
+                                           for x in range(len(blocks[0]))] for y in range(len(blocks))])
+            self.assertEqual(os.listdir(tempdir), ['out.jpg'])
+            # A tile with other quantization tables cannot be mixed in, jt_xl joins all tiles instead.
+            untiler.tile_data[2, 1] = marked_jpeg(6, 156, 256, qtable=3)
+            untiler.downloaded_iterator = iter(downloaded)
+            joined = []
+            with unittest.mock.patch.object(dezoomify.JpegtranLargeJoiner, 'join',
+                                            lambda joiner: joined.extend(untiler.downloaded_iterator)):
+                dezoomify.TurboJPEGJoiner(untiler, destination, lambda: None, lambda: None).join()
+            self.assertEqual(joined, downloaded)
+            self.assertEqual(untiler.num_joined, 0)
+            self.assertEqual(os.listdir(tempdir), ['out.jpg'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    @unittest.skipUnless(dezoomify.Image, 'Pillow is not installed')
+    def test_failed_crop_keeps_region(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            untiler = self.make_untiler(12, 9, 'jt_xl')
+            untiler.log = unittest.mock.Mock()
+            untiler.region, untiler.optimize = [300, 0.25, 700, 0.5], 'final'
+            untiler.plan = untiler.plan_join('out.jpg')
+            untiler.downloaded_iterator = iter(())
+            destination = os.path.join(tempdir, 'out.jpg')
+            joined = dezoomify.io.BytesIO()
+            dezoomify.Image.new('RGB', (64, 64)).save(joined, 'JPEG')
+
+            def join(joiner):
+                with open(joiner.output_destination, 'wb') as f:
+                    f.write(joined.getvalue())
+            untiler.run_jpegtran = unittest.mock.Mock(return_value=1)
+            with unittest.mock.patch.object(untiler.plan.joiner, 'join', join):
+                untiler.join_region(destination, None, None)
+            with open(destination, 'rb') as f:
+                self.assertEqual(f.read(), joined.getvalue())
+            self.assertEqual(os.listdir(tempdir), ['out.jpg'])
+            self.assertIn('failed', untiler.log.warning.call_args[0][0])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_write_image(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            untiler = unittest.mock.Mock(spec=['optimize', 'optimize_image', 'optimize_later', 'log', 'plan'])
+            destination = os.path.join(tempdir, 'out.jpg')
+            joiner = dezoomify.JpegtranLargeJoiner(untiler, destination, None, None)
+            path = os.path.join(tempdir, 'final.jpg')
+            for untiler.optimize in ('final', 'merge'):
+                joiner.write_image(path)
+                untiler.optimize_image.assert_called_with(path, destination)
+            untiler.optimize = 'background'
+            with open(path, 'wb') as f:
+                f.write(b'image')
+            joiner.write_image(path)
+            unoptimized, later_destination = untiler.optimize_later.call_args[0]
+            self.assertEqual((os.path.dirname(unoptimized), later_destination), (tempdir, destination))
+            untiler.optimize = 'skip'
+            shutil.move(unoptimized, path)
+            joiner.write_image(path)
+            self.assertEqual(os.listdir(tempdir), ['out.jpg'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_optimize_image(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            untiler = object.__new__(dezoomify.ImageUntiler)
+            untiler.log = unittest.mock.Mock()
+            source, destination = os.path.join(tempdir, 'final.jpg'), os.path.join(tempdir, 'out.jpg')
+
+            def run_jpegtran(*args, returncode):
+                with open(args[args.index('-outfile') + 1], 'wb') as f:
+                    f.write(b'optimized'[:5 if returncode else None])
+                return returncode
+
+            for returncode, written in ((0, b'optimized'), (1, b'image')):
+                with open(source, 'wb') as f:
+                    f.write(b'image')
+                untiler.run_jpegtran = functools.partial(run_jpegtran, returncode=returncode)
+                untiler.optimize_image(source, destination)
+                # A failed optimization keeps the image as it is.
+                with open(destination, 'rb') as f:
+                    self.assertEqual(f.read(), written)
+                self.assertEqual(os.listdir(tempdir), ['out.jpg'])
+        finally:
+            shutil.rmtree(tempdir)
+
+
 if __name__ == '__main__':
     unittest.main()